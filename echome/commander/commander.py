@@ -1,5 +1,6 @@
 import logging
 import subprocess
+from typing import Callable
 
 logger = logging.getLogger(__name__)
 
@@ -10,14 +11,30 @@ class BaseCommander():
     verbose_flag = ["-v"]
     env = {}
 
-    def command(self, cmd: list, wait: bool = True):
-        """Run a command."""
+    def command(self, cmd: list, wait: bool = True, on_output: Callable[[str], None] = None):
+        """Run a command.
+
+        If on_output is set, it is called with each line of output while the command is
+        running. Progress updates that end with a carriage return count as lines as well.
+        """
 
         opt_verbose = self.verbose_flag if self.set_verbose else []
         cmd = [self.base_command] + opt_verbose + cmd
         
         logger.debug(f"Running command: {cmd}")
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, env=self.env)
+        if on_output:
+            # Universal newlines turns the carriage returns into newlines for us
+            lines = []
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                lines.append(line)
+                on_output(line)
+            proc.wait()
+            stdout = "\n".join(lines)
+            logger.debug(f"SUBPROCESS RETURN CODE: {proc.returncode}")
+            return stdout, proc.returncode
+
         if wait:
             logger.debug("wait set to True. Waiting..")
             proc.wait()
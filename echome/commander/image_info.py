@@ -0,0 +1,229 @@
+import logging
+import os
+import stat
+import struct
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_V2_HEADER_LENGTH = 72
+QCOW2_V3_HEADER_LENGTH = 104
+
+# Header extension types
+QCOW2_EXT_END = 0x00000000
+QCOW2_EXT_BACKING_FORMAT = 0xe2792aca
+QCOW2_EXT_BITMAPS = 0x23852875
+QCOW2_EXT_DATA_FILE = 0x44415441
+QCOW2_EXT_CRYPTO = 0x0537be77
+
+# Feature bits
+QCOW2_INCOMPAT_DIRTY = 1 << 0
+QCOW2_INCOMPAT_CORRUPT = 1 << 1
+QCOW2_INCOMPAT_DATA_FILE = 1 << 2
+QCOW2_INCOMPAT_COMPRESSION = 1 << 3
+QCOW2_INCOMPAT_EXTL2 = 1 << 4
+QCOW2_COMPAT_LAZY_REFCOUNTS = 1 << 0
+QCOW2_AUTOCLEAR_BITMAPS = 1 << 0
+
+COMPRESSION_TYPES = {0: "zlib", 1: "zstd"}
+
+# Magic numbers (offset, magic) of the other formats qemu-img can probe. Images
+# starting with any of these are never reported as raw.
+OTHER_FORMAT_MAGICS = [
+    (0, b"QFI\xfb"),                    # qcow (v1)
+    (0, b"QFI\x00"),                    # qed
+    (0, b"KDMV"),                       # vmdk
+    (0, b"# Disk DescriptorFile"),      # vmdk descriptor
+    (0, b"COWD"),                       # vmdk (ESX)
+    (0, b"conectix"),                   # vpc
+    (0, b"vhdxfile"),                   # vhdx
+    (0, b"LUKS\xba\xbe"),               # luks
+    (0, b"WithoutFreeSpace"),           # parallels
+    (0, b"WithouFreSpacExt"),           # parallels
+    (0, b"Bochs Virtual HD Image"),     # bochs
+    (0, b"#!/bin/sh\n#V2.0 Format"),    # cloop
+    (64, struct.pack("<I", 0xbeda107f)),  # vdi
+]
+PROBE_SIZE = 2048
+
+
+class UnsupportedImage(Exception):
+    """The image can't be read natively, use `qemu-img info` instead."""
+    pass
+
+
+def read_image_info(filename: str) -> dict:
+    """Read the metadata of a raw or qcow2 image without running `qemu-img info`. Returns the
+    same dictionary as `qemu-img info --output json` for the fields qemu-img reports for these
+    formats (format, virtual-size, actual-size, cluster-size, backing file and dirty-flag).
+
+    Raises UnsupportedImage for other formats and for qcow2 features that are not handled here
+    (encryption, internal snapshots, bitmaps, external data files, ...). Raises OSError if the
+    file can't be read.
+    """
+    st = os.stat(filename)
+    if not stat.S_ISREG(st.st_mode):
+        raise UnsupportedImage(f"{filename} is not a regular file")
+
+    with open(filename, "rb") as f:
+        header = f.read(PROBE_SIZE)
+        try:
+            if header[:4] == QCOW2_MAGIC and len(header) >= 8 and struct.unpack(">I", header[4:8])[0] in (2, 3):
+                details = _read_qcow2(filename, f, header, st)
+            else:
+                details = _read_raw(filename, f, header, st)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise UnsupportedImage(f"{filename} has an invalid header: {e}")
+
+    return details
+
+
+def read_image_info_chain(filename: str, max_depth: int = 64) -> list:
+    """Read the metadata of an image and all of its backing files, like `qemu-img info --backing-chain`."""
+    chain = []
+    seen = set()
+    while filename:
+        real_path = os.path.realpath(filename)
+        if real_path in seen or len(chain) >= max_depth:
+            raise UnsupportedImage(f"Backing chain of {chain[0]['filename']} is too deep or has a loop")
+        seen.add(real_path)
+
+        details = read_image_info(filename)
+        chain.append(details)
+
+        backing_format = details.get("backing-filename-format")
+        if backing_format and backing_format not in ("raw", "qcow2"):
+            raise UnsupportedImage(f"Unsupported backing file format: {backing_format}")
+        filename = details.get("full-backing-filename")
+    return chain
+
+
+def _read_qcow2(filename: str, f, header: bytes, st: os.stat_result) -> dict:
+    if len(header) < QCOW2_V2_HEADER_LENGTH:
+        raise UnsupportedImage(f"{filename} has a truncated qcow2 header")
+
+    (version, backing_file_offset, backing_file_size, cluster_bits, size,
+        crypt_method, _, _, _, _, nb_snapshots, _) = struct.unpack(">IQIIQIIQQIIQ", header[4:72])
+
+    incompatible_features = compatible_features = autoclear_features = 0
+    refcount_order = 4
+    compression_type = 0
+    header_length = QCOW2_V2_HEADER_LENGTH
+    if version == 3:
+        if len(header) < QCOW2_V3_HEADER_LENGTH:
+            raise UnsupportedImage(f"{filename} has a truncated qcow2 header")
+        (incompatible_features, compatible_features, autoclear_features,
+            refcount_order, header_length) = struct.unpack(">QQQII", header[72:104])
+        if header_length > QCOW2_V3_HEADER_LENGTH:
+            compression_type = header[104]
+
+    if crypt_method != 0:
+        raise UnsupportedImage(f"{filename} is encrypted")
+    if nb_snapshots != 0:
+        raise UnsupportedImage(f"{filename} has internal snapshots")
+    if autoclear_features & QCOW2_AUTOCLEAR_BITMAPS:
+        raise UnsupportedImage(f"{filename} has persistent bitmaps")
+    if incompatible_features & ~(QCOW2_INCOMPAT_DIRTY | QCOW2_INCOMPAT_CORRUPT | QCOW2_INCOMPAT_COMPRESSION | QCOW2_INCOMPAT_EXTL2):
+        # External data files or features newer than this parser
+        raise UnsupportedImage(f"{filename} uses unsupported qcow2 features")
+    if compression_type not in COMPRESSION_TYPES:
+        raise UnsupportedImage(f"{filename} uses an unknown compression type")
+
+    cluster_size = 1 << cluster_bits
+    extensions = _read_qcow2_extensions(filename, f, header_length, backing_file_offset, cluster_size)
+
+    details = {
+        "virtual-size": size,
+        "filename": filename,
+        "cluster-size": cluster_size,
+        "format": "qcow2",
+        "actual-size": st.st_blocks * SECTOR_SIZE,
+        "format-specific": {
+            "type": "qcow2",
+            "data": _qcow2_format_specific(version, incompatible_features, compatible_features, refcount_order, compression_type),
+        },
+        "dirty-flag": bool(incompatible_features & QCOW2_INCOMPAT_DIRTY),
+    }
+
+    if backing_file_offset:
+        f.seek(backing_file_offset)
+        backing_file = f.read(backing_file_size).decode()
+        if ":" in backing_file.split("/")[0]:
+            # Protocols (nbd:, json:, ...) are resolved by qemu
+            raise UnsupportedImage(f"{filename} has a backing file that is not a local file: {backing_file}")
+
+        details["backing-filename"] = backing_file
+        details["full-backing-filename"] = _full_backing_filename(filename, backing_file)
+        if QCOW2_EXT_BACKING_FORMAT in extensions:
+            details["backing-filename-format"] = extensions[QCOW2_EXT_BACKING_FORMAT].decode()
+
+    return details
+
+
+def _read_qcow2_extensions(filename: str, f, offset: int, backing_file_offset: int, cluster_size: int) -> dict:
+    """Returns the header extensions as a dictionary of type -> data"""
+    # Extensions end at the backing file name, or the end of the first cluster
+    end = backing_file_offset if backing_file_offset else cluster_size
+    extensions = {}
+    f.seek(offset)
+    while offset + 8 <= end:
+        ext_type, ext_length = struct.unpack(">II", f.read(8))
+        if ext_type == QCOW2_EXT_END:
+            break
+        if ext_type in (QCOW2_EXT_BITMAPS, QCOW2_EXT_DATA_FILE, QCOW2_EXT_CRYPTO):
+            raise UnsupportedImage(f"{filename} has an unsupported qcow2 header extension: {ext_type:#x}")
+
+        extensions[ext_type] = f.read(ext_length)
+        # Extension data is padded to a multiple of 8 bytes
+        offset += 8 + ((ext_length + 7) & ~7)
+        f.seek(offset)
+    return extensions
+
+
+def _qcow2_format_specific(version: int, incompatible_features: int, compatible_features: int,
+        refcount_order: int, compression_type: int) -> dict:
+    if version == 2:
+        return {
+            "compat": "0.10",
+            "compression-type": "zlib",
+            "refcount-bits": 16,
+        }
+
+    return {
+        "compat": "1.1",
+        "compression-type": COMPRESSION_TYPES[compression_type],
+        "lazy-refcounts": bool(compatible_features & QCOW2_COMPAT_LAZY_REFCOUNTS),
+        "refcount-bits": 1 << refcount_order,
+        "corrupt": bool(incompatible_features & QCOW2_INCOMPAT_CORRUPT),
+        "extended-l2": bool(incompatible_features & QCOW2_INCOMPAT_EXTL2),
+    }
+
+
+def _read_raw(filename: str, f, header: bytes, st: os.stat_result) -> dict:
+    for offset, magic in OTHER_FORMAT_MAGICS:
+        if header[offset:offset + len(magic)] == magic:
+            raise UnsupportedImage(f"{filename} is not a raw or qcow2 image")
+
+    # dmg images are identified by a trailer at the end of the file
+    if st.st_size >= 512:
+        f.seek(st.st_size - 512)
+        if f.read(4) == b"koly":
+            raise UnsupportedImage(f"{filename} is not a raw or qcow2 image")
+
+    return {
+        # qemu rounds the size of images up to whole sectors
+        "virtual-size": -(-st.st_size // SECTOR_SIZE) * SECTOR_SIZE,
+        "filename": filename,
+        "format": "raw",
+        "actual-size": st.st_blocks * SECTOR_SIZE,
+        "dirty-flag": False,
+    }
+
+
+def _full_backing_filename(filename: str, backing_file: str) -> str:
+    # Relative backing files are relative to the directory of the image, like qemu's path_combine()
+    if os.path.isabs(backing_file):
+        return backing_file
+    return os.path.join(os.path.dirname(filename), backing_file)
@@ -0,0 +1,210 @@
+import logging
+import struct
+from datetime import datetime, timezone
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 2048
+
+# Sectors 0-15 are the system area, the volume descriptors start after it
+SYSTEM_AREA_SECTORS = 16
+
+# Escape sequence of a Joliet supplementary volume descriptor (UCS-2 level 3)
+JOLIET_ESCAPE = b"%/E"
+
+DIRECTORY_FLAG = 0x02
+
+
+class IsoCreationError(Exception):
+    pass
+
+
+def build_iso(files: Dict[str, bytes], volume_id: str, timestamp: datetime = None) -> bytes:
+    """Build an ISO9660 image with Joliet extensions containing `files` (name -> content) in
+    its root directory. This is the layout `genisoimage -volid <volume_id> -joliet` creates,
+    so a NoCloud seed ("cidata") image can be created without cloud-localds:
+
+        build_iso({"user-data": b"...", "meta-data": b"..."}, "cidata")
+
+    Only a root directory is supported. The ISO9660 names are 8.3 upper case names
+    (user-data is USER_DAT.;1), the Joliet names are the original ones, which is what
+    Linux uses to mount the image.
+    """
+    if not files:
+        raise IsoCreationError("An ISO image needs at least one file.")
+    if len(volume_id) > 16:
+        raise IsoCreationError("The volume ID can be 16 characters at most.")
+
+    timestamp = timestamp if timestamp else datetime.now(timezone.utc)
+    names = sorted(files)
+
+    iso_names = [_iso_name(name) for name in names]
+    if len(set(iso_names)) != len(iso_names):
+        raise IsoCreationError(f"File names are not unique as ISO9660 names: {', '.join(names)}")
+    # Like genisoimage, Joliet names have no version number
+    joliet_names = [name.encode("utf-16-be") for name in names]
+
+    # Volume descriptors (primary, Joliet, terminator), then the path tables
+    # (L and M, for both), then the two root directories and the file data.
+    path_table_sector = SYSTEM_AREA_SECTORS + 3
+    iso_root_sector = path_table_sector + 4
+    iso_root_size = _directory_size(iso_names)
+    joliet_root_sector = iso_root_sector + iso_root_size // SECTOR_SIZE
+    joliet_root_size = _directory_size(joliet_names)
+    data_sector = joliet_root_sector + joliet_root_size // SECTOR_SIZE
+
+    extents = []
+    for name in names:
+        extents.append(data_sector)
+        data_sector += _sectors(len(files[name]))
+    volume_size = data_sector
+
+    date = _directory_date(timestamp)
+    iso_root = _directory(iso_root_sector, iso_root_size, iso_names, names, files, extents, date)
+    joliet_root = _directory(joliet_root_sector, joliet_root_size, joliet_names, names, files, extents, date)
+
+    image = bytearray(volume_size * SECTOR_SIZE)
+    _put(image, SYSTEM_AREA_SECTORS, _volume_descriptor(
+        1, volume_id, volume_size, path_table_sector, iso_root_sector, iso_root_size, timestamp))
+    _put(image, SYSTEM_AREA_SECTORS + 1, _volume_descriptor(
+        2, volume_id, volume_size, path_table_sector + 2, joliet_root_sector, joliet_root_size, timestamp))
+    _put(image, SYSTEM_AREA_SECTORS + 2, b"\xffCD001\x01")
+
+    _put(image, path_table_sector, _path_table(iso_root_sector, "<"))
+    _put(image, path_table_sector + 1, _path_table(iso_root_sector, ">"))
+    _put(image, path_table_sector + 2, _path_table(joliet_root_sector, "<"))
+    _put(image, path_table_sector + 3, _path_table(joliet_root_sector, ">"))
+
+    _put(image, iso_root_sector, iso_root)
+    _put(image, joliet_root_sector, joliet_root)
+    for name, extent in zip(names, extents):
+        _put(image, extent, files[name])
+
+    return bytes(image)
+
+
+def write_iso(path: str, files: Dict[str, bytes], volume_id: str, timestamp: datetime = None):
+    """Build an ISO image with build_iso() and write it to `path`."""
+    image = build_iso(files, volume_id, timestamp)
+    with open(path, "wb") as f:
+        f.write(image)
+    logger.debug(f"Wrote {len(image)} byte ISO image to {path}")
+
+
+def _iso_name(name: str) -> bytes:
+    """ISO9660 level 1 (8.3) file name, the way genisoimage maps names without -l"""
+    base, _, extension = name.rpartition(".") if "." in name else (name, "", "")
+    base = "".join(c if c.isascii() and c.isalnum() else "_" for c in base.upper())[:8]
+    extension = "".join(c if c.isascii() and c.isalnum() else "_" for c in extension.upper())[:3]
+    return f"{base}.{extension};1".encode("ascii")
+
+
+def _both16(value: int) -> bytes:
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+
+def _both32(value: int) -> bytes:
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+
+def _sectors(size: int) -> int:
+    return -(-size // SECTOR_SIZE)
+
+
+def _put(image: bytearray, sector: int, data: bytes):
+    offset = sector * SECTOR_SIZE
+    image[offset:offset + len(data)] = data
+
+
+def _directory_record(extent: int, size: int, identifier: bytes, date: bytes, flags: int = 0) -> bytes:
+    length = 33 + len(identifier)
+    # Records have an even length
+    padding = b"\0" if length % 2 else b""
+    return bytes([length + len(padding), 0]) + _both32(extent) + _both32(size) + date \
+        + bytes([flags, 0, 0]) + _both16(1) + bytes([len(identifier)]) + identifier + padding
+
+
+def _directory_size(identifiers: list) -> int:
+    """Size of a directory with "." and ".." and one record per identifier, in whole sectors.
+    Records don't cross sector boundaries."""
+    sectors = 1
+    used = 34 * 2
+    for identifier in identifiers:
+        length = 33 + len(identifier) + (1 - len(identifier) % 2)
+        if used + length > SECTOR_SIZE:
+            sectors += 1
+            used = 0
+        used += length
+    return sectors * SECTOR_SIZE
+
+
+def _directory(sector: int, size: int, identifiers: list, names: list, files: dict, extents: list, date: bytes) -> bytes:
+    # The root directory is its own parent
+    data = bytearray(_directory_record(sector, size, b"\0", date, DIRECTORY_FLAG))
+    data += _directory_record(sector, size, b"\1", date, DIRECTORY_FLAG)
+    for identifier, name, extent in sorted(zip(identifiers, names, extents)):
+        record = _directory_record(extent, len(files[name]), identifier, date)
+        if len(data) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+            data += bytes(SECTOR_SIZE - len(data) % SECTOR_SIZE)
+        data += record
+    return bytes(data)
+
+
+def _path_table(root_sector: int, byte_order: str) -> bytes:
+    # A single entry for the root directory
+    return bytes([1, 0]) + struct.pack(f"{byte_order}IH", root_sector, 1) + b"\0\0"
+
+
+def _volume_descriptor(descriptor_type: int, volume_id: str, volume_size: int, path_table_sector: int,
+        root_sector: int, root_size: int, timestamp: datetime) -> bytes:
+    joliet = descriptor_type == 2
+
+    def text(value: str, length: int) -> bytes:
+        if joliet:
+            # Padded with UCS-2 spaces
+            return (value.encode("utf-16-be") + b"\0 " * length)[:length]
+        return value.encode("ascii").ljust(length, b" ")
+
+    path_table_size = 10
+    date = _volume_date(timestamp)
+    unset_date = b"0" * 16 + b"\0"
+
+    descriptor = bytearray(SECTOR_SIZE)
+    descriptor[0:8] = bytes([descriptor_type]) + b"CD001\x01\0"
+    descriptor[8:40] = text("LINUX", 32)
+    descriptor[40:72] = text(volume_id, 32)
+    descriptor[80:88] = _both32(volume_size)
+    if joliet:
+        descriptor[88:91] = JOLIET_ESCAPE
+    descriptor[120:124] = _both16(1)
+    descriptor[124:128] = _both16(1)
+    descriptor[128:132] = _both16(SECTOR_SIZE)
+    descriptor[132:140] = _both32(path_table_size)
+    descriptor[140:144] = struct.pack("<I", path_table_sector)
+    descriptor[148:152] = struct.pack(">I", path_table_sector + 1)
+    descriptor[156:190] = _directory_record(root_sector, root_size, b"\0", _directory_date(timestamp), DIRECTORY_FLAG)
+    descriptor[190:318] = text("", 128)     # Volume set
+    descriptor[318:446] = text("", 128)     # Publisher
+    descriptor[446:574] = text("", 128)     # Data preparer
+    descriptor[574:702] = text("", 128)     # Application
+    descriptor[702:739] = text("", 37)      # Copyright file
+    descriptor[739:776] = text("", 37)      # Abstract file
+    descriptor[776:813] = text("", 37)      # Bibliographic file
+    descriptor[813:830] = date
+    descriptor[830:847] = date
+    descriptor[847:864] = unset_date
+    descriptor[864:881] = unset_date
+    descriptor[881] = 1
+    return bytes(descriptor)
+
+
+def _volume_date(timestamp: datetime) -> bytes:
+    timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.strftime("%Y%m%d%H%M%S").encode() + f"{timestamp.microsecond // 10000:02d}".encode() + b"\0"
+
+
+def _directory_date(timestamp: datetime) -> bytes:
+    timestamp = timestamp.astimezone(timezone.utc)
+    return bytes([timestamp.year - 1900, timestamp.month, timestamp.day,
+        timestamp.hour, timestamp.minute, timestamp.second, 0])
@@ -1,15 +1,44 @@
 import logging
 import json
+import re
+from typing import Callable
 from .commander import BaseCommander
+from .image_info import read_image_info, UnsupportedImage
 
 logger = logging.getLogger(__name__)
 
+# Progress printed by `qemu-img convert -p`, e.g. "    (12.50/100%)"
+PROGRESS_PATTERN = re.compile(r"\((\d+(?:\.\d+)?)/100%\)")
+
+SIZE_SUFFIXES = {
+    "b": 1,
+    "k": 1024,
+    "m": 1024 ** 2,
+    "g": 1024 ** 3,
+    "t": 1024 ** 4,
+    "p": 1024 ** 5,
+    "e": 1024 ** 6,
+}
+
+
+def size_to_bytes(size: str) -> int:
+    """Convert a qemu-img style size string (e.g. 10G, 512M, 1073741824) to bytes."""
+    size = str(size).strip()
+    suffix = size[-1:].lower()
+    if suffix in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[suffix])
+    return int(size)
+
+
 class QemuImg(BaseCommander):
     """
     Create a QemuImg object to pass commands to qemu-img.
     """
 
     base_command = '/usr/bin/qemu-img'
+    # Cache for info() results, anything with key(filename), get(key) and put(key, value).
+    # Not cached if None (the default), the server sets one up when it starts.
+    info_cache = None
     
 
     def resize(self, filename: str, size: str):
@@ -29,7 +58,8 @@ class QemuImg(BaseCommander):
             return False
     
 
-    def convert(self, filename: str, output_filename: str, output_format=None):
+    def convert(self, filename: str, output_filename: str, output_format=None,
+            progress: Callable[[float], None] = None):
         """Convert or copy an image to another format using `qemu-img convert`.
 
         :param filename: Source filename to convert or copy.
@@ -37,6 +67,8 @@ class QemuImg(BaseCommander):
         :param output_format: Specify a format to copy to. By default, uses the
             format of the original filename. Run qemu-img -h to determine what
             formats are supported, defaults to None
+        :param progress: Called with the percentage completed while converting,
+            defaults to None
 
         :returns: boolean if the operation was successful
         """        
@@ -44,16 +76,18 @@ class QemuImg(BaseCommander):
         if output_format:
             flags.append("-O")
             flags.append(output_format)
+        if progress:
+            flags.append("-p")
         
         cmds = ["convert"] + flags + [filename, output_filename]
-        output, return_code = self.command(cmds)
+        output, return_code = self.command(cmds, on_output=self._progress_parser(progress) if progress else None)
         if return_code == 0:
             return True
         else:
             return False
     
 
-    def create(self, filename: str, format: str, size: str):
+    def create(self, filename: str, format: str, size: str = None, backing_file: str = None, backing_format: str = None):
         """Create a new image for virtual machines using `qemu-img create`.
 
         :param filename: Destination filename/location for the new image.
@@ -62,11 +96,24 @@ class QemuImg(BaseCommander):
         :param size: Size of the image to create. Uses Qemu-img size rules:
             'k' or 'K' (kilobyte, 1024), 'M' (megabyte, 1024k), 'G' (gigabyte, 1024M),
             'T' (terabyte, 1024G), 'P' (petabyte, 1024T) and 'E' (exabyte, 1024P)  are
-            supported. 'b' is ignored.
+            supported. 'b' is ignored. May be omitted when a backing file is used, in
+            which case the size of the backing file is used.
+        :param backing_file: Create a copy-on-write overlay that is backed by this
+            (read-only) image, defaults to None
+        :param backing_format: Format of the backing file. Required by newer versions
+            of qemu-img when backing_file is set, defaults to None
 
         :returns: boolean if the operation was successful
         """        
-        cmds = ["create", "-f", format , filename, size]
+        flags = ["-f", format]
+        if backing_file:
+            flags += ["-b", backing_file]
+            if backing_format:
+                flags += ["-F", backing_format]
+
+        cmds = ["create"] + flags + [filename]
+        if size:
+            cmds.append(size)
         output, return_code = self.command(cmds)
         if return_code == 0:
             return True
@@ -76,16 +123,46 @@ class QemuImg(BaseCommander):
 
     def info(self, filename: str):
         """Get info about an image. Returns a dictionary if the image exists.
+        Raw and qcow2 images are read directly, other formats with `qemu-img info`.
+        Results are cached if an info_cache is set.
 
         :param filename: Destination filename/location for the new image.
 
         :returns: Dictionary if successful, False if the operation was unsuccessful. 
         """
+        info_cache = self.info_cache
+        key = info_cache.key(filename) if info_cache else None
+        if key:
+            cached = info_cache.get(key)
+            if cached is not None:
+                return cached
+
+        try:
+            details = read_image_info(filename)
+        except (UnsupportedImage, OSError) as e:
+            logger.debug(f"Reading image info with qemu-img: {e}")
+        else:
+            # Don't cache results of an image that changed while it was being read
+            if key and info_cache.key(filename) == key:
+                info_cache.put(key, details)
+            return details
+
         flags = ["--output", "json"]
         
         cmds = ["info"] + [filename] + flags
         output, return_code = self.command(cmds)
         if return_code == 0:
-            return json.loads(output)
+            details = json.loads(output)
+            # Don't cache results of an image that changed while it was being read
+            if key and info_cache.key(filename) == key:
+                info_cache.put(key, details)
+            return details
         else:
             return False
+
+
+    def _progress_parser(self, progress: Callable[[float], None]):
+        def parse(line: str):
+            if match := PROGRESS_PATTERN.search(line):
+                progress(float(match.group(1)))
+        return parse
@@ -1,3 +1,430 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+from django.test import SimpleTestCase
+from .cloudlocalds import CloudLocalds
+from .qemuimg import QemuImg
+from .virt_tools import VirtTools
+from .iso9660 import build_iso, IsoCreationError, SECTOR_SIZE
+from .image_info import (
+    read_image_info,
+    read_image_info_chain,
+    UnsupportedImage,
+    QCOW2_EXT_BACKING_FORMAT,
+    QCOW2_INCOMPAT_DIRTY,
+)
 
-# Create your tests here.
+QEMU_IMG = shutil.which("qemu-img")
+CLOUD_LOCALDS = shutil.which(CloudLocalds.base_command)
+
+# Fields read from `qemu-img info` that the native reader has to return identically
+PARITY_FIELDS = [
+    "format",
+    "virtual-size",
+    "actual-size",
+    "cluster-size",
+    "backing-filename",
+    "full-backing-filename",
+    "backing-filename-format",
+    "dirty-flag",
+]
+
+
+def write_qcow2(path:str, size:int, version:int = 3, cluster_bits:int = 16, backing_file:str = None,
+        backing_format:str = None, incompatible_features:int = 0, crypt_method:int = 0, nb_snapshots:int = 0):
+    """Write a qcow2 header (without any tables) that is good enough to be read by read_image_info()"""
+    header_length = 104 if version == 3 else 72
+
+    extensions = b""
+    if backing_format:
+        data = backing_format.encode()
+        extensions += struct.pack(">II", QCOW2_EXT_BACKING_FORMAT, len(data)) + data.ljust((len(data) + 7) & ~7, b"\0")
+    extensions += struct.pack(">II", 0, 0)
+
+    backing_file_offset = header_length + len(extensions) if backing_file else 0
+    backing_file_size = len(backing_file.encode()) if backing_file else 0
+
+    header = b"QFI\xfb" + struct.pack(">IQIIQIIQQIIQ",
+        version, backing_file_offset, backing_file_size, cluster_bits, size,
+        crypt_method, 0, 0, 0, 0, nb_snapshots, 0)
+    if version == 3:
+        header += struct.pack(">QQQII", incompatible_features, 0, 0, 4, header_length)
+
+    with open(path, "wb") as f:
+        f.write(header + extensions)
+        if backing_file:
+            f.write(backing_file.encode())
+        f.truncate(1 << cluster_bits)
+
+
+def read_iso(image:bytes) -> dict:
+    """Minimal ISO9660 reader, independent of iso9660.py. Returns the volume ID and the files
+    (name -> content) in the root directory of the primary and the Joliet volume descriptors."""
+    volumes = {}
+    sector = 16
+    while image[sector * SECTOR_SIZE] != 255:
+        descriptor = image[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+        assert descriptor[1:6] == b"CD001", f"No volume descriptor in sector {sector}"
+        joliet = descriptor[0] == 2 and descriptor[88:91] in (b"%/@", b"%/C", b"%/E")
+        sector += 1
+        if descriptor[0] != 1 and not joliet:
+            continue
+
+        encoding = "utf-16-be" if joliet else "ascii"
+        root_extent, = struct.unpack("<I", descriptor[158:162])
+        root_size, = struct.unpack("<I", descriptor[166:170])
+
+        files = {}
+        offset = root_extent * SECTOR_SIZE
+        while offset < root_extent * SECTOR_SIZE + root_size:
+            length = image[offset]
+            if length == 0:
+                # Records continue in the next sector
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            record = image[offset:offset + length]
+            extent, = struct.unpack("<I", record[2:6])
+            size, = struct.unpack("<I", record[10:14])
+            if not record[25] & 0x02:
+                name = record[33:33 + record[32]].decode(encoding)
+                files[name] = image[extent * SECTOR_SIZE:extent * SECTOR_SIZE + size]
+            offset += length
+
+        volumes["joliet" if joliet else "primary"] = {
+            "volume_id": descriptor[40:72].decode(encoding).rstrip(),
+            "files": files,
+        }
+    return volumes
+
+
+SEED_FILES = {
+    "user-data": b"#cloud-config\nchpasswd: {expire: false}\nssh_pwauth: false\n",
+    "meta-data": b'{"instance-id": "vm-a1b2c3d4", "local-hostname": "ip-10-0-0-5"}',
+    "network-config": b"version: 2\nethernets:\n  ens2:\n    dhcp4: true\n",
+}
+
+
+class TestBuildIso(SimpleTestCase):
+
+    def test_seed_image(self):
+        volumes = read_iso(build_iso(SEED_FILES, "cidata"))
+
+        self.assertEqual(volumes["joliet"]["volume_id"], "cidata")
+        self.assertEqual(volumes["primary"]["volume_id"], "cidata")
+        self.assertEqual(volumes["joliet"]["files"], SEED_FILES)
+        self.assertEqual(volumes["primary"]["files"], {
+            "USER_DAT.;1": SEED_FILES["user-data"],
+            "META_DAT.;1": SEED_FILES["meta-data"],
+            "NETWORK_.;1": SEED_FILES["network-config"],
+        })
+
+
+    def test_large_and_empty_files(self):
+        files = {"user-data": os.urandom(3 * SECTOR_SIZE + 1), "meta-data": b""}
+        image = build_iso(files, "cidata")
+        volumes = read_iso(image)
+
+        self.assertEqual(volumes["joliet"]["files"]["user-data"], files["user-data"])
+        self.assertEqual(volumes["joliet"]["files"]["meta-data"], b"")
+        self.assertEqual(len(image) % SECTOR_SIZE, 0)
+
+
+    def test_directory_larger_than_a_sector(self):
+        files = {f"file-with-a-long-name-{i:03d}.txt": str(i).encode() for i in range(40)}
+        # Unique 8.3 names
+        files = {f"F{i:03d}-{name}": data for i, (name, data) in enumerate(files.items())}
+        volumes = read_iso(build_iso(files, "cidata"))
+
+        self.assertEqual(len(volumes["joliet"]["files"]), 40)
+        self.assertEqual(volumes["joliet"]["files"]["F039-file-with-a-long-name-039.txt"], b"39")
+
+
+    def test_invalid(self):
+        with self.assertRaises(IsoCreationError):
+            build_iso({}, "cidata")
+        with self.assertRaises(IsoCreationError):
+            build_iso(SEED_FILES, "a-volume-id-that-is-too-long")
+        with self.assertRaises(IsoCreationError):
+            build_iso({"user-data-1": b"", "user-data-2": b""}, "cidata")
+
+
+@unittest.skipUnless(CLOUD_LOCALDS, "cloud-localds is not installed")
+class TestBuildIsoCompatibility(SimpleTestCase):
+    """Compares the seed image with the one cloud-localds creates. The images are not identical
+    byte for byte (genisoimage adds Rock Ridge records, padding and timestamps), but cloud-init
+    has to see the same label, file names and contents."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_seed_image(self):
+        paths = {}
+        for name, data in SEED_FILES.items():
+            paths[name] = os.path.join(self.dir, name)
+            with open(paths[name], "wb") as f:
+                f.write(data)
+
+        output = os.path.join(self.dir, "seed.iso")
+        self.assertTrue(CloudLocalds().create_image(
+            user_data_file=paths["user-data"],
+            output=output,
+            meta_data_file=paths["meta-data"],
+            network_config_file=paths["network-config"],
+        ))
+        with open(output, "rb") as f:
+            expected = read_iso(f.read())
+        volumes = read_iso(build_iso(SEED_FILES, "cidata"))
+
+        for volume in ["primary", "joliet"]:
+            self.assertEqual(volumes[volume]["volume_id"], expected[volume]["volume_id"])
+        # Linux and cloud-init ignore the version number of Joliet names
+        self.assertEqual(
+            {name.split(";")[0]: data for name, data in volumes["joliet"]["files"].items()},
+            {name.split(";")[0]: data for name, data in expected["joliet"]["files"].items()},
+        )
+        self.assertEqual(
+            sorted(volumes["primary"]["files"].values()),
+            sorted(expected["primary"]["files"].values()),
+        )
+
+
+class TestReadImageInfo(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name:str):
+        return os.path.join(self.dir, name)
+
+
+    def test_qcow2_v3(self):
+        write_qcow2(self.path("disk.qcow2"), 10 * 1024 ** 3)
+        details = read_image_info(self.path("disk.qcow2"))
+
+        self.assertEqual(details["format"], "qcow2")
+        self.assertEqual(details["virtual-size"], 10 * 1024 ** 3)
+        self.assertEqual(details["cluster-size"], 65536)
+        self.assertEqual(details["actual-size"], os.stat(self.path("disk.qcow2")).st_blocks * 512)
+        self.assertEqual(details["format-specific"]["data"]["compat"], "1.1")
+        self.assertEqual(details["format-specific"]["data"]["refcount-bits"], 16)
+        self.assertFalse(details["dirty-flag"])
+        self.assertNotIn("backing-filename", details)
+
+
+    def test_qcow2_v2(self):
+        write_qcow2(self.path("disk.qcow2"), 1024 ** 3, version=2, cluster_bits=12)
+        details = read_image_info(self.path("disk.qcow2"))
+
+        self.assertEqual(details["format"], "qcow2")
+        self.assertEqual(details["virtual-size"], 1024 ** 3)
+        self.assertEqual(details["cluster-size"], 4096)
+        self.assertEqual(details["format-specific"]["data"]["compat"], "0.10")
+
+
+    def test_qcow2_dirty(self):
+        write_qcow2(self.path("disk.qcow2"), 1024 ** 3, incompatible_features=QCOW2_INCOMPAT_DIRTY)
+        self.assertTrue(read_image_info(self.path("disk.qcow2"))["dirty-flag"])
+
+
+    def test_qcow2_backing_file(self):
+        write_qcow2(self.path("base.qcow2"), 1024 ** 3)
+        write_qcow2(self.path("overlay.qcow2"), 1024 ** 3, backing_file="base.qcow2", backing_format="qcow2")
+        details = read_image_info(self.path("overlay.qcow2"))
+
+        self.assertEqual(details["backing-filename"], "base.qcow2")
+        self.assertEqual(details["full-backing-filename"], self.path("base.qcow2"))
+        self.assertEqual(details["backing-filename-format"], "qcow2")
+
+
+    def test_qcow2_absolute_backing_file_without_format(self):
+        write_qcow2(self.path("overlay.qcow2"), 1024 ** 3, backing_file="/images/base.qcow2")
+        details = read_image_info(self.path("overlay.qcow2"))
+
+        self.assertEqual(details["full-backing-filename"], "/images/base.qcow2")
+        self.assertNotIn("backing-filename-format", details)
+
+
+    def test_backing_chain(self):
+        with open(self.path("base.raw"), "wb") as f:
+            f.truncate(1024 ** 2)
+        write_qcow2(self.path("middle.qcow2"), 1024 ** 2, backing_file="base.raw", backing_format="raw")
+        write_qcow2(self.path("top.qcow2"), 1024 ** 2, backing_file="middle.qcow2", backing_format="qcow2")
+        chain = read_image_info_chain(self.path("top.qcow2"))
+
+        self.assertEqual([d["format"] for d in chain], ["qcow2", "qcow2", "raw"])
+        self.assertEqual(chain[2]["filename"], self.path("base.raw"))
+
+
+    def test_backing_chain_loop(self):
+        write_qcow2(self.path("a.qcow2"), 1024 ** 2, backing_file="b.qcow2")
+        write_qcow2(self.path("b.qcow2"), 1024 ** 2, backing_file="a.qcow2")
+        with self.assertRaises(UnsupportedImage):
+            read_image_info_chain(self.path("a.qcow2"))
+
+
+    def test_unsupported_qcow2_features(self):
+        write_qcow2(self.path("encrypted.qcow2"), 1024 ** 3, crypt_method=1)
+        write_qcow2(self.path("snapshots.qcow2"), 1024 ** 3, nb_snapshots=1)
+        write_qcow2(self.path("data-file.qcow2"), 1024 ** 3, incompatible_features=1 << 2)
+        for name in ["encrypted.qcow2", "snapshots.qcow2", "data-file.qcow2"]:
+            with self.assertRaises(UnsupportedImage):
+                read_image_info(self.path(name))
+
+
+    def test_raw(self):
+        with open(self.path("disk.img"), "wb") as f:
+            f.write(b"\xeb\x63\x90" + b"\0" * 1000)
+        details = read_image_info(self.path("disk.img"))
+
+        self.assertEqual(details["format"], "raw")
+        # Rounded up to whole sectors
+        self.assertEqual(details["virtual-size"], 1024)
+        self.assertNotIn("cluster-size", details)
+
+
+    def test_other_formats(self):
+        with open(self.path("disk.vmdk"), "wb") as f:
+            f.write(b"KDMV" + b"\0" * 508)
+        with self.assertRaises(UnsupportedImage):
+            read_image_info(self.path("disk.vmdk"))
+
+
+    def test_info_without_cache(self):
+        write_qcow2(self.path("disk.qcow2"), 1024 ** 3)
+
+        with mock.patch.object(QemuImg, "info_cache", None), \
+                mock.patch.object(QemuImg, "command") as command:
+            details = QemuImg().info(self.path("disk.qcow2"))
+
+        command.assert_not_called()
+        self.assertEqual(details["format"], "qcow2")
+        self.assertEqual(details["virtual-size"], 1024 ** 3)
+
+
+@unittest.skipUnless(QEMU_IMG, "qemu-img is not installed")
+class TestReadImageInfoParity(SimpleTestCase):
+    """Compares the native reader with the output of qemu-img itself"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name:str):
+        return os.path.join(self.dir, name)
+
+    def qemu_img(self, *args):
+        return subprocess.run([QEMU_IMG, *args], check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    def assertParity(self, filename:str):
+        expected = json.loads(self.qemu_img("info", "--output", "json", filename))
+        details = read_image_info(filename)
+        for field in PARITY_FIELDS:
+            self.assertEqual(details.get(field), expected.get(field), f"{field} of {filename}")
+
+
+    def test_qcow2(self):
+        for compat in ["0.10", "1.1"]:
+            filename = self.path(f"disk-{compat}.qcow2")
+            self.qemu_img("create", "-f", "qcow2", "-o", f"compat={compat}", filename, "10G")
+            self.assertParity(filename)
+
+
+    def test_qcow2_cluster_size(self):
+        self.qemu_img("create", "-f", "qcow2", "-o", "cluster_size=2M", self.path("disk.qcow2"), "1G")
+        self.assertParity(self.path("disk.qcow2"))
+
+
+    def test_qcow2_backing_chain(self):
+        self.qemu_img("create", "-f", "raw", self.path("base.raw"), "1G")
+        self.qemu_img("create", "-f", "qcow2", "-b", "base.raw", "-F", "raw", self.path("middle.qcow2"))
+        self.qemu_img("create", "-f", "qcow2", "-b", self.path("middle.qcow2"), "-F", "qcow2", self.path("top.qcow2"), "2G")
+        for name in ["middle.qcow2", "top.qcow2"]:
+            self.assertParity(self.path(name))
+
+        expected = json.loads(self.qemu_img("info", "--backing-chain", "--output", "json", self.path("top.qcow2")))
+        chain = read_image_info_chain(self.path("top.qcow2"))
+        self.assertEqual(
+            [(d["format"], d["virtual-size"]) for d in chain],
+            [(d["format"], d["virtual-size"]) for d in expected],
+        )
+
+
+    def test_qcow2_with_data(self):
+        self.qemu_img("create", "-f", "raw", self.path("source.raw"), "64M")
+        with open(self.path("source.raw"), "r+b") as f:
+            f.write(os.urandom(4 * 1024 ** 2))
+        self.qemu_img("convert", "-O", "qcow2", self.path("source.raw"), self.path("disk.qcow2"))
+        self.assertParity(self.path("disk.qcow2"))
+
+
+    def test_raw(self):
+        self.qemu_img("create", "-f", "raw", self.path("disk.raw"), "1G")
+        self.assertParity(self.path("disk.raw"))
+
+        with open(self.path("odd.raw"), "wb") as f:
+            f.write(b"\1" * 1000)
+        self.assertParity(self.path("odd.raw"))
+
+
+class TestProgressParsers(SimpleTestCase):
+    """Progress of the tools, parsed from the output they print while running"""
+
+    def run_with_output(self, commander, run, lines:list) -> list:
+        process = mock.Mock(returncode=0)
+        # Universal newlines turns the carriage returns of the progress bars into newlines
+        process.stdout = iter(f"{line}\n" for line in lines)
+        progress = []
+        with mock.patch("commander.commander.subprocess.Popen", return_value=process) as popen:
+            self.assertTrue(run(commander, progress.append))
+        self.command = popen.call_args.args[0]
+        return progress
+
+
+    def test_qemu_img_convert(self):
+        # Printed by `qemu-img convert -p`
+        lines = [
+            "    (0.00/100%)",
+            "    (1.01/100%)",
+            "    (12.50/100%)",
+            "    (99.99/100%)",
+            "    (100.00/100%)",
+        ]
+        progress = self.run_with_output(QemuImg(), lambda qemu_img, progress: qemu_img.convert(
+            "disk.qcow2", "image.qcow2", "qcow2", progress), lines)
+
+        self.assertEqual(progress, [0.0, 1.01, 12.5, 99.99, 100.0])
+        self.assertEqual(self.command[1:], ["convert", "-O", "qcow2", "-p", "disk.qcow2", "image.qcow2"])
+
+
+    def test_virt_sparsify(self):
+        # Printed by `virt-sparsify --machine-readable`, the progress bar is "<position>/<total>"
+        lines = [
+            "[   0.0] Create overlay file in /tmp to protect source disk",
+            "[   0.0] Examine source disk",
+            "0/65536",
+            "16384/65536",
+            "65536/65536",
+            "[  12.4] Fill free space in /dev/sda1 with zero",
+            "0/0",
+            "[  20.1] Copy to destination and make sparse",
+            "32768/65536",
+            "Sparsify operation completed with no errors.",
+        ]
+        progress = self.run_with_output(VirtTools(), lambda virt_tools, progress: virt_tools.sparsify(
+            "disk.qcow2", "image.qcow2", "qcow2", progress=progress), lines)
+
+        self.assertEqual(progress, [0.0, 25.0, 100.0, 50.0])
+        self.assertIn("--machine-readable", self.command)
@@ -1,9 +1,14 @@
 import logging
 import json
+import re
+from typing import Callable
 from .commander import BaseCommander
 
 logger = logging.getLogger(__name__)
 
+# Progress bars are printed as "<position>/<total>" with --machine-readable
+PROGRESS_PATTERN = re.compile(r"^(\d+)/(\d+)$")
+
 class VirtTools(BaseCommander):
     """ Collection of virt tools"""
 
@@ -24,20 +29,49 @@ class VirtTools(BaseCommander):
             return False
     
 
-    def sparsify(self, file_name: str):
+    def sparsify(self, file_name: str, output_file_name: str = None, output_format: str = None,
+            compress: bool = False, progress: Callable[[float], None] = None):
         """Sparsify a virtual machine disk
 
         :param file_name: Source filename to convert or copy.
+        :param output_file_name: Write the sparsified disk to this file instead of
+            sparsifying the source in place. Backing files of the source are merged
+            into the output, defaults to None
+        :param output_format: Format of the output file, defaults to the format
+            of the source
+        :param compress: Compress the output file (qcow2 only), defaults to False
+        :param progress: Called with the percentage completed, defaults to None
 
         :returns: boolean if the operation was successful
         """
         
         self.base_command = '/usr/bin/virt-sparsify'
-        cmds = ['--in-place', file_name]
-        output, return_code = self.command(cmds)
+        if output_file_name:
+            cmds = [file_name, output_file_name]
+            if output_format:
+                cmds = ['--convert', output_format] + cmds
+            if compress:
+                cmds = ['--compress'] + cmds
+        else:
+            cmds = ['--in-place', file_name]
+
+        on_output = None
+        if progress:
+            cmds = ['--machine-readable'] + cmds
+            on_output = self._progress_parser(progress)
+
+        output, return_code = self.command(cmds, on_output=on_output)
         if return_code == 0:
             return True
         else:
             return False
-    
+
+
+    def _progress_parser(self, progress: Callable[[float], None]):
+        def parse(line: str):
+            if match := PROGRESS_PATTERN.match(line.strip()):
+                position, total = int(match.group(1)), int(match.group(2))
+                if total > 0:
+                    progress(position * 100 / total)
+        return parse
 
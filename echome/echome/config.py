@@ -44,6 +44,58 @@ class AppConfig:
 
         guest_images_dir = None
         user_dir = None
+
+        # Content-addressed store for image files. Defaults to a directory
+        # in guest_images_dir.
+        image_store_dir = None
+
+        # 'copy' makes a full copy of the image for every new virtual machine,
+        # 'linked' creates a thin qcow2 overlay backed by the read-only image.
+        disk_provisioning = "copy"
+
+        # Number of ready boot disks to keep per image and disk size
+        disk_pool_depth = 0
+
+        # How virtual machines are placed on the hosts: 'spread' or 'binpack'
+        placement_strategy = "spread"
+
+        # Seconds between samples of the resources of the hosts
+        host_sample_interval = 60
+        # Virtual CPUs that can be allocated per host CPU thread
+        cpu_allocation_ratio = 1.0
+        # Memory of each host that is not allocated to virtual machines
+        reserved_host_memory_mb = 1024
+        # Host cores (comma separated) kept for the host: not allocated, never picked for the
+        # vCPUs of pinned instance types and left out of the cores unpinned ones float on
+        reserved_host_cpus = "0"
+
+        # Seconds a virtual machine gets to shut down before it's destroyed
+        shutdown_timeout = 240
+
+        # Virtual machines started or stopped at the same time by a bulk power action
+        bulk_action_concurrency = 16
+        # Virtual machines started at the same time on one host by a bulk power action,
+        # and the seconds each start waits for the guest to boot before the next one
+        host_start_concurrency = 4
+        host_start_delay = 5
+
+        # Seconds between heartbeats of the domain event listener. The states it
+        # caches are used while its last heartbeat is at most 3 intervals old.
+        domain_event_heartbeat = 10
+        # Seconds between full reads of the domain states by the listener
+        domain_event_reconcile_interval = 300
+
+        # How virtual machines get their cloud-init seed: 'iso' for a seed image, or
+        # 'nocloud-net' from the metadata service (through the SMBIOS serial). Falls back
+        # to 'iso' if metadata_api_url is not set or the VM has a static network config.
+        cloudinit_datasource = "iso"
+
+        # Compress images captured from virtual machines
+        compress_images = False
+
+        # Share cached `qemu-img info` results between the API server and the
+        # workers through the "shared" Django cache.
+        image_info_shared_cache = False
     
     class EcHome(__base_section):
         ini_section = "echome"
@@ -0,0 +1,85 @@
+import logging
+import math
+import threading
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+# Number of observations that are kept per histogram
+MAX_OBSERVATIONS = 1000
+
+
+class MetricsRegistry:
+    """Simple in-process registry of counters and histograms. Metrics are identified by
+    their name and an optional set of labels, e.g.:
+
+        metrics.increment("image_copy_total", mechanism="reflink")
+        metrics.observe("image_copy_seconds", 0.02, mechanism="reflink")
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = defaultdict(lambda: deque(maxlen=MAX_OBSERVATIONS))
+
+
+    def increment(self, name:str, value:float = 1, **labels):
+        """Increment a counter by value."""
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+
+    def observe(self, name:str, value:float, **labels):
+        """Add an observation (e.g. a duration) to a histogram."""
+        with self._lock:
+            self._histograms[self._key(name, labels)].append(value)
+
+
+    def get_counter(self, name:str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+
+    def snapshot(self) -> dict:
+        """Return a copy of all of the counters and a summary of all of the histograms."""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ]
+            histograms = [
+                {"name": name, "labels": dict(labels), **summarize(list(values))}
+                for (name, labels), values in self._histograms.items()
+            ]
+
+        return {
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+
+    def _key(self, name:str, labels:dict):
+        return name, tuple(sorted(labels.items()))
+
+
+def percentile(values:list, pct:float) -> float:
+    """Return the nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def summarize(values:list) -> dict:
+    """Summarize a list of observations with the count, sum and common percentiles."""
+    return {
+        "count": len(values),
+        "sum": sum(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values) if values else None,
+    }
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='placement_strategy',
+            field=models.CharField(max_length=20, null=True),
+        ),
+    ]
@@ -17,6 +17,9 @@ class Account(models.Model):
     created = models.DateTimeField(auto_now_add=True, null=False)
     secret = models.TextField(null=True)
     tags = models.JSONField(default=dict)
+    # How virtual machines of this account are placed on the hosts
+    # ('spread' or 'binpack'). Uses the server default if not set.
+    placement_strategy = models.CharField(max_length=20, null=True)
 
 
     def __str__(self) -> str:
@@ -1,6 +1,7 @@
 import logging
 import ipaddress
 from identity.models import User
+from vmmanager.interface_profiles import INTERFACE_PROFILES, HOST_OFFLOADS, GUEST_OFFLOADS
 from .models import VirtualNetwork
 from .exceptions import InvalidNetworkConfiguration, InvalidNetworkName, InvalidNetworkType
 
@@ -54,6 +55,24 @@ class VirtualNetworkManager:
         return ip_object
     
 
+    def expand_ip_range(self, ip_range:str, max_count:int = None) -> list:
+        """Returns all of the IP addresses in a range like 10.0.0.10-10.0.0.19 (inclusive). Raises
+        ValueError if the range is invalid or has more than max_count addresses."""
+        try:
+            first, last = [ipaddress.ip_address(ip.strip()) for ip in ip_range.split("-")]
+        except ValueError:
+            raise ValueError(f"Provided IP range is not valid: {ip_range}")
+
+        if first.version != last.version or first > last:
+            raise ValueError(f"Provided IP range is not valid: {ip_range}")
+
+        count = int(last) - int(first) + 1
+        if max_count and count > max_count:
+            raise ValueError(f"Provided IP range has more than {max_count} addresses: {ip_range}")
+
+        return [str(ipaddress.ip_address(int(first) + i)) for i in range(count)]
+
+
     def validate_network(self, network:str, prefix:str, gateway:str, dns_servers:list) -> bool:
         """Validates aspects of the network including IP addresses."""
         logger.debug("Validating provided network information..")
@@ -79,7 +98,8 @@ class VirtualNetworkManager:
     # Tags: {"Environment": "Home"}
     def create_bridge_to_lan_network(self, name:str, user:User, type:VirtualNetwork.Type,
             network:str, prefix:str, gateway:str, dns_servers:list,
-            bridge:str = None, tags:list = None):
+            bridge:str = None, tags:list = None, interface_profile:str = None, mtu:int = None,
+            disabled_offloads:list = None):
         logger.debug("Creating new network")
 
         vnet = VirtualNetwork()
@@ -95,7 +115,9 @@ class VirtualNetworkManager:
         if not self.validate_network(network, prefix, gateway, dns_servers):
             raise InvalidNetworkConfiguration("Cannot verify network configuration with provided information. Is the IP address space correct?")
 
-        logger.debug(f"Creating new virtual network with Id: {self.network_id}")
+        self.validate_interface_options(interface_profile, mtu, disabled_offloads)
+
+        logger.debug(f"Creating new virtual network with Id: {vnet.network_id}")
         
         config = {
             "network": network,
@@ -104,6 +126,13 @@ class VirtualNetworkManager:
             "dns_servers": dns_servers,
             "bridge_interface": bridge,
         }
+        # Interface options of the virtual machines on the network, see vmmanager/interface_profiles.py
+        if interface_profile:
+            config["interface_profile"] = interface_profile
+        if mtu:
+            config["mtu"] = mtu
+        if disabled_offloads:
+            config["disabled_offloads"] = disabled_offloads
 
         vnet.account = user.account
         vnet.name = name
@@ -115,5 +144,23 @@ class VirtualNetworkManager:
         return vnet.network_id
 
 
+    def validate_interface_options(self, interface_profile:str = None, mtu:int = None, disabled_offloads:list = None):
+        """Checks the options of the network interfaces of the virtual machines on a network
+
+        Raises:
+            InvalidNetworkConfiguration: If an option is invalid.
+        """
+        if interface_profile and interface_profile not in INTERFACE_PROFILES:
+            raise InvalidNetworkConfiguration(f"Interface profile does not exist. Valid profiles: {', '.join(INTERFACE_PROFILES)}")
+
+        if mtu is not None and not 68 <= mtu <= 65535:
+            raise InvalidNetworkConfiguration("MTU must be between 68 and 65535.")
+
+        offloads = set(HOST_OFFLOADS) | set(GUEST_OFFLOADS)
+        for offload in disabled_offloads or []:
+            if offload not in offloads:
+                raise InvalidNetworkConfiguration(f"Unknown offload: {offload}. Valid offloads: {', '.join(sorted(offloads))}")
+
+
     def create_nat_network(self):
         pass
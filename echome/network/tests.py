@@ -1,3 +1,41 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from .manager import VirtualNetworkManager
 
 # Create your tests here.
+class TestExpandIpRange(SimpleTestCase):
+
+    def setUp(self):
+        self.manager = VirtualNetworkManager()
+
+
+    def test_range(self):
+        self.assertEqual(
+            self.manager.expand_ip_range("10.0.0.254-10.0.1.1"),
+            ["10.0.0.254", "10.0.0.255", "10.0.1.0", "10.0.1.1"],
+        )
+        self.assertEqual(self.manager.expand_ip_range(" 10.0.0.10 - 10.0.0.10 "), ["10.0.0.10"])
+        self.assertEqual(self.manager.expand_ip_range("fd00::1-fd00::3"), ["fd00::1", "fd00::2", "fd00::3"])
+
+
+    def test_invalid_ranges(self):
+        for ip_range in [
+            "10.0.0.10",
+            "10.0.0.10-",
+            "10.0.0.10-10.0.0.20-10.0.0.30",
+            "10.0.0.10-10.0.0.300",
+            "10.0.0.10-fd00::1",
+            "hosts",
+        ]:
+            with self.subTest(ip_range=ip_range), self.assertRaises(ValueError):
+                self.manager.expand_ip_range(ip_range)
+
+
+    def test_reversed_range(self):
+        with self.assertRaises(ValueError):
+            self.manager.expand_ip_range("10.0.0.20-10.0.0.10")
+
+
+    def test_max_count(self):
+        self.assertEqual(len(self.manager.expand_ip_range("10.0.0.1-10.0.0.20", max_count=20)), 20)
+        with self.assertRaises(ValueError):
+            self.manager.expand_ip_range("10.0.0.1-10.0.0.21", max_count=20)
@@ -4,6 +4,7 @@ from rest_framework.views import APIView
 from rest_framework import viewsets, status
 from api.api_view import HelperView
 from .models import VirtualNetwork
+from .manager import VirtualNetworkManager
 from .exceptions import InvalidNetworkConfiguration, InvalidNetworkName
 from .serializers import NetworkSerializer
 
@@ -36,8 +37,14 @@ class CreateNetwork(HelperView, APIView):
 
         tags = self.unpack_tags(request)
 
+        if "Mtu" in request.POST and not request.POST["Mtu"].isdigit():
+            return self.error_response(
+                message="Provided Mtu is not a number.",
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
         try:
-            new_network_id = VirtualNetwork().create(
+            new_network_id = VirtualNetworkManager().create_bridge_to_lan_network(
                 name=request.POST["Name"],
                 user=request.user,
                 type=type,
@@ -47,6 +54,10 @@ class CreateNetwork(HelperView, APIView):
                 dns_servers=self.unpack_comma_separated_list("DnsServers", request.POST),
                 bridge=request.POST["Bridge"],
                 tags=tags,
+                interface_profile=request.POST["InterfaceProfile"] if "InterfaceProfile" in request.POST else None,
+                mtu=int(request.POST["Mtu"]) if "Mtu" in request.POST else None,
+                disabled_offloads=[offload.strip() for offload in self.unpack_comma_separated_list("DisabledOffloads", request.POST)] \
+                    if "DisabledOffloads" in request.POST else None,
             )
         except InvalidNetworkName as e:
             return self.error_response(
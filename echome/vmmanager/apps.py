@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class VmManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vmmanager'
+
+    def ready(self):
+        from commander.qemuimg import QemuImg
+        from .image_info_cache import ImageInfoCache
+
+        QemuImg.info_cache = ImageInfoCache()
@@ -8,7 +8,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from dataclasses import dataclass
 from echome.config import ecHomeConfig
-from commander.cloudlocalds import CloudLocalds
+from commander.iso9660 import write_iso, IsoCreationError
 from commander.cloudinit import CloudInit as CloudInitCommand
 from network.models import VirtualNetwork
 
@@ -25,10 +25,13 @@ KNOWN_CONTENT_TYPES = [
     'text/cloud-boothook',
 ]
 
-NETWORK_CONFIG_FILE_NAME = "network.yaml"
+NETWORK_CONFIG_FILE_NAME = "network-config"
 USERDATA_CONFIG_FILE_NAME = "user-data"
 METADATA_CONFIG_FILE_NAME = "meta-data"
 
+# Volume label cloud-init looks for to find a NoCloud seed image
+SEED_VOLUME_ID = "cidata"
+
 @dataclass
 class CloudInitFile():
     path: str
@@ -118,7 +121,6 @@ class CloudInit:
 
         contents = yaml.dump(network_config, default_flow_style=False, indent=2, sort_keys=False)
         self.network_config = contents
-        self._write_file(NETWORK_CONFIG_FILE_NAME, contents)
         return contents
     
 
@@ -198,11 +200,9 @@ class CloudInit:
                 combined_message.attach(msg)
             logger.debug(combined_message)
             self.userdata_config = str(combined_message)
-            self._write_file(USERDATA_CONFIG_FILE_NAME, str(combined_message))
             return str(combined_message)
 
         self.userdata_config = yaml_config
-        self._write_file(USERDATA_CONFIG_FILE_NAME, yaml_config)
         return yaml_config
     
 
@@ -219,7 +219,6 @@ class CloudInit:
 
         contents = json.dumps(md, indent=4)
         self.metadata = contents
-        self._write_file(METADATA_CONFIG_FILE_NAME, contents)
         return contents
     
 
@@ -227,8 +226,9 @@ class CloudInit:
             cloudinit_metadata_file_path:str = None) -> str:
         """Create the Cloudinit ISO to be mounted to the virtual machine.
 
-        If no arguments are supplied, the function will use the files that were created from
-        calling the other generate methods.
+        If no arguments are supplied, the function will use the configs that were created from
+        calling the other generate methods. The ISO (a NoCloud seed image with the `cidata`
+        label) is built in-process from those, without writing them to separate files first.
 
         Args:
             userdata_yaml_file_path (str, optional): Complete file path to the yaml cloudinit file. Defaults to None.
@@ -236,32 +236,32 @@ class CloudInit:
             cloudinit_metadata_file_path (str, optional): Complete file path to the metadata cloudinit file. Defaults to None.
 
         Raises:
-            CloudInitFailedValidation: If CloudInit could fails validation of the schema.
+            CloudInitError: If there is no user-data or base directory to create the image with.
             CloudInitIsoCreationError: If CloudInit was not able to create the image.
 
         Returns:
             str: A complete file path to the location of the ISO file.
         """
-
-        if userdata_yaml_file_path:
-            userdata_file = userdata_yaml_file_path
-        else:
-            userdata_file = f"{self.base_dir}/{USERDATA_CONFIG_FILE_NAME}"
-        
-        if cloudinit_network_yaml_file_path:
-            network_file = cloudinit_network_yaml_file_path
-        elif self.network_config:
-            network_file = f"{self.base_dir}/{NETWORK_CONFIG_FILE_NAME}"
-        else:
-            network_file = None
-        
-        if cloudinit_metadata_file_path:
-            metadata_file = cloudinit_metadata_file_path
-        elif self.metadata:
-            metadata_file = f"{self.base_dir}/{METADATA_CONFIG_FILE_NAME}"
-        else:
-            metadata_file = None
+        if self.base_dir is None or self.base_dir == "":
+            raise CloudInitError("Base directory was empty. Cannot create Cloudinit image!")
+
+        try:
+            userdata = self._read_file(userdata_yaml_file_path) if userdata_yaml_file_path else self.userdata_config
+            network_config = self._read_file(cloudinit_network_yaml_file_path) if cloudinit_network_yaml_file_path else self.network_config
+            metadata = self._read_file(cloudinit_metadata_file_path) if cloudinit_metadata_file_path else self.metadata
+        except OSError as e:
+            logger.exception(e)
+            raise CloudInitIsoCreationError
         
+        if userdata is None:
+            raise CloudInitError("No user-data was generated. Cannot create Cloudinit image!")
+
+        files = {USERDATA_CONFIG_FILE_NAME: userdata.encode("utf-8")}
+        # NoCloud requires meta-data, even if it's empty
+        files[METADATA_CONFIG_FILE_NAME] = metadata.encode("utf-8") if metadata else b""
+        if network_config:
+            files[NETWORK_CONFIG_FILE_NAME] = network_config.encode("utf-8")
+
         # Validate the yaml file
         
         # logger.debug("Validating Cloudinit config yaml.")        
@@ -273,29 +273,19 @@ class CloudInit:
         # onto the VMs
         cloudinit_iso_path = f"{self.base_dir}/cloudinit.iso"
 
-        create_image_success = CloudLocalds().create_image(
-            user_data_file=userdata_file,
-            output=cloudinit_iso_path,
-            meta_data_file=metadata_file,
-            network_config_file=network_file
-        )
-
-        if not create_image_success:
-            logger.exception("Was not able to create the cloud-init image!")
+        try:
+            write_iso(cloudinit_iso_path, files, SEED_VOLUME_ID)
+        except (IsoCreationError, OSError) as e:
+            logger.exception(f"Was not able to create the cloud-init image: {e}")
             raise CloudInitIsoCreationError
 
         logger.debug(f"Created cloudinit iso: {cloudinit_iso_path}")
         return cloudinit_iso_path
     
 
-    def _write_file(self, file_name:str, contents:str):
-        if self.base_dir is None or self.base_dir == "":
-            raise CloudInitError("Base directory was empty. Cannot write Cloudinit files!")
-        
-        complete_path = f"{self.base_dir}/{file_name}"
-        with open(complete_path, "w") as filehandle:
-            logger.debug(f"Writing contents to file: {complete_path}")
-            filehandle.write(contents)
+    def _read_file(self, path:str) -> str:
+        with open(path, "r") as filehandle:
+            return filehandle.read()
     
 
     def _generate_hostname(self, vm_id:str, ip_address:str = None, prefix:str = "ip"):
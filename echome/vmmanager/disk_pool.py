@@ -0,0 +1,173 @@
+import logging
+import os
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from django.db import transaction
+from django.utils import timezone
+from echome.config import ecHomeConfig
+from commander.qemuimg import QemuImg
+from .image_manager import ImageManager
+from .models import Image, DiskPool, PooledDisk
+from .exceptions import ImageCopyError
+
+logger = logging.getLogger(__name__)
+
+VM_ROOT_DIR = ecHomeConfig.VirtualMachines().user_dir
+
+# Pools are created automatically for every image/disk size that gets launched
+# with this depth. 0 disables automatic pools, pools can still be configured
+# manually with the `configurediskpool` management command.
+DEFAULT_POOL_DEPTH = int(ecHomeConfig.VirtualMachines().disk_pool_depth)
+
+# Disks that are still being provisioned after this long are considered abandoned
+# (e.g. the worker was killed) and their slot in the pool is freed.
+PROVISION_TIMEOUT = timedelta(hours=1)
+
+
+class DiskPoolManager:
+    """Maintains a pool of ready-to-use boot disks per (image, disk size) so that launching a
+    virtual machine only has to claim and rename a disk instead of copying and resizing one."""
+
+    def configure_pool(self, image:Image, disk_size:str, depth:int) -> DiskPool:
+        """Create or update the pool for an image and disk size. Setting the depth to 0 empties the pool."""
+        pool, _ = DiskPool.objects.update_or_create(
+            image=image,
+            disk_size=disk_size,
+            defaults={"depth": depth}
+        )
+        self._trim_pool(pool)
+        return pool
+
+
+    def claim(self, image:Image, disk_size:str, destination_dir:Path, file_name:str) -> PooledDisk:
+        """Claim a ready disk for the image and disk size and move it to the destination directory.
+        Returns the claimed PooledDisk (with its path set to the new location) or None if the pool
+        is empty or does not exist."""
+        with transaction.atomic():
+            disk = PooledDisk.objects.select_for_update(skip_locked=True) \
+                .filter(pool__image=image, pool__disk_size=disk_size, ready=True) \
+                .order_by("created") \
+                .first()
+
+            if disk:
+                destination = destination_dir.absolute() / f"{file_name}{Path(disk.path).suffix}"
+                logger.debug(f"Claiming pooled disk {disk.path} as {destination}")
+                os.rename(disk.path, destination)
+                disk.delete()
+                disk.path = str(destination)
+
+        if disk is None and DEFAULT_POOL_DEPTH > 0:
+            DiskPool.objects.get_or_create(image=image, disk_size=disk_size, defaults={"depth": DEFAULT_POOL_DEPTH})
+
+        self._request_refill(image, disk_size)
+        return disk
+
+
+    def refill(self, image:Image, disk_size:str):
+        """Provision disks until the pool for the image and disk size is at its configured depth.
+
+        A slot in the pool is reserved (a PooledDisk that is not ready) while the pool row is
+        locked, so concurrent refills do not overfill it. The disk is provisioned outside of the
+        transaction, which can take minutes for a full copy."""
+        if not image.is_ready_for_use:
+            logger.debug(f"Image {image.image_id} is not available, not refilling its disk pools.")
+            return
+
+        linked = ecHomeConfig.VirtualMachines().disk_provisioning == "linked"
+        pool_dir = self._pool_dir(image)
+        pool_dir.mkdir(parents=True, exist_ok=True)
+        self._discard_abandoned(image, disk_size)
+
+        while True:
+            file_name = f"pool-{uuid.uuid4().hex[:12]}"
+            with transaction.atomic():
+                try:
+                    pool = DiskPool.objects.select_for_update().get(image=image, disk_size=disk_size)
+                except DiskPool.DoesNotExist:
+                    return
+
+                if pool.disks.count() >= pool.depth:
+                    return
+
+                reserved = PooledDisk.objects.create(
+                    pool=pool,
+                    path=str(pool_dir / file_name),
+                    backing_file=os.path.abspath(image.image_path) if linked else None,
+                    ready=False,
+                )
+
+            try:
+                path = ImageManager().provision_disk(image, pool_dir, file_name, disk_size, linked)
+                details = QemuImg().info(str(path))
+            except ImageCopyError as e:
+                logger.error(f"Could not provision disk for pool {pool}: {e}")
+                self._remove_files(pool_dir, file_name)
+                reserved.delete()
+                return
+            except Exception:
+                self._remove_files(pool_dir, file_name)
+                reserved.delete()
+                raise
+
+            updated = PooledDisk.objects.filter(pk=reserved.pk, ready=False).update(
+                path=str(path),
+                size=details["virtual-size"] if details else None,
+                format=details["format"] if details else None,
+                ready=True,
+            )
+            if not updated:
+                # Discarded while it was provisioned, e.g. the image was registered again
+                logger.debug(f"Disk {path} was discarded from pool {pool} while it was provisioned")
+                self._remove_files(pool_dir, file_name)
+                return
+            logger.debug(f"Added disk {path} to pool {pool}")
+
+
+    def _discard_abandoned(self, image:Image, disk_size:str):
+        abandoned = PooledDisk.objects.filter(
+            pool__image=image,
+            pool__disk_size=disk_size,
+            ready=False,
+            created__lt=timezone.now() - PROVISION_TIMEOUT,
+        )
+        for disk in abandoned:
+            logger.warning(f"Discarding abandoned pooled disk: {disk.path}")
+            path = Path(disk.path)
+            self._remove_files(path.parent, path.name)
+            disk.delete()
+
+
+    @staticmethod
+    def _remove_files(directory:Path, file_name:str):
+        """Remove the (partially) provisioned disk with the file name, whatever its extension"""
+        for path in directory.glob(f"{file_name}.*"):
+            path.unlink(missing_ok=True)
+
+
+    def _trim_pool(self, pool:DiskPool):
+        excess = pool.disks.count() - pool.depth
+        if excess > 0:
+            for disk in pool.disks.filter(ready=True).order_by("-created")[:excess]:
+                disk.discard()
+        else:
+            self._request_refill(pool.image, pool.disk_size)
+
+
+    def _request_refill(self, image:Image, disk_size:str):
+        """Queue a refill if the pool is below its depth and no refill is provisioning a disk for
+        it already (that one keeps going until the pool is full)"""
+        # Imported here as the tasks module depends on the VmManager which uses this module
+        from .tasks import task_refill_disk_pool
+
+        pool = DiskPool.objects.filter(image=image, disk_size=disk_size).first()
+        if pool is None or pool.disks.count() >= pool.depth:
+            return
+        in_flight = pool.disks.filter(ready=False, created__gte=timezone.now() - PROVISION_TIMEOUT)
+        if in_flight.exists():
+            return
+        task_refill_disk_pool.delay(image.image_id, disk_size)
+
+
+    def _pool_dir(self, image:Image) -> Path:
+        return Path(f"{VM_ROOT_DIR}/disk_pool/{image.image_id}")
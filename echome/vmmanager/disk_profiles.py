@@ -0,0 +1,65 @@
+import logging
+from dataclasses import dataclass
+from .profiles import select_profile
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DiskProfile():
+    """How a disk is attached to a virtual machine and how qemu does its I/O"""
+    name: str
+    # 'ide' (emulated), 'virtio' (virtio-blk) or 'scsi' (on a virtio-scsi controller)
+    bus: str = "virtio"
+    cache: str = None
+    # 'native' or 'io_uring' (libvirt 6.3+ and qemu 5.0+)
+    io: str = None
+    discard: str = None
+    detect_zeroes: str = None
+    # One queue per vCPU
+    multiqueue: bool = False
+    # Run the I/O of the disk in an iothread of its own instead of the main qemu loop
+    iothread: bool = False
+
+
+DISK_PROFILES = {
+    # Emulated IDE disks, for guests without virtio drivers
+    "legacy": DiskProfile(
+        name="legacy",
+        bus="ide",
+    ),
+    "balanced": DiskProfile(
+        name="balanced",
+        bus="virtio",
+        cache="none",
+        io="native",
+        discard="unmap",
+        detect_zeroes="unmap",
+        multiqueue=True,
+    ),
+    "performance": DiskProfile(
+        name="performance",
+        bus="virtio",
+        cache="none",
+        io="io_uring",
+        discard="unmap",
+        detect_zeroes="unmap",
+        multiqueue=True,
+        iothread=True,
+    ),
+    "scsi": DiskProfile(
+        name="scsi",
+        bus="scsi",
+        cache="none",
+        io="native",
+        discard="unmap",
+        detect_zeroes="unmap",
+        multiqueue=True,
+        iothread=True,
+    ),
+}
+
+
+def get_disk_profile(name:str = None, default:str = "balanced", operating_system:str = None) -> DiskProfile:
+    """The disk profile with the given name, or the one to use without a name (see select_profile())"""
+    return select_profile(DISK_PROFILES, name, default, operating_system)
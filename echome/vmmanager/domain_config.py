@@ -0,0 +1,158 @@
+import xmltodict
+import logging
+from typing import List
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# Memory units of the domain XML, in KiB
+MEMORY_UNITS = {
+    "b": 1 / 1024, "bytes": 1 / 1024,
+    "kb": 1000 / 1024, "k": 1, "kib": 1,
+    "mb": 1000 ** 2 / 1024, "m": 1024, "mib": 1024,
+    "gb": 1000 ** 3 / 1024, "g": 1024 ** 2, "gib": 1024 ** 2,
+    "tb": 1000 ** 4 / 1024, "t": 1024 ** 3, "tib": 1024 ** 3,
+}
+
+
+@dataclass
+class DomainDisk():
+    target_dev: str
+    bus: str = None
+    device: str = "disk"
+    # File, block device or network volume backing the disk
+    source: str = None
+    format: str = None
+    alias: str = None
+    read_only: bool = False
+
+
+@dataclass
+class DomainInterface():
+    type: str
+    # Bridge or network the interface is connected to
+    source: str = None
+    mac: str = None
+    model: str = None
+    # Device on the host, e.g. vnet0 (running domains only)
+    target_dev: str = None
+
+
+@dataclass
+class DomainGraphics():
+    type: str
+    # Port assigned to the display (running domains only if autoport is set)
+    port: int = None
+    autoport: bool = False
+    listen: str = None
+
+
+@dataclass
+class DomainConfig():
+    """Typed view of the parts of a libvirt domain XML ecHome uses. Create it with from_xml()."""
+    name: str
+    uuid: str = None
+    vcpu: int = None
+    memory_kb: int = None
+    current_memory_kb: int = None
+    disks: List[DomainDisk] = field(default_factory=lambda: [])
+    interfaces: List[DomainInterface] = field(default_factory=lambda: [])
+    graphics: List[DomainGraphics] = field(default_factory=lambda: [])
+
+
+    def disk(self, target_dev:str) -> DomainDisk:
+        """The disk with the given target dev (e.g. vda), or None"""
+        for disk in self.disks:
+            if disk.target_dev == target_dev:
+                return disk
+        return None
+
+
+    def disk_by_source(self, source:str) -> DomainDisk:
+        """The disk backed by the given file (or block device), or None"""
+        for disk in self.disks:
+            if disk.source == source:
+                return disk
+        return None
+
+
+    @classmethod
+    def from_xml(cls, xml:str) -> "DomainConfig":
+        domain = xmltodict.parse(xml)["domain"]
+        devices = domain.get("devices") or {}
+
+        return cls(
+            name=domain.get("name"),
+            uuid=domain.get("uuid"),
+            vcpu=_int(_text(domain.get("vcpu"))),
+            memory_kb=_memory_kb(domain.get("memory")),
+            current_memory_kb=_memory_kb(domain.get("currentMemory")),
+            disks=[_parse_disk(disk) for disk in _list(devices.get("disk")) if _attr(disk, "target", "@dev")],
+            interfaces=[_parse_interface(interface) for interface in _list(devices.get("interface"))],
+            graphics=[_parse_graphics(graphics) for graphics in _list(devices.get("graphics"))],
+        )
+
+
+def _parse_disk(disk:dict) -> DomainDisk:
+    source = disk.get("source") or {}
+    return DomainDisk(
+        target_dev=_attr(disk, "target", "@dev"),
+        bus=_attr(disk, "target", "@bus"),
+        device=disk.get("@device", "disk"),
+        source=source.get("@file") or source.get("@dev") or source.get("@name"),
+        format=_attr(disk, "driver", "@type"),
+        alias=_attr(disk, "alias", "@name"),
+        read_only="readonly" in disk,
+    )
+
+
+def _parse_interface(interface:dict) -> DomainInterface:
+    source = interface.get("source") or {}
+    return DomainInterface(
+        type=interface.get("@type"),
+        source=source.get("@bridge") or source.get("@network") or source.get("@dev"),
+        mac=_attr(interface, "mac", "@address"),
+        model=_attr(interface, "model", "@type"),
+        target_dev=_attr(interface, "target", "@dev"),
+    )
+
+
+def _parse_graphics(graphics:dict) -> DomainGraphics:
+    port = _int(graphics.get("@port"))
+    return DomainGraphics(
+        type=graphics.get("@type"),
+        # -1 until a port is assigned
+        port=port if port is not None and port > 0 else None,
+        autoport=graphics.get("@autoport") == "yes",
+        listen=graphics.get("@listen"),
+    )
+
+
+def _list(value) -> list:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _attr(element:dict, child:str, name:str):
+    value = element.get(child)
+    return value.get(name) if isinstance(value, dict) else None
+
+
+def _text(value):
+    return value.get("#text") if isinstance(value, dict) else value
+
+
+def _int(value) -> int:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _memory_kb(value) -> int:
+    amount = _int(_text(value))
+    if amount is None:
+        return None
+    unit = value.get("@unit", "KiB") if isinstance(value, dict) else "KiB"
+    return int(amount * MEMORY_UNITS.get(unit.lower(), 1))
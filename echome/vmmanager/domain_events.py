@@ -0,0 +1,433 @@
+import libvirt
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, List
+from django.db import close_old_connections
+from django.utils import timezone
+from echome.config import ecHomeConfig
+from echome.metrics import metrics
+from .models import DomainEvent, HostMachine, VirtualMachine
+from .vm_instance import DOMAIN_STATES, get_domain_states
+
+logger = logging.getLogger(__name__)
+
+# Seconds between heartbeats of the listener (and reconnects to hosts it lost)
+HEARTBEAT_INTERVAL = int(ecHomeConfig.VirtualMachines().domain_event_heartbeat)
+# Seconds between full reads of the domain states, in case an event was missed
+RECONCILE_INTERVAL = int(ecHomeConfig.VirtualMachines().domain_event_reconcile_interval)
+# Cached states are used while the listener of the host sent a heartbeat within this time
+HEARTBEAT_TIMEOUT = timedelta(seconds=HEARTBEAT_INTERVAL * 3)
+
+LIFECYCLE_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED: "defined",
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED: "undefined",
+    libvirt.VIR_DOMAIN_EVENT_STARTED: "started",
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: "suspended",
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: "resumed",
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: "stopped",
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: "shutdown",
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: "pm_suspended",
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: "crashed",
+}
+
+LIFECYCLE_DETAILS = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED: {
+        libvirt.VIR_DOMAIN_EVENT_DEFINED_ADDED: "added",
+        libvirt.VIR_DOMAIN_EVENT_DEFINED_UPDATED: "updated",
+    },
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED: {
+        libvirt.VIR_DOMAIN_EVENT_UNDEFINED_REMOVED: "removed",
+    },
+    libvirt.VIR_DOMAIN_EVENT_STARTED: {
+        libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED: "booted",
+        libvirt.VIR_DOMAIN_EVENT_STARTED_MIGRATED: "migrated",
+        libvirt.VIR_DOMAIN_EVENT_STARTED_RESTORED: "restored",
+        libvirt.VIR_DOMAIN_EVENT_STARTED_FROM_SNAPSHOT: "from_snapshot",
+        libvirt.VIR_DOMAIN_EVENT_STARTED_WAKEUP: "wakeup",
+    },
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: {
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_PAUSED: "paused",
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_MIGRATED: "migrated",
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_IOERROR: "io_error",
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_WATCHDOG: "watchdog",
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_RESTORED: "restored",
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_FROM_SNAPSHOT: "from_snapshot",
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED_API_ERROR: "api_error",
+    },
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: {
+        libvirt.VIR_DOMAIN_EVENT_RESUMED_UNPAUSED: "unpaused",
+        libvirt.VIR_DOMAIN_EVENT_RESUMED_MIGRATED: "migrated",
+        libvirt.VIR_DOMAIN_EVENT_RESUMED_FROM_SNAPSHOT: "from_snapshot",
+    },
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: {
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN: "shutdown",
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_DESTROYED: "destroyed",
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED: "crashed",
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED: "migrated",
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_SAVED: "saved",
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED: "failed",
+        libvirt.VIR_DOMAIN_EVENT_STOPPED_FROM_SNAPSHOT: "from_snapshot",
+    },
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: {
+        libvirt.VIR_DOMAIN_EVENT_SHUTDOWN_FINISHED: "finished",
+        libvirt.VIR_DOMAIN_EVENT_SHUTDOWN_GUEST: "guest",
+        libvirt.VIR_DOMAIN_EVENT_SHUTDOWN_HOST: "host",
+    },
+}
+
+# State of a domain after a lifecycle event. Defined and undefined are handled separately.
+LIFECYCLE_STATES = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: libvirt.VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: libvirt.VIR_DOMAIN_PMSUSPENDED,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: libvirt.VIR_DOMAIN_CRASHED,
+}
+
+# Events that were not requested through libvirt
+UNEXPECTED_EVENTS = {
+    (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED),
+    (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED),
+    (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, libvirt.VIR_DOMAIN_EVENT_SUSPENDED_IOERROR),
+    (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, libvirt.VIR_DOMAIN_EVENT_SUSPENDED_WATCHDOG),
+    (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, libvirt.VIR_DOMAIN_EVENT_SUSPENDED_API_ERROR),
+}
+
+AGENT_STATES = {
+    libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED: True,
+    libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_DISCONNECTED: False,
+}
+
+
+def is_listening(host:HostMachine) -> bool:
+    """Whether a domain event listener is keeping the states of the host's domains up to date"""
+    return host is not None and host.events_heartbeat is not None \
+        and timezone.now() - host.events_heartbeat < HEARTBEAT_TIMEOUT
+
+
+def get_cached_state(vm:VirtualMachine) -> dict:
+    """The state of a virtual machine as recorded by the domain event listener, or None if
+    no listener is watching its host (ask libvirt instead). The state is None while the
+    domain is not defined."""
+    if not is_listening(vm.host):
+        return None
+    return {
+        "state": vm.domain_state,
+        "code": vm.domain_state_code,
+        "reason": vm.domain_state_reason,
+        "changed": vm.state_changed,
+        "guest_agent_connected": vm.guest_agent_connected,
+    }
+
+
+def get_states(vms:List[VirtualMachine], stats:bool = False) -> Dict[str, dict]:
+    """State of many virtual machines, by instance ID, like get_domain_states(). Read from the
+    cache for the hosts a listener is watching and from libvirt for the others (or for stats,
+    which are not cached). Load the virtual machines with their host (select_related)."""
+    cached = {}
+    uncached = []
+    for vm in vms:
+        state = None if stats else get_cached_state(vm)
+        if state is None:
+            uncached.append(vm)
+        elif state["state"] is not None:
+            cached[vm.instance_id] = {**state, "stats": None}
+
+    states = get_domain_states(uncached) if uncached else {}
+    states.update(cached)
+    return states
+
+
+class DomainStateCache:
+    """States of the domains the listener watches, by instance ID. Changes are written
+    through to the VirtualMachine (domain_state and state_changed), which is what the
+    API and the workers read (get_cached_state())."""
+
+    def __init__(self) -> None:
+        self._states = {}
+        self._lock = threading.Lock()
+
+
+    def load(self, host:HostMachine):
+        """Start from the states recorded in the database"""
+        vms = VirtualMachine.objects.filter(host=host).exclude(
+            state=VirtualMachine.State.TERMINATED
+        ).values_list("instance_id", "domain_state_code", "domain_state_reason")
+        with self._lock:
+            for instance_id, code, reason in vms:
+                self._states[instance_id] = {"code": code, "reason": reason}
+
+
+    def get(self, instance_id:str) -> dict:
+        with self._lock:
+            return self._states.get(instance_id)
+
+
+    def set(self, instance_id:str, state_int:int, reason:str) -> bool:
+        """Set the state of a domain (None if it's not defined). Returns whether it changed."""
+        with self._lock:
+            # Domains that are not known yet are not defined
+            current = self._states.setdefault(instance_id, {"code": None, "reason": None})
+            if current["code"] == state_int:
+                return False
+            self._states[instance_id] = {"code": state_int, "reason": reason}
+
+        VirtualMachine.objects.filter(instance_id=instance_id).update(
+            domain_state=DOMAIN_STATES.get(state_int, "unknown") if state_int is not None else None,
+            domain_state_code=state_int,
+            domain_state_reason=reason,
+            state_changed=timezone.now(),
+        )
+        return True
+
+
+    def retain(self, instance_ids:set):
+        """Forget the domains of the virtual machines not in instance_ids (e.g. terminated)"""
+        with self._lock:
+            for instance_id in set(self._states) - instance_ids:
+                del self._states[instance_id]
+
+
+class DomainEventListener:
+    """Long-running service that keeps the domain states of the virtual machines up to date
+    from libvirt's lifecycle, reboot and guest agent events, so reading the state of a virtual
+    machine doesn't need a call to libvirt. Run it with `manage.py listendomainevents`.
+
+    It watches all of the registered hosts with a connection of its own per host, records
+    every event in the DomainEvent history and sends a heartbeat per host (events_heartbeat).
+    Hosts it loses the connection to are reconnected, and the states are read in full after
+    connecting and every RECONCILE_INTERVAL seconds, in case events were missed.
+    """
+
+    EVENT_IDS = [
+        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+        libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+        libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
+    ]
+
+    def __init__(self, cache:DomainStateCache = None) -> None:
+        self.cache = cache if cache else DomainStateCache()
+        # host_id -> (host, connection, callback IDs)
+        self._watches = {}
+        # Domains the guest is shutting down by itself, see _on_lifecycle
+        self._guest_shutdowns = set()
+        # Hosts whose connection was closed, see _on_close
+        self._lost_hosts = set()
+        self._running = False
+        self._last_reconcile = None
+
+
+    def run(self):
+        # The event loop has to be registered before the connections are opened
+        libvirt.virEventRegisterDefaultImpl()
+        libvirt.virEventAddTimeout(HEARTBEAT_INTERVAL * 1000, self._on_timer, None)
+
+        self._running = True
+        self.watch_hosts()
+        self.heartbeat()
+        # Connecting to a host reads its states in full
+        self._last_reconcile = timezone.now()
+        logger.info(f"Listening for domain events of {len(self._watches)} host(s)")
+        try:
+            while self._running:
+                libvirt.virEventRunDefaultImpl()
+        finally:
+            for host_id in list(self._watches):
+                self.unwatch(host_id)
+
+
+    def stop(self):
+        """Stop after the current iteration of the event loop (at most HEARTBEAT_INTERVAL seconds)"""
+        self._running = False
+
+
+    def watch_hosts(self):
+        for host in HostMachine.objects.all():
+            if host.host_id in self._watches:
+                continue
+            try:
+                self.watch(host)
+            except libvirt.libvirtError as e:
+                logger.error(f"Could not watch host {host.host_id} at {host.libvirt_uri}: {e}")
+                metrics.increment("domain_event_connect_total", host=host.host_id, result="error")
+
+
+    def watch(self, host:HostMachine):
+        conn = libvirt.open(host.libvirt_uri)
+        # Detects a dead connection without waiting for a call to fail
+        conn.setKeepAlive(5, 3)
+        conn.registerCloseCallback(self._on_close, host.host_id)
+        callbacks = {
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE: self._on_lifecycle,
+            libvirt.VIR_DOMAIN_EVENT_ID_REBOOT: self._on_reboot,
+            libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE: self._on_agent,
+        }
+        callback_ids = [conn.domainEventRegisterAny(None, event_id, callbacks[event_id], host) for event_id in self.EVENT_IDS]
+        self._watches[host.host_id] = (host, conn, callback_ids)
+        metrics.increment("domain_event_connect_total", host=host.host_id, result="success")
+        logger.info(f"Watching domain events of host {host.host_id} at {host.libvirt_uri}")
+
+        self.cache.load(host)
+        self.reconcile(host, conn)
+
+
+    def unwatch(self, host_id:str):
+        host, conn, callback_ids = self._watches.pop(host_id)
+        # The calls can fail on a connection that was lost, the connection is closed regardless
+        for callback_id in callback_ids:
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            # Already unregistered after the connection was closed by libvirt
+            pass
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+
+    def release_lost_hosts(self):
+        """Release the watches of the hosts that lost their connection, so they are reconnected"""
+        for host_id in self._lost_hosts & set(self._watches):
+            self.unwatch(host_id)
+        self._lost_hosts.clear()
+
+
+    def heartbeat(self):
+        HostMachine.objects.filter(host_id__in=list(self._watches)).update(events_heartbeat=timezone.now())
+
+
+    def reconcile(self, host:HostMachine, conn:libvirt.virConnect):
+        """Read the states of all of the domains of the host and record the ones that changed
+        without an event (e.g. while the listener wasn't connected)."""
+        domains = {
+            domain.name(): stats.get("state.state")
+            for domain, stats in conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        }
+        vms = VirtualMachine.objects.filter(host=host).exclude(
+            state=VirtualMachine.State.TERMINATED
+        ).values_list("instance_id", "account_id")
+        for instance_id, account_id in vms:
+            state_int = domains.get(instance_id)
+            if self.cache.set(instance_id, state_int, "reconciled"):
+                logger.info(f"State of {instance_id} changed without an event, now {DOMAIN_STATES.get(state_int)}")
+                self.record(host, instance_id, account_id, "reconciled", None, state_int)
+
+
+    def record(self, host:HostMachine, instance_id:str, account_id:str, event:str, detail:str,
+            state_int:int, unexpected:bool = False):
+        DomainEvent.objects.create(
+            instance_id=instance_id,
+            account_id=account_id,
+            host=host,
+            event=event,
+            detail=detail,
+            state=DOMAIN_STATES.get(state_int) if state_int is not None else None,
+            unexpected=unexpected,
+        )
+        metrics.increment("domain_events_total", event=event, unexpected=str(unexpected).lower())
+        if unexpected:
+            logger.warning(f"Unexpected {event} ({detail}) of {instance_id} on host {host.host_id}")
+
+
+    def _account_id(self, instance_id:str) -> str:
+        # Only the domains of ecHome's virtual machines are recorded
+        return VirtualMachine.objects.filter(instance_id=instance_id).values_list("account_id", flat=True).first()
+
+
+    def _on_lifecycle(self, conn, domain, event:int, detail:int, host:HostMachine):
+        try:
+            instance_id = domain.name()
+            account_id = self._account_id(instance_id)
+            if account_id is None:
+                return
+
+            event_name = LIFECYCLE_EVENTS.get(event, str(event))
+            detail_name = LIFECYCLE_DETAILS.get(event, {}).get(detail, str(detail))
+            unexpected = (event, detail) in UNEXPECTED_EVENTS or event == libvirt.VIR_DOMAIN_EVENT_CRASHED
+
+            # A shutdown the guest started by itself ends with a regular stopped/shutdown event,
+            # which is the unexpected shutoff
+            if event == libvirt.VIR_DOMAIN_EVENT_SHUTDOWN and detail == libvirt.VIR_DOMAIN_EVENT_SHUTDOWN_GUEST:
+                self._guest_shutdowns.add(instance_id)
+            elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+                if instance_id in self._guest_shutdowns and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN:
+                    unexpected = True
+                self._guest_shutdowns.discard(instance_id)
+
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                state_int = None
+            elif event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+                # A new domain is shut off, a redefined one keeps its state
+                current = self.cache.get(instance_id)
+                state_int = current["code"] if current and current["code"] is not None else libvirt.VIR_DOMAIN_SHUTOFF
+            else:
+                state_int = LIFECYCLE_STATES.get(event)
+
+            self.cache.set(instance_id, state_int, detail_name)
+            self.record(host, instance_id, account_id, event_name, detail_name, state_int, unexpected)
+        except Exception as e:
+            # Exceptions can't be raised into the event loop
+            logger.exception(e)
+
+
+    def _on_reboot(self, conn, domain, host:HostMachine):
+        try:
+            instance_id = domain.name()
+            if account_id := self._account_id(instance_id):
+                current = self.cache.get(instance_id)
+                self.record(host, instance_id, account_id, "reboot", None, current["code"] if current else None)
+        except Exception as e:
+            logger.exception(e)
+
+
+    def _on_agent(self, conn, domain, state:int, reason:int, host:HostMachine):
+        try:
+            instance_id = domain.name()
+            if account_id := self._account_id(instance_id):
+                connected = AGENT_STATES.get(state)
+                VirtualMachine.objects.filter(instance_id=instance_id).update(guest_agent_connected=connected)
+                current = self.cache.get(instance_id)
+                self.record(host, instance_id, account_id, "agent",
+                    "connected" if connected else "disconnected", current["code"] if current else None)
+        except Exception as e:
+            logger.exception(e)
+
+
+    def _on_close(self, conn, reason:int, host_id:str):
+        # Reconnected on the next timer
+        logger.warning(f"Lost the connection to host {host_id} (reason {reason}), reconnecting")
+        # libvirt holds the lock of the close callback while calling it, so the callbacks
+        # and the connection are released on the next timer instead
+        self._lost_hosts.add(host_id)
+        metrics.increment("domain_event_disconnect_total", host=host_id)
+
+
+    def _on_timer(self, timer, opaque):
+        try:
+            # The listener runs for a long time, don't hold on to stale database connections
+            close_old_connections()
+            self.release_lost_hosts()
+            self.watch_hosts()
+            self.heartbeat()
+
+            now = timezone.now()
+            if self._last_reconcile is None or now - self._last_reconcile >= timedelta(seconds=RECONCILE_INTERVAL):
+                self._last_reconcile = now
+                for host, conn, _ in list(self._watches.values()):
+                    try:
+                        self.reconcile(host, conn)
+                    except libvirt.libvirtError as e:
+                        logger.error(f"Could not read the domain states of host {host.host_id}: {e}")
+                self.cache.retain(set(VirtualMachine.objects.exclude(
+                    state=VirtualMachine.State.TERMINATED
+                ).values_list("instance_id", flat=True)))
+        except Exception as e:
+            logger.exception(e)
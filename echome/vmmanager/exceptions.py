@@ -14,6 +14,15 @@ class InvalidLaunchConfiguration(Exception):
 class LaunchError(Exception):
     pass
 
+class VirtualMachineSnapshotError(Exception):
+    pass
+
+class PlacementError(Exception):
+    pass
+
+class ShutdownError(Exception):
+    pass
+
 # Image Model Exceptions
 class ImageDoesNotExistError(Exception):
     pass
@@ -32,3 +41,14 @@ class ImagePrepError(Exception):
 
 class ImageCopyError(Exception):
     pass
+
+class ImageInUseError(Exception):
+    pass
+
+class InvalidImageUpload(Exception):
+    pass
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset:int):
+        super().__init__(f"Upload offset does not match the number of bytes received ({offset})")
+        self.offset = offset
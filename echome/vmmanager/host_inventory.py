@@ -0,0 +1,158 @@
+import libvirt
+import xmltodict
+import logging
+import os
+from datetime import timedelta
+from django.utils import timezone
+from echome.config import ecHomeConfig
+from .models import HostMachine, HostSample
+from .scheduler import capacity_index, RESERVED_HOST_CPUS
+from .libvirt_connection import connections
+
+logger = logging.getLogger(__name__)
+
+VM_ROOT_DIR = ecHomeConfig.VirtualMachines().user_dir
+
+# Virtual CPUs that can be allocated per physical CPU thread
+CPU_ALLOCATION_RATIO = float(ecHomeConfig.VirtualMachines().cpu_allocation_ratio)
+# Memory kept for the host itself, not allocated to virtual machines
+RESERVED_HOST_MEMORY_MB = int(ecHomeConfig.VirtualMachines().reserved_host_memory_mb)
+
+# How long samples are kept for
+SAMPLE_RETENTION = timedelta(days=1)
+
+
+class HostInventory:
+    """Samples the resources of a host through libvirt and records them:
+
+    - A HostSample with the free memory (also per NUMA cell) and storage.
+    - The allocatable capacity in HostMachine.cpu_count, memory_mb and storage_bytes,
+      which is what the scheduler places virtual machines against.
+    - The CPU model and topology (the cores and hugepages of each NUMA cell) in
+      HostMachine.metadata["inventory"].
+
+    Sampling runs periodically in the workers (task_sample_hosts), so nothing on the
+    request path has to call libvirt to know the capacity of a host.
+    """
+
+    def __init__(self, host:HostMachine) -> None:
+        self.host = host
+
+
+    def sample(self) -> HostSample:
+        with connections.connection(self.host.libvirt_uri) as conn:
+            model, memory_mb, cpus, mhz, nodes, sockets, cores, threads = conn.getInfo()
+            capabilities = self.parse_capabilities(conn.getCapabilities())
+            free_memory_mb = conn.getFreeMemory() // 1024 ** 2
+            cells = self.get_numa_cells(conn, capabilities)
+
+        storage_bytes, free_storage_bytes = self.get_storage()
+
+        sample = HostSample(
+            host=self.host,
+            cpu_count=cpus,
+            memory_mb=memory_mb,
+            free_memory_mb=free_memory_mb,
+            storage_bytes=storage_bytes,
+            free_storage_bytes=free_storage_bytes,
+            numa_cells=cells,
+        )
+        sample.save()
+
+        # The reserved cores are kept for the host, like the reserved memory
+        reserved_cpus = len([cpu for cpu in RESERVED_HOST_CPUS if cpu < cpus])
+        self.host.cpu_count = int((cpus - reserved_cpus) * CPU_ALLOCATION_RATIO)
+        self.host.memory_mb = max(memory_mb - RESERVED_HOST_MEMORY_MB, 0)
+        self.host.storage_bytes = storage_bytes
+        self.host.metadata["inventory"] = {
+            "sampled": sample.created.isoformat(),
+            "arch": model,
+            "cpu_model": capabilities["cpu_model"],
+            "cpu_vendor": capabilities["cpu_vendor"],
+            "mhz": mhz,
+            "sockets": sockets,
+            "cores": cores,
+            "threads": threads,
+            "numa_nodes": len(cells),
+            # Cores and hugepages of each NUMA cell, for pinned virtual machines
+            "topology": [
+                {key: cell[key] for key in ("id", "memory_mb", "cpu_ids", "hugepages")}
+                for cell in cells
+            ],
+        }
+        self.host.save()
+
+        logger.debug(f"Sampled host {self.host.host_id}: {cpus} CPUs, {free_memory_mb}/{memory_mb} MB free")
+        return sample
+
+
+    @staticmethod
+    def parse_capabilities(xml:str) -> dict:
+        """Returns the CPU model and the NUMA cells of the host from the capabilities XML"""
+        host = xmltodict.parse(xml)["capabilities"]["host"]
+        cpu = host.get("cpu", {})
+
+        cells = []
+        topology = host.get("topology") or {}
+        cell_list = (topology.get("cells") or {}).get("cell", [])
+        for cell in cell_list if isinstance(cell_list, list) else [cell_list]:
+            memory = cell.get("memory", {})
+            memory_kib = int(memory.get("#text", 0)) if isinstance(memory, dict) else int(memory)
+            cpus = cell.get("cpus") or {}
+            cpu_list = cpus.get("cpu", [])
+            pages = cell.get("pages", [])
+            cells.append({
+                "id": int(cell["@id"]),
+                "memory_mb": memory_kib // 1024,
+                "cpus": int(cpus.get("@num", 0)),
+                "cpu_ids": [int(c["@id"]) for c in (cpu_list if isinstance(cpu_list, list) else [cpu_list])],
+                # Hugepages reserved on the cell by page size (KiB), the 4 KiB pages are left out
+                "hugepages": {
+                    page["@size"]: int(page.get("#text", 0))
+                    for page in (pages if isinstance(pages, list) else [pages])
+                    if int(page["@size"]) > 4
+                },
+            })
+
+        return {
+            "cpu_model": cpu.get("model"),
+            "cpu_vendor": cpu.get("vendor"),
+            "cells": cells,
+        }
+
+
+    @staticmethod
+    def get_numa_cells(conn:libvirt.virConnect, capabilities:dict) -> list:
+        cells = capabilities["cells"]
+        if not cells:
+            return []
+        free = conn.getCellsFreeMemory(0, len(cells))
+        return [
+            {**cell, "free_memory_mb": free_bytes // 1024 ** 2}
+            for cell, free_bytes in zip(cells, free)
+        ]
+
+
+    @staticmethod
+    def get_storage():
+        """Total and free bytes of the virtual machine storage. The storage is shared between
+        the hosts, so it's read locally."""
+        try:
+            st = os.statvfs(VM_ROOT_DIR)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Could not read free space of {VM_ROOT_DIR}: {e}")
+            return None, None
+        return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+
+
+def sample_hosts():
+    """Sample all of the registered hosts and remove old samples."""
+    for host in HostMachine.objects.all():
+        try:
+            HostInventory(host).sample()
+        except libvirt.libvirtError as e:
+            logger.error(f"Could not sample host {host.host_id} at {host.libvirt_uri}: {e}")
+
+    HostSample.objects.filter(created__lt=timezone.now() - SAMPLE_RETENTION).delete()
+    # Pick up the new capacity on the next placement in this process
+    capacity_index.invalidate()
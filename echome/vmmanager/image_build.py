@@ -0,0 +1,126 @@
+import logging
+import time
+from contextlib import contextmanager
+from django.utils import timezone
+from .models import Image
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between saving progress updates of a stage
+PROGRESS_SAVE_INTERVAL = 2
+
+
+class ImageBuild:
+    """Tracks the stages of building an image (e.g. capturing a virtual machine disk) in
+    Image.metadata["build"] so the progress can be followed with DescribeImage:
+
+        build = ImageBuild(image, ["capture", "sysprep"])
+        with build.stage("capture") as stage:
+            ...
+            stage.progress(50, bytes_processed)
+
+    A stage that raises an exception is marked as failed and the exception is re-raised.
+    """
+
+    def __init__(self, image:Image, stages:list) -> None:
+        self.image = image
+        self.image.metadata["build"] = {
+            "state": "pending",
+            "started": None,
+            "finished": None,
+            "stages": [{"name": name, "state": "pending"} for name in stages],
+        }
+        self._save()
+
+
+    @contextmanager
+    def stage(self, name:str):
+        build = self.image.metadata["build"]
+        stage = BuildStage(self, self._get_stage(name))
+        if build["state"] == "pending":
+            build["state"] = "running"
+            build["started"] = self._now()
+        build["stage"] = name
+        stage.start()
+
+        try:
+            yield stage
+        except Exception as e:
+            stage.fail(str(e))
+            build["state"] = "failed"
+            build["finished"] = self._now()
+            self._save()
+            raise
+
+        stage.finish()
+        if all(s["state"] == "finished" for s in build["stages"]):
+            build["state"] = "finished"
+            build["finished"] = self._now()
+            del build["stage"]
+        self._save()
+
+
+    def _get_stage(self, name:str) -> dict:
+        for stage in self.image.metadata["build"]["stages"]:
+            if stage["name"] == name:
+                return stage
+        raise KeyError(f"Unknown build stage: {name}")
+
+
+    def _save(self):
+        self.image.save(update_fields=["metadata", "last_modified"])
+
+
+    @staticmethod
+    def _now() -> str:
+        return timezone.now().isoformat()
+
+
+class BuildStage:
+    """A single stage of an ImageBuild"""
+
+    def __init__(self, build:ImageBuild, record:dict) -> None:
+        self.build = build
+        self.record = record
+        self._last_saved = 0
+
+
+    def start(self):
+        logger.debug(f"Starting build stage '{self.record['name']}' of {self.build.image.image_id}")
+        self.record.update({
+            "state": "running",
+            "started": ImageBuild._now(),
+            "progress": 0,
+            "bytes": 0,
+        })
+        self.build._save()
+        self._last_saved = time.monotonic()
+
+
+    def progress(self, percent:float, bytes_processed:int = None):
+        """Report the progress of the stage. Saved to the database every few seconds at most."""
+        self.record["progress"] = round(percent, 1)
+        if bytes_processed is not None:
+            self.record["bytes"] = bytes_processed
+
+        if time.monotonic() - self._last_saved >= PROGRESS_SAVE_INTERVAL:
+            self.build._save()
+            self._last_saved = time.monotonic()
+
+
+    def finish(self):
+        self.record.update({
+            "state": "finished",
+            "finished": ImageBuild._now(),
+            "progress": 100,
+        })
+        logger.debug(f"Finished build stage '{self.record['name']}' of {self.build.image.image_id}")
+
+
+    def fail(self, error:str):
+        self.record.update({
+            "state": "failed",
+            "finished": ImageBuild._now(),
+            "error": error,
+        })
+        logger.debug(f"Build stage '{self.record['name']}' of {self.build.image.image_id} failed: {error}")
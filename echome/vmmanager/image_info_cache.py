@@ -0,0 +1,90 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from django.core.cache import caches
+from echome.config import ecHomeConfig
+from echome.metrics import metrics
+
+# Number of `qemu-img info` results kept per process
+INFO_CACHE_SIZE = 1024
+# Seconds entries are kept in the shared cache
+SHARED_INFO_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class ImageInfoCache:
+    """Cache of `qemu-img info` results. Entries are keyed by the path, inode, modification time
+    and size of the image, so a changed (or replaced) image is never served from the cache.
+
+    Results are kept in a bounded LRU cache in the process and, if enabled with
+    `image_info_shared_cache`, in the shared Django cache so the API server and the
+    workers can use each other's results.
+    """
+
+    def __init__(self, max_size:int = INFO_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = None
+
+
+    def key(self, filename: str):
+        """Returns the cache key for a file or None if the file can't be cached (e.g. doesn't exist)."""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (os.path.abspath(filename), st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+    def get(self, key: tuple):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.increment("qemu_img_info_cache_total", result="hit")
+                return copy.deepcopy(self._entries[key])
+
+        shared = self._get_shared_cache()
+        if shared is not None:
+            value = shared.get(self._shared_key(key))
+            if value is not None:
+                metrics.increment("qemu_img_info_cache_total", result="shared_hit")
+                self._put_local(key, value)
+                return copy.deepcopy(value)
+
+        metrics.increment("qemu_img_info_cache_total", result="miss")
+        return None
+
+
+    def put(self, key: tuple, value: dict):
+        self._put_local(key, copy.deepcopy(value))
+        shared = self._get_shared_cache()
+        if shared is not None:
+            shared.set(self._shared_key(key), value, SHARED_INFO_CACHE_TIMEOUT)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def _put_local(self, key: tuple, value: dict):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def _get_shared_cache(self):
+        if self._shared is None:
+            enabled = str(ecHomeConfig.VirtualMachines().image_info_shared_cache).lower() == "true"
+            self._shared = caches["shared"] if enabled else False
+        return self._shared if self._shared is not False else None
+
+
+    def _shared_key(self, key: tuple) -> str:
+        path, inode, mtime, size = key
+        path_hash = hashlib.sha1(path.encode()).hexdigest()
+        return f"qemu-img-info:{path_hash}:{inode}:{mtime}:{size}"
@@ -1,15 +1,19 @@
 import logging
 import os
-import shutil
 from pathlib import Path
+from django.db.models import Q
+from commander.qemuimg import QemuImg, size_to_bytes
 from identity.models import User
-from .models import Image
+from .models import Image, DiskPool, PooledDisk
+from .fast_copy import copy_file
+from .image_store import ImageStore
 from .exceptions import (
     ImageAlreadyExistsError, 
     InvalidImagePath, 
     ImageDoesNotExistError, 
     ImagePrepError, 
-    ImageCopyError
+    ImageCopyError,
+    ImageInUseError
 )
 
 
@@ -36,8 +40,8 @@ class ImageManager:
         """Instantly register a user image for use. If you need to prepare an image that needs processing done
         in the background, use prepare_user_image()."""
 
-        self.prepare_user_image(user)
-        return self._register_image(path, name, description, host=host, tags=tags)
+        self.prepare_user_image(user, name, description, tags)
+        return self._register_image(path)
 
     
     def prepare_guest_image(self, name=None, description=None) -> str:
@@ -59,13 +63,20 @@ class ImageManager:
         return self.image.image_id
     
 
-    def finish_guest_image(self, path, name, description, tags:dict = None) -> str:
+    def finish_guest_image(self, path, name = None, description = None, tags:dict = None) -> str:
         """Finishes a guest image that was first prepared."""
         if not self.image:
             logger.warn("Cannot finish an image that was not first prepared")
             raise ImagePrepError
         
-        return self._register_image(path, name, description, tags)
+        if name:
+            self.image.name = name
+        if description:
+            self.image.description = description
+        if tags:
+            self.image.tags = tags
+
+        return self._register_image(path)
 
 
     def prepare_user_image(self, user:User, name:str, description:str, tags:dict = None) -> str:
@@ -99,23 +110,52 @@ class ImageManager:
         return self._register_image(path)
 
 
-    def _register_image(self, path:str):
+    def finish_upload(self, path:str, digest:str) -> str:
+        """Finishes an image that was prepared and then uploaded to `path`. The uploaded file is moved into
+        the image store."""
+        if not self.image:
+            logger.warn("Cannot finish an image that was not first prepared")
+            raise ImagePrepError
+
+        return self._register_image(path, digest=digest, move=True)
+
+
+    def _register_image(self, path:str, digest:str = None, move:bool = None):
         # Check to see if a file exists at the provided path
         if not os.path.exists(path):
             logger.error(f"File does not exist at specified file path: {path}")
             raise InvalidImagePath(f"File does not exist at specified file path: {path}")
         
-        # Check to see if an image at the path already exists
-        if Image.objects.filter(image_path=path).exists():
+        # Check to see if an image at the path already exists. image_path is the path of the
+        # blob in the image store, the path the image was registered from is in the metadata.
+        if Image.objects.filter(Q(image_path=path) | Q(metadata__source_path=path)).exclude(pk=self.image.pk).exists():
             logger.error(f"Image already exists in database. img_path={path}")
             raise ImageAlreadyExistsError(f"Image already exists in database. img_path={path}")
         
-        self.image.image_path = path
+        # Add the image to the content-addressed store. If an identical image is already
+        # stored, this image will share its file. User images are created by us and can be
+        # moved into the store, guest images are left where the administrator put them.
+        if move is None:
+            move = self.image.image_type == Image.ImageType.USER
+
+        previous_blob = self.image.blob
+        blob = ImageStore().ingest(path, digest=digest, move=move)
+
+        self.image.blob = blob
+        self.image.image_path = blob.path
         self.image.set_image_metadata()
+        self.image.metadata["sha256"] = blob.digest
+        self.image.metadata["source_path"] = path
 
         self.image.state = Image.State.AVAILABLE
 
         self.image.save()
+
+        # Disks provisioned from a previous registration of this image are stale
+        self._invalidate_disk_pool(refill=True)
+        if previous_blob and previous_blob.digest != blob.digest:
+            ImageStore().release(previous_blob)
+
         return self.image.image_id
 
 
@@ -156,7 +196,7 @@ class ImageManager:
 
         try:
             logger.debug(f"Copying image: {img_path} TO directory {destination_dir} as {destination_vm_img}")
-            shutil.copy2(img_path, destination_vm_img)
+            copy_file(img_path, destination_vm_img)
         except FileNotFoundError:
             raise ImageCopyError("Encountered an error on image copy. Original image is not found. Cannot continue.")
         except OSError as e:
@@ -166,6 +206,47 @@ class ImageManager:
         return destination_vm_img
 
     
+    def clone_image(self, image:Image, destination_dir:Path, file_name:str, size:str = None) -> Path:
+        """Create a thin copy-on-write qcow2 overlay (linked clone) of a guest or user image in the path.
+        The overlay is created and resized in a single step. Returns the full path of the overlay."""
+        backing_path = os.path.abspath(image.image_path)
+        if not os.path.exists(backing_path):
+            raise ImageCopyError("Encountered an error on image clone. Original image is not found. Cannot continue.")
+
+        destination_vm_img = destination_dir.absolute() / f"{file_name}.qcow2"
+
+        # An overlay smaller than its backing file would truncate the disk
+        # seen by the guest, keep the size of the image instead.
+        if size and size_to_bytes(size) < image.metadata["virtual-size"]:
+            logger.warning(f"Requested size {size} is smaller than the image. Using the image size instead.")
+            size = None
+
+        logger.debug(f"Creating linked clone of image: {backing_path} as {destination_vm_img}")
+        if not QemuImg().create(str(destination_vm_img), "qcow2", size, backing_file=backing_path, backing_format=image.format):
+            raise ImageCopyError("Encountered an error when creating the linked clone with qemu-img.")
+
+        logger.debug(f"Final image: {destination_vm_img}")
+        return destination_vm_img
+
+
+    def provision_disk(self, image:Image, destination_dir:Path, file_name:str, size:str, linked:bool = False) -> Path:
+        """Provision a boot disk of the specified size from an image, either as a full copy or as a linked clone.
+        Returns the full path of the new disk."""
+        if linked:
+            return self.clone_image(image, destination_dir, file_name, size)
+
+        disk_path = self.copy_image(image, destination_dir, file_name)
+
+        logger.debug(f"Resizing image size to {size}")
+        try:
+            QemuImg().resize(disk_path, size)
+        except Exception as e:
+            logger.error(f"Encountered error when running qemu resize. {e}")
+            raise ImageCopyError("Encountered error when running qemu resize.")
+
+        return disk_path
+
+    
     def mark_image_as_failed(self):
         logger.debug("Marking image as failed")
         self.image.state = Image.State.ERROR
@@ -173,11 +254,55 @@ class ImageManager:
 
 
     def deactivate_image(self):
-        pass
+        """Deactivate an image so that it can no longer be used for new virtual machines. Existing
+        virtual machines (including linked clones) are not affected."""
+        logger.debug(f"Deactivating image: {self.image.image_id}")
+        self.image.deactivated = True
+        self.image.save()
+        self._invalidate_disk_pool()
 
 
     def delete_image(self):
-        pass
+        """Delete an image and its file. Images that are still backing linked clones cannot be deleted."""
+        self._invalidate_disk_pool()
+
+        if self.image.is_in_use:
+            logger.error(f"Image {self.image.image_id} is backing one or more volumes and cannot be deleted.")
+            raise ImageInUseError(f"Image {self.image.image_id} is backing one or more volumes and cannot be deleted.")
+
+        self.image.state = Image.State.DELETING
+        self.image.save()
+
+        if self.image.blob:
+            # The file is shared with identical images, only delete it when it's no longer referenced
+            blob = self.image.blob
+            self.image.deactivated = True
+            self.image.state = Image.State.DELETED
+            self.image.save()
+            ImageStore().release(blob)
+            return
+
+        try:
+            os.remove(self.image.image_path)
+        except FileNotFoundError:
+            logger.warning(f"Image file was already removed: {self.image.image_path}")
+
+        self.image.deactivated = True
+        self.image.state = Image.State.DELETED
+        self.image.save()
+
+
+    def _invalidate_disk_pool(self, refill:bool = False):
+        """Discard all ready disks in the warm pool that were provisioned from this image."""
+        for disk in PooledDisk.objects.filter(pool__image=self.image):
+            disk.discard()
+
+        if refill:
+            # Imported here as the tasks module depends on this module
+            from .tasks import task_refill_disk_pool
+
+            for pool in DiskPool.objects.filter(image=self.image):
+                task_refill_disk_pool.delay(self.image.image_id, pool.disk_size)
 
     
     def __get_image_from_id(self, image_id:str) -> Image:
@@ -0,0 +1,160 @@
+import errno
+import hashlib
+import logging
+import os
+import uuid
+from pathlib import Path
+from django.db import IntegrityError
+from echome.config import ecHomeConfig
+from echome.metrics import metrics
+from .models import ImageBlob
+from .fast_copy import copy_file
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def get_image_store_dir() -> Path:
+    vm_config = ecHomeConfig.VirtualMachines()
+    if vm_config.image_store_dir:
+        return Path(vm_config.image_store_dir)
+    return Path(f"{vm_config.guest_images_dir}/.image_store")
+
+
+class ImageStore:
+    """Content-addressed store for image files, keyed by the sha256 of the file contents.
+
+    Images with identical contents share a single read-only file in the store. Blobs are
+    deleted once nothing references them anymore (see ImageBlob.reference_count).
+    """
+
+    def __init__(self, store_dir:Path = None) -> None:
+        self.store_dir = store_dir if store_dir else get_image_store_dir()
+
+
+    def ingest(self, path:str, digest:str = None, move:bool = False) -> ImageBlob:
+        """Add a file to the store and return its blob. If a blob with identical contents already
+        exists, that blob is returned instead and no data is stored.
+
+        Args:
+            path (str): Path of the file to add.
+            digest (str, optional): sha256 of the file if already known. Computed if not provided.
+            move (bool, optional): Move the file into the store (the original path is removed). Otherwise
+                the file is copied (reflinked where the filesystem supports it) into the store and the
+                original is left untouched. Defaults to False.
+
+        Returns:
+            ImageBlob: The blob holding the contents of the file.
+        """
+        if digest is None:
+            digest = self.hash_file(path)
+
+        existing = self._get_blob(digest)
+        if existing:
+            logger.info(f"Identical image already stored as {existing.digest}, deduplicating {path}")
+            metrics.increment("image_store_dedup_total")
+            metrics.increment("image_store_dedup_bytes", existing.size)
+            if move:
+                os.remove(path)
+            return existing
+
+        blob_path = self.blob_path(digest)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if blob_path.exists():
+            # Left over from an earlier ingest that did not finish registering
+            # the blob. Blobs are only ever renamed into place once complete.
+            logger.debug(f"Blob file already exists for {digest}, reusing it")
+            if move:
+                os.remove(path)
+        else:
+            logger.debug(f"Adding {path} to the image store as {blob_path}")
+            if move:
+                self._move(path, blob_path)
+            else:
+                self._copy(path, blob_path)
+
+            # Blobs are shared and must never be modified in place
+            os.chmod(blob_path, 0o444)
+
+        try:
+            blob, _ = ImageBlob.objects.get_or_create(
+                digest=digest,
+                defaults={
+                    "path": str(blob_path),
+                    "size": os.stat(blob_path).st_size,
+                }
+            )
+        except IntegrityError:
+            blob = ImageBlob.objects.get(digest=digest)
+
+        return blob
+
+
+    def release(self, blob:ImageBlob) -> bool:
+        """Delete a blob and its file if nothing references it anymore. Returns True if the blob was deleted."""
+        references = blob.reference_count
+        if references > 0:
+            logger.debug(f"Blob {blob.digest} still has {references} reference(s), keeping it")
+            return False
+
+        logger.debug(f"Deleting unreferenced blob {blob.digest}")
+        try:
+            os.remove(blob.path)
+        except FileNotFoundError:
+            logger.warning(f"Blob file was already removed: {blob.path}")
+        blob.delete()
+        return True
+
+
+    def blob_path(self, digest:str) -> Path:
+        return self.store_dir.absolute() / "sha256" / digest[:2] / digest
+
+
+    @staticmethod
+    def hash_file(path:str) -> str:
+        """Compute the sha256 of a file"""
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                sha.update(chunk)
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            except (AttributeError, OSError):
+                pass
+        return sha.hexdigest()
+
+
+    def _get_blob(self, digest:str) -> ImageBlob:
+        try:
+            blob = ImageBlob.objects.get(digest=digest)
+        except ImageBlob.DoesNotExist:
+            return None
+
+        if not os.path.exists(blob.path):
+            logger.warning(f"Blob {digest} is missing its file {blob.path}, storing it again")
+            return None
+        return blob
+
+
+    def _move(self, path:str, blob_path:Path):
+        try:
+            os.rename(path, blob_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._copy(path, blob_path)
+            os.remove(path)
+
+
+    def _copy(self, path:str, blob_path:Path):
+        # Copy next to the blob first so a partial copy never ends up in the store. The name is
+        # unique so concurrent ingests of the same contents don't write to the same file.
+        tmp_path = blob_path.parent / f".{blob_path.name}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            copy_file(path, tmp_path)
+            os.rename(tmp_path, blob_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
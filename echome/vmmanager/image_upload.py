@@ -0,0 +1,187 @@
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+from .models import Image
+from .image_manager import ImageManager
+from .image_store import get_image_store_dir
+from .exceptions import InvalidImageUpload, UploadOffsetMismatch
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+QCOW2_MAGIC = b"QFI\xfb"
+
+# sha256 state of uploads in progress in this process, keyed by image ID. The
+# state is only valid for the offset it was saved at. Uploads resumed in another
+# process re-hash the data that was already received instead.
+_upload_hashes = {}
+_upload_hashes_lock = threading.Lock()
+
+
+class ImageUpload:
+    """Streams an image upload straight to disk in one or more requests. Uploads can be resumed
+    from the last received offset after a dropped connection. Once all of the data is received,
+    the image is registered and moves from CREATING to AVAILABLE."""
+
+    def __init__(self, image_manager:ImageManager) -> None:
+        self.image_manager = image_manager
+        self.image = image_manager.image
+
+
+    @staticmethod
+    def upload_dir() -> Path:
+        return get_image_store_dir().absolute() / "uploads"
+
+
+    @property
+    def part_path(self) -> Path:
+        return self.upload_dir() / f"{self.image.image_id}.part"
+
+
+    @property
+    def size(self) -> int:
+        return self.image.metadata["upload"]["size"]
+
+
+    @property
+    def offset(self) -> int:
+        """Number of bytes received so far"""
+        try:
+            return os.stat(self.part_path).st_size
+        except FileNotFoundError:
+            return 0
+
+
+    def start(self, size:int):
+        """Start a new upload of `size` bytes for the prepared image."""
+        if size <= 0:
+            raise InvalidImageUpload("Image size must be larger than 0.")
+
+        self.upload_dir().mkdir(parents=True, exist_ok=True)
+        self.part_path.touch()
+
+        self.image.metadata = {
+            "upload": {
+                "size": size,
+            }
+        }
+        self.image.save()
+
+
+    def write(self, stream, offset:int) -> int:
+        """Write the data from `stream` to the upload, starting at `offset`. The offset must match the
+        number of bytes received so far. Returns the new offset. Completes the upload once all of the
+        data has been received."""
+        if self.image.state != Image.State.CREATING or "upload" not in self.image.metadata:
+            raise InvalidImageUpload("Image is not accepting uploads.")
+
+        with open(self.part_path, "r+b") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise InvalidImageUpload("Another upload for this image is in progress.")
+
+            current_offset = self.offset
+            if offset != current_offset:
+                raise UploadOffsetMismatch(current_offset)
+
+            sha = self._get_hash(offset)
+            f.seek(offset)
+            try:
+                while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                    if offset + len(chunk) > self.size:
+                        raise InvalidImageUpload("Received more data than the size of the image.")
+
+                    if offset < 512:
+                        self._check_header(f, chunk, offset)
+
+                    f.write(chunk)
+                    sha.update(chunk)
+                    offset += len(chunk)
+            finally:
+                # Keep what was received so far (e.g. on a dropped connection) so
+                # the client can resume from the new offset.
+                f.truncate(offset)
+                self._save_hash(sha, offset)
+
+        logger.debug(f"Received {offset}/{self.size} bytes for {self.image.image_id}")
+
+        if offset == self.size:
+            self._complete(sha.hexdigest())
+
+        return offset
+
+
+    def _complete(self, digest:str):
+        logger.debug(f"Upload complete for {self.image.image_id}, registering image")
+        with _upload_hashes_lock:
+            _upload_hashes.pop(self.image.image_id, None)
+
+        try:
+            self.image_manager.finish_upload(str(self.part_path), digest)
+        except Exception:
+            self.image_manager.mark_image_as_failed()
+            raise
+
+
+    def _check_header(self, f, chunk:bytes, offset:int):
+        """Inspect the image header as soon as it has arrived, to record the format and
+        reject images that qemu would not be able to use safely."""
+        f.flush()
+        header = self._read_prefix(f, offset) + chunk
+        if len(header) < 72 and offset + len(chunk) < self.size:
+            # Wait until enough of the header has arrived
+            return
+
+        upload = self.image.metadata["upload"]
+        if header[:4] == QCOW2_MAGIC:
+            version, backing_file_offset = struct.unpack(">IQ", header[4:16])
+            virtual_size = struct.unpack(">Q", header[24:32])[0]
+            if backing_file_offset != 0:
+                # A backing file could point anywhere on the host
+                raise InvalidImageUpload("Images with a backing file cannot be uploaded.")
+            upload["format"] = "qcow2"
+            upload["qcow2-version"] = version
+            upload["virtual-size"] = virtual_size
+        else:
+            upload["format"] = "raw"
+            upload["virtual-size"] = self.size
+        self.image.save()
+
+
+    def _read_prefix(self, f, offset:int) -> bytes:
+        if offset == 0:
+            return b""
+        f.seek(0)
+        prefix = f.read(offset)
+        f.seek(offset)
+        return prefix
+
+
+    def _get_hash(self, offset:int):
+        with _upload_hashes_lock:
+            saved = _upload_hashes.get(self.image.image_id)
+        if saved and saved[0] == offset:
+            return saved[1]
+
+        # Resumed in another process (or after a restart), hash what we already have
+        sha = hashlib.sha256()
+        remaining = offset
+        with open(self.part_path, "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                sha.update(chunk)
+                remaining -= len(chunk)
+        return sha
+
+
+    def _save_hash(self, sha, offset:int):
+        with _upload_hashes_lock:
+            _upload_hashes[self.image.image_id] = (offset, sha)
@@ -5,6 +5,17 @@ logger = logging.getLogger(__name__)
 # 'InstanceType' or definition refers to the entire string: 'standard.medium'.
 # 'InstanceClass' or 'class' refers to 'standard'
 # 'InstanceSize' or 'size' refers to 'medium'
+#
+# Classes other than 'standard' can request:
+#   pinned:         Each vCPU runs on a host core of its own (picked by the scheduler),
+#                   on a single NUMA cell that the memory is allocated from as well.
+#   emulator:       Where the emulator threads of the VM run. 'shared' runs them on the
+#                   vCPU cores, 'isolate' on a host core of their own.
+#   hugepage_kb:    Back the memory with hugepages of this size (2048 or 1048576).
+#   disk_profile:   Disk profile used if the launch doesn't pick one (see disk_profiles.py),
+#                   defaults to 'balanced'.
+#   interface_profile: Network interface profile used if the virtual network doesn't set one
+#                   (see interface_profiles.py), defaults to 'balanced'.
 class InstanceDefinition:
     instanceSizes = {
         "standard": {
@@ -32,7 +43,56 @@ class InstanceDefinition:
                 "cpu": 8,
                 "memory_megabytes": 8192,
             },
-        }
+        },
+        "dedicated": {
+            "small": {
+                "cpu": 2,
+                "memory_megabytes": 2048,
+            },
+            "medium": {
+                "cpu": 2,
+                "memory_megabytes": 4096,
+            },
+            "large": {
+                "cpu": 4,
+                "memory_megabytes": 8192,
+            },
+            "xlarge": {
+                "cpu": 8,
+                "memory_megabytes": 16384,
+            },
+        },
+        "hpc": {
+            "large": {
+                "cpu": 4,
+                "memory_megabytes": 8192,
+            },
+            "xlarge": {
+                "cpu": 8,
+                "memory_megabytes": 16384,
+            },
+            "2xlarge": {
+                "cpu": 16,
+                "memory_megabytes": 32768,
+            },
+        },
+    }
+
+    classOptions = {
+        "dedicated": {
+            "pinned": True,
+            "emulator": "shared",
+            "hugepage_kb": 2048,
+            "disk_profile": "performance",
+            "interface_profile": "throughput",
+        },
+        "hpc": {
+            "pinned": True,
+            "emulator": "isolate",
+            "hugepage_kb": 1048576,
+            "disk_profile": "performance",
+            "interface_profile": "throughput",
+        },
     }
 
     def __init__(self, instance_class:str = None, instance_size:str = None):
@@ -87,6 +147,27 @@ class InstanceDefinition:
     @property
     def memory(self):
         return self.instanceSizes[self._class][self._size]["memory_megabytes"]
+
+    @property
+    def pinned(self) -> bool:
+        return self.classOptions.get(self._class, {}).get("pinned", False)
+
+    @property
+    def emulator_cpus(self) -> int:
+        """Host cores needed for the emulator threads, on top of the vCPUs"""
+        return 1 if self.classOptions.get(self._class, {}).get("emulator") == "isolate" else 0
+
+    @property
+    def hugepage_kb(self) -> int:
+        return self.classOptions.get(self._class, {}).get("hugepage_kb")
+
+    @property
+    def disk_profile(self) -> str:
+        return self.classOptions.get(self._class, {}).get("disk_profile", "balanced")
+
+    @property
+    def interface_profile(self) -> str:
+        return self.classOptions.get(self._class, {}).get("interface_profile", "balanced")
     
 
 class InvalidInstanceType(Exception):
@@ -0,0 +1,47 @@
+import logging
+from dataclasses import dataclass
+from .profiles import select_profile
+
+logger = logging.getLogger(__name__)
+
+# Offloads that can be turned off per virtual network, on the host side and/or in the guest
+HOST_OFFLOADS = ["csum", "gso", "tso4", "tso6", "ecn", "ufo", "mrg_rxbuf"]
+GUEST_OFFLOADS = ["csum", "tso4", "tso6", "ecn", "ufo"]
+
+
+@dataclass
+class InterfaceProfile():
+    """Model and backend of the network interfaces of a virtual machine"""
+    name: str
+    # NIC model presented to the guest, libvirt's default (emulated) if not set
+    model: str = None
+    # Process the packets in the host kernel (vhost-net) instead of in qemu
+    vhost: bool = False
+    # One queue pair per vCPU
+    multiqueue: bool = False
+    rx_queue_size: int = None
+
+
+INTERFACE_PROFILES = {
+    # Emulated NIC, for guests without virtio drivers
+    "legacy": InterfaceProfile(
+        name="legacy",
+    ),
+    "balanced": InterfaceProfile(
+        name="balanced",
+        model="virtio",
+        vhost=True,
+    ),
+    "throughput": InterfaceProfile(
+        name="throughput",
+        model="virtio",
+        vhost=True,
+        multiqueue=True,
+        rx_queue_size=1024,
+    ),
+}
+
+
+def get_interface_profile(name:str = None, default:str = "balanced", operating_system:str = None) -> InterfaceProfile:
+    """The interface profile with the given name, or the one to use without a name (see select_profile())"""
+    return select_profile(INTERFACE_PROFILES, name, default, operating_system)
@@ -0,0 +1,178 @@
+import libvirt
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from django.utils import timezone
+from echome.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIBVIRT_URI = "qemu:///system"
+
+# Errors that mean the connection itself is broken (e.g. libvirtd was restarted),
+# rather than the call failing.
+CONNECTION_ERRORS = (
+    libvirt.VIR_ERR_SYSTEM_ERROR,
+    libvirt.VIR_ERR_RPC,
+    libvirt.VIR_ERR_INVALID_CONN,
+    libvirt.VIR_ERR_NO_CONNECT,
+)
+
+
+def is_connection_error(e:libvirt.libvirtError) -> bool:
+    return e.get_error_code() in CONNECTION_ERRORS
+
+
+class LibvirtConnectionManager:
+    """Keeps one shared libvirt connection per URI in this process, instead of opening a
+    connection for every VirtualMachineInstance. Connections are checked before they are
+    handed out and re-opened if they were closed or broke:
+
+        conn = connections.get("qemu:///system")
+
+        with connections.connection(uri) as conn:
+            ...  # A connection error in here drops the connection, the next get() reconnects
+
+    Forked processes (e.g. celery workers) open their own connections.
+
+    Connecting can take a while (e.g. to a remote host over ssh), so it's done under a lock of
+    its own for every URI: a host that is down doesn't hold up the connections to other hosts.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._status = {}
+        self._connect_locks = {}
+        self._pid = os.getpid()
+
+
+    def get(self, uri:str = DEFAULT_LIBVIRT_URI) -> libvirt.virConnect:
+        with self._lock:
+            self._check_fork()
+            conn = self._connections.get(uri)
+            connect_lock = self._connect_locks.setdefault(uri, threading.Lock())
+        if conn is not None and self._is_alive(conn):
+            return conn
+
+        with connect_lock:
+            # Another thread may have reconnected while this one waited for the lock
+            with self._lock:
+                current = self._connections.get(uri)
+            if current is not None and current is not conn and self._is_alive(current):
+                return current
+            if current is not None:
+                logger.warning(f"libvirt connection to {uri} is not alive, reconnecting")
+                self.invalidate(uri, current)
+            return self._connect(uri)
+
+
+    @contextmanager
+    def connection(self, uri:str = DEFAULT_LIBVIRT_URI):
+        conn = self.get(uri)
+        try:
+            yield conn
+        except libvirt.libvirtError as e:
+            if is_connection_error(e):
+                self.invalidate(uri, conn)
+            raise
+
+
+    def invalidate(self, uri:str, conn:libvirt.virConnect = None):
+        """Drop the connection to `uri` (if it's still `conn`), the next get() reconnects."""
+        with self._lock:
+            current = self._connections.get(uri)
+            if current is None or (conn is not None and current is not conn):
+                return
+            del self._connections[uri]
+        logger.warning(f"Dropping libvirt connection to {uri}")
+        self._close(current)
+
+
+    def close_all(self):
+        with self._lock:
+            closing = list(self._connections.values())
+            self._connections = {}
+        for conn in closing:
+            self._close(conn)
+
+
+    def health(self, uri:str = None) -> dict:
+        """Status of the connections of this process: whether they are alive, when they were
+        opened, how often they were re-opened and the round trip time of a ping."""
+        with self._lock:
+            uris = [uri] if uri else list(self._status)
+            connections = {u: (self._connections.get(u), dict(self._status.get(u, {}))) for u in uris}
+
+        health = {}
+        for u, (conn, status) in connections.items():
+            status["alive"] = conn is not None and self._is_alive(conn)
+            if status["alive"]:
+                start = time.monotonic()
+                try:
+                    conn.getLibVersion()
+                    status["ping_seconds"] = time.monotonic() - start
+                    metrics.observe("libvirt_ping_seconds", status["ping_seconds"], uri=u)
+                except libvirt.libvirtError as e:
+                    status["alive"] = False
+                    status["last_error"] = str(e)
+            health[u] = status
+        return health
+
+
+    def _connect(self, uri:str) -> libvirt.virConnect:
+        """Open a connection to `uri`, called with the URI's connect lock held"""
+        start = time.monotonic()
+        try:
+            conn = libvirt.open(uri)
+        except libvirt.libvirtError as e:
+            with self._lock:
+                status = self._status.setdefault(uri, {"connects": 0, "failures": 0})
+                status["failures"] += 1
+                status["last_error"] = str(e)
+            metrics.increment("libvirt_connect_total", uri=uri, result="error")
+            raise
+
+        duration = time.monotonic() - start
+        metrics.increment("libvirt_connect_total", uri=uri, result="success")
+        metrics.observe("libvirt_connect_seconds", duration, uri=uri)
+        logger.debug(f"Opened libvirt connection to {uri} in {duration:.3f}s")
+
+        with self._lock:
+            status = self._status.setdefault(uri, {"connects": 0, "failures": 0})
+            status["connects"] += 1
+            status["connected_since"] = timezone.now().isoformat()
+            status["connect_seconds"] = duration
+            self._connections[uri] = conn
+        return conn
+
+
+    @staticmethod
+    def _close(conn:libvirt.virConnect):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+
+    def _check_fork(self):
+        # Connections (and locks held by the parent's threads) can't be shared with a
+        # forked child, leave them to the parent
+        if os.getpid() != self._pid:
+            self._connections = {}
+            self._status = {}
+            self._connect_locks = {}
+            self._pid = os.getpid()
+
+
+    @staticmethod
+    def _is_alive(conn:libvirt.virConnect) -> bool:
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+
+connections = LibvirtConnectionManager()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import time
+from api.management_command import ManagementCommand
+from echome.metrics import summarize
+from commander.cloudlocalds import CloudLocalds
+from vmmanager.cloudinit import CloudInit
+
+class Command(ManagementCommand):
+    help = 'Benchmark creating the cloud-init seed image, compared to cloud-localds if it is installed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        base_dir = tempfile.mkdtemp()
+        try:
+            cloudinit = CloudInit(base_dir=base_dir)
+            cloudinit.generate_userdata_config(
+                public_keys=["ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBenchmarkKeyBenchmarkKeyBenchmarkKey0 benchmark"],
+                run_command=["echo hello"],
+            )
+            cloudinit.generate_metadata("vm-00000000", ip_addr="10.0.0.5")
+
+            self.report("in-process", self.time(iterations, cloudinit.create_iso))
+
+            if shutil.which(CloudLocalds.base_command):
+                self.report("cloud-localds", self.time(iterations, lambda: self.cloud_localds(cloudinit, base_dir)))
+            else:
+                self.stdout.write(f'{CloudLocalds.base_command} is not installed, skipping')
+        finally:
+            shutil.rmtree(base_dir)
+
+    def cloud_localds(self, cloudinit:CloudInit, base_dir:str):
+        # What creating the image used to take: writing the configs to files and running cloud-localds
+        for name, contents in [("user-data", cloudinit.userdata_config), ("meta-data", cloudinit.metadata)]:
+            with open(os.path.join(base_dir, name), "w") as f:
+                f.write(contents)
+        CloudLocalds().create_image(
+            user_data_file=os.path.join(base_dir, "user-data"),
+            output=os.path.join(base_dir, "cloudinit-localds.iso"),
+            meta_data_file=os.path.join(base_dir, "meta-data"),
+        )
+
+    def time(self, iterations:int, func) -> list:
+        durations = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start)
+        return durations
+
+    def report(self, name:str, durations:list):
+        summary = summarize(durations)
+        self.stdout.write(
+            f'{name}: {summary["count"]} images, '
+            f'mean {summary["sum"] / summary["count"] * 1000:.2f} ms, '
+            f'p50 {summary["p50"] * 1000:.2f} ms, '
+            f'p95 {summary["p95"] * 1000:.2f} ms, '
+            f'max {summary["max"] * 1000:.2f} ms'
+        )
@@ -0,0 +1,25 @@
+from api.management_command import ManagementCommand
+from vmmanager.models import DiskPool
+from vmmanager.image_manager import ImageManager
+from vmmanager.disk_pool import DiskPoolManager
+
+class Command(ManagementCommand):
+    help = 'Configure the number of ready boot disks to keep for an image and disk size'
+
+    def handle(self, *args, **options):
+        image_id = self.ask_for_input(DiskPool._meta.get_field('image').target_field)
+        disk_size = self.ask_for_input(DiskPool._meta.get_field('disk_size'))
+
+        # A depth of 0 is valid (it empties the pool), so don't use ask_for_input()
+        depth_field = DiskPool._meta.get_field('depth')
+        depth = None
+        while depth is None:
+            depth = self.get_input_data(depth_field, self.get_input_message(depth_field))
+
+        try:
+            image = ImageManager(image_id).image
+            pool = DiskPoolManager().configure_pool(image, disk_size, depth)
+            self.stdout.write(self.style.SUCCESS(f'Successfully configured disk pool {pool} with depth {pool.depth}'))
+        except Exception as e:
+            self.stdout.write(str(e))
+            self.stderr.write('Error: There was an error when attempting to configure the disk pool.')
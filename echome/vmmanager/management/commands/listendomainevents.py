@@ -0,0 +1,17 @@
+import signal
+from api.management_command import ManagementCommand
+from vmmanager.domain_events import DomainEventListener
+
+class Command(ManagementCommand):
+    help = 'Keep the states of the virtual machines up to date from libvirt domain events (runs until stopped)'
+
+    def handle(self, *args, **options):
+        listener = DomainEventListener()
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping')
+            listener.stop()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        listener.run()
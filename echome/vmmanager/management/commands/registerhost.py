@@ -12,10 +12,16 @@ class Command(ManagementCommand):
 
         hostname = HostMachine._meta.get_field('name')
         ip = HostMachine._meta.get_field('ip')
+        libvirt_uri = HostMachine._meta.get_field('libvirt_uri')
         
         try:
             newhost.name = self.ask_for_input(hostname)
             newhost.ip = self.ask_for_input(ip)
+            newhost.libvirt_uri = self.get_input_data(
+                libvirt_uri,
+                self.get_input_message(libvirt_uri, libvirt_uri.default),
+                libvirt_uri.default
+            )
             newhost.save()
             self.stdout.write(self.style.SUCCESS('Successfully registered host'))
         except Exception as e:
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from echome.config import ecHomeConfig
+from echome.metrics import metrics
+from .models import InstanceSeed, VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+METADATA_API_URL = ecHomeConfig.EcHome().metadata_api_url
+METADATA_API_PORT = ecHomeConfig.EcHome().metadata_api_port
+
+# Number of seeds kept in memory by the metadata service
+SEED_CACHE_SIZE = 4096
+# Seconds a seed is served from memory before it's read from the database again
+SEED_CACHE_TTL = 300
+
+# Files cloud-init requests from a NoCloud-net seed URL
+SEED_FILES = ["meta-data", "user-data", "network-config", "vendor-data"]
+
+
+def is_configured() -> bool:
+    return bool(METADATA_API_URL)
+
+
+def get_seed_url(token:str) -> str:
+    """NoCloud-net seed URL of a virtual machine"""
+    base = f"{METADATA_API_URL.rstrip('/')}:{METADATA_API_PORT}" if METADATA_API_PORT else METADATA_API_URL.rstrip("/")
+    return f"{base}/{token}/"
+
+
+class SeedCache:
+    """In-memory cache of the seeds of the virtual machines by token. Seeds are added when they
+    are published at launch, and read from the database on a miss (e.g. the seed was published
+    by a worker)."""
+
+    def __init__(self, max_size:int = SEED_CACHE_SIZE, ttl:int = SEED_CACHE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def put(self, seed:InstanceSeed) -> dict:
+        files = {
+            "meta-data": seed.meta_data,
+            "user-data": seed.user_data,
+            "network-config": seed.network_config,
+            "vendor-data": "",
+        }
+        with self._lock:
+            self._entries[seed.token] = (files, time.monotonic() + self.ttl)
+            self._entries.move_to_end(seed.token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return files
+
+
+    def get_by_token(self, token:str) -> dict:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(token)
+                metrics.increment("metadata_seed_cache_total", result="hit")
+                return entry[0]
+
+        metrics.increment("metadata_seed_cache_total", result="miss")
+        seed = InstanceSeed.objects.filter(
+            token=token,
+            virtual_machine__state__in=[VirtualMachine.State.CREATING, VirtualMachine.State.AVAILABLE],
+        ).first()
+        return self.put(seed) if seed else None
+
+
+    def load(self):
+        """Load the seeds of all of the virtual machines that are running or being created"""
+        seeds = InstanceSeed.objects.filter(
+            virtual_machine__state__in=[VirtualMachine.State.CREATING, VirtualMachine.State.AVAILABLE]
+        ).order_by("created")[:self.max_size]
+        for seed in seeds:
+            self.put(seed)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+seed_cache = SeedCache()
+
+
+class MetadataService:
+    """WSGI application serving the NoCloud-net seeds of the virtual machines:
+
+        GET /<token>/meta-data      Seed of the virtual machine with this token (the seed URL)
+
+    for meta-data, user-data, network-config and vendor-data. Seeds are only served by token:
+    IP addresses are reused after a virtual machine is terminated. Run it with the uwsgi config
+    in system/etc/services or with `gunicorn wsgi_metadata_service_entry:metadata_app`.
+    """
+
+    def __init__(self, cache:SeedCache = None) -> None:
+        self.cache = cache if cache else seed_cache
+
+
+    def __call__(self, environ, start_response):
+        if environ.get("REQUEST_METHOD", "GET") not in ("GET", "HEAD"):
+            return self._respond(start_response, "405 Method Not Allowed")
+
+        parts = environ.get("PATH_INFO", "").strip("/").split("/")
+        if len(parts) != 2 or parts[1] not in SEED_FILES:
+            return self._respond(start_response, "404 Not Found")
+        token, name = parts
+
+        try:
+            files = self.cache.get_by_token(token)
+        except Exception as e:
+            logger.exception(e)
+            return self._respond(start_response, "500 Internal Server Error")
+
+        found = files is not None and files.get(name) is not None
+        metrics.increment("metadata_requests_total", file=name, result="found" if found else "not_found")
+        if not found:
+            return self._respond(start_response, "404 Not Found")
+
+        body = files[name].encode("utf-8")
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return self._respond(start_response, "200 OK", content_length=len(body))
+        return self._respond(start_response, "200 OK", body)
+
+
+    def _respond(self, start_response, status:str, body:bytes = b"", content_length:int = None):
+        start_response(status, [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(content_length if content_length is not None else len(body))),
+        ])
+        return [body]
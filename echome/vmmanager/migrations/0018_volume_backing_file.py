@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0017_alter_image_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='volume',
+            name='backing_file',
+            field=models.CharField(max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0018_volume_backing_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiskPool',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('disk_size', models.CharField(max_length=20)),
+                ('depth', models.PositiveIntegerField(default=1)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vmmanager.image', to_field='image_id')),
+            ],
+            options={
+                'unique_together': {('image', 'disk_size')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PooledDisk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('path', models.CharField(max_length=200)),
+                ('size', models.BigIntegerField(null=True)),
+                ('format', models.CharField(max_length=12, null=True)),
+                ('backing_file', models.CharField(max_length=200, null=True)),
+                ('pool', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disks', to='vmmanager.diskpool')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0019_diskpool_pooleddisk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=64, unique=True)),
+                ('path', models.CharField(max_length=200)),
+                ('size', models.BigIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='vmmanager.imageblob', to_field='digest'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0001_initial'),
+        ('vmmanager', '0020_auto_20261018_0303'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(db_index=True, max_length=20, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('resource_id', models.CharField(max_length=40, null=True)),
+                ('stage', models.CharField(max_length=40, null=True)),
+                ('stages', models.JSONField(default=list)),
+                ('error', models.TextField(null=True)),
+                ('job_type', models.CharField(choices=[('CREATE_VM', 'Create Virtual Machine')], max_length=24)),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')], default='PENDING', max_length=16)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='identity.account', to_field='account_id')),
+            ],
+        ),
+    ]
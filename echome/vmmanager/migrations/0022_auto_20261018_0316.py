@@ -0,0 +1,33 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0021_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hostmachine',
+            name='cpu_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='hostmachine',
+            name='libvirt_uri',
+            field=models.CharField(default='qemu:///system', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='hostmachine',
+            name='memory_mb',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='hostmachine',
+            name='storage_bytes',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0022_auto_20261018_0316'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostSample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('cpu_count', models.IntegerField()),
+                ('memory_mb', models.BigIntegerField()),
+                ('free_memory_mb', models.BigIntegerField()),
+                ('storage_bytes', models.BigIntegerField(null=True)),
+                ('free_storage_bytes', models.BigIntegerField(null=True)),
+                ('numa_cells', models.JSONField(default=list)),
+                ('host', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='samples', to='vmmanager.hostmachine', to_field='host_id')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
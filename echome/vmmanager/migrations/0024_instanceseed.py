@@ -0,0 +1,27 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0023_hostsample'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceSeed',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(db_index=True, max_length=40, unique=True)),
+                ('ip', models.GenericIPAddressField(db_index=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user_data', models.TextField()),
+                ('meta_data', models.TextField()),
+                ('network_config', models.TextField(null=True)),
+                ('virtual_machine', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='seed', to='vmmanager.virtualmachine', to_field='instance_id')),
+            ],
+        ),
+    ]
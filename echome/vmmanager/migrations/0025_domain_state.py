@@ -0,0 +1,62 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0002_account_placement_strategy'),
+        ('vmmanager', '0024_instanceseed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hostmachine',
+            name='events_heartbeat',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='domain_state',
+            field=models.CharField(max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='domain_state_code',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='domain_state_reason',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='guest_agent_connected',
+            field=models.BooleanField(null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='state_changed',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name='DomainEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instance_id', models.CharField(db_index=True, max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('event', models.CharField(max_length=20)),
+                ('detail', models.CharField(max_length=40, null=True)),
+                ('state', models.CharField(max_length=16, null=True)),
+                ('unexpected', models.BooleanField(default=False)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='identity.account', to_field='account_id')),
+                ('host', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='vmmanager.hostmachine', to_field='host_id')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0025_domain_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='results',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='start_order',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='job_type',
+            field=models.CharField(choices=[('CREATE_VM', 'Create Virtual Machine'), ('POWER_ACTION', 'Start or Stop Virtual Machines')], max_length=24),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0026_power_actions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='cpu_pinning',
+            field=models.JSONField(default=dict),
+        ),
+    ]
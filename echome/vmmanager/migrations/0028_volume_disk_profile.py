@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0027_cpu_pinning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='volume',
+            name='disk_profile',
+            field=models.CharField(max_length=20, null=True),
+        ),
+    ]
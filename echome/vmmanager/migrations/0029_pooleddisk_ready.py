@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0028_volume_disk_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pooleddisk',
+            name='ready',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.6 on 2026-10-18 03:55
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0029_pooleddisk_ready'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='instanceseed',
+            name='ip',
+        ),
+    ]
@@ -1,5 +1,9 @@
 import logging
+import os
+import secrets
+from contextlib import contextmanager
 from django.db import models
+from django.utils import timezone
 from echome.exceptions import AttemptedOverrideOfImmutableIdException
 from echome.id_gen import IdGenerator
 from commander.qemuimg import QemuImg
@@ -14,6 +18,17 @@ class HostMachine(models.Model):
     created = models.DateTimeField(auto_now_add=True, null=False)
     metadata = models.JSONField(default=dict)
     tags = models.JSONField(default=dict)
+    # Connection used to manage the virtual machines on this host,
+    # e.g. qemu+ssh://root@hypervisor-2/system for a remote host
+    libvirt_uri = models.CharField(max_length=200, default="qemu:///system")
+    # Capacity that can be allocated to virtual machines. Unknown (null)
+    # capacity is not taken into account when placing virtual machines.
+    cpu_count = models.IntegerField(null=True)
+    memory_mb = models.BigIntegerField(null=True)
+    storage_bytes = models.BigIntegerField(null=True)
+    # Last heartbeat of the domain event listener watching this host. While it's
+    # recent, the cached domain states of the virtual machines are up to date.
+    events_heartbeat = models.DateTimeField(null=True)
 
     def generate_id(self):
         if self.host_id is None or self.host_id == "":
@@ -26,12 +41,32 @@ class HostMachine(models.Model):
             logger.error("Attempted to get cpu info for HostMachine that does not have a row in database.")
             raise Exception
         
-        return 
+        # Set by the host inventory, see host_inventory.py
+        return self.metadata.get("inventory", {}).get("cpu_model")
 
     def __str__(self) -> str:
         return self.name
 
 
+class HostSample(models.Model):
+    """Snapshot of the resources of a host, sampled periodically by the host inventory"""
+    host = models.ForeignKey(HostMachine, on_delete=models.CASCADE, to_field="host_id", related_name="samples")
+    created = models.DateTimeField(auto_now_add=True, null=False, db_index=True)
+    cpu_count = models.IntegerField()
+    memory_mb = models.BigIntegerField()
+    free_memory_mb = models.BigIntegerField()
+    storage_bytes = models.BigIntegerField(null=True)
+    free_storage_bytes = models.BigIntegerField(null=True)
+    # Free memory per NUMA cell: [{"id": 0, "memory_mb": ..., "free_memory_mb": ..., "cpus": ...}]
+    numa_cells = models.JSONField(default=list)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self) -> str:
+        return f"{self.host_id} at {self.created}"
+
+
 class VirtualMachine(models.Model):
     instance_id = models.CharField(max_length=20, unique=True, db_index=True)
     account = models.ForeignKey("identity.Account", on_delete=models.CASCADE, to_field="account_id")
@@ -62,6 +97,23 @@ class VirtualMachine(models.Model):
         default=State.CREATING,
     )
 
+    # State of the libvirt domain, kept up to date by the domain event listener
+    # (see domain_events.py). Null while the domain is not defined.
+    domain_state = models.CharField(max_length=16, null=True)
+    domain_state_code = models.IntegerField(null=True)
+    domain_state_reason = models.CharField(max_length=40, null=True)
+    # Last transition of domain_state
+    state_changed = models.DateTimeField(null=True)
+    guest_agent_connected = models.BooleanField(null=True)
+    # Bulk power actions start virtual machines with a lower start order first,
+    # and stop them in the reverse order
+    start_order = models.IntegerField(default=0)
+    # Host cores and NUMA cell picked by the scheduler for instance types with pinned
+    # vCPUs: {"numa_node": 0, "vcpus": [2, 3], "emulator": [2, 3], "memory_mb": 4096,
+    # "hugepage_kb": 2048}. Instance types that aren't pinned float on the host cores that
+    # are neither pinned nor reserved: {"cpuset": [1, 4, 5]}, empty if the topology is unknown.
+    cpu_pinning = models.JSONField(default=dict)
+
 
     def generate_id(self):
         if self.instance_id is None or self.instance_id == "":
@@ -79,6 +131,140 @@ class VirtualMachine(models.Model):
         return self.instance_id
 
 
+# cloud-init NoCloud seed of a virtual machine, served by the metadata service.
+# The token is part of the seed URL in the SMBIOS serial number of the virtual
+# machine, and keeps other virtual machines from reading its user-data.
+class InstanceSeed(models.Model):
+    virtual_machine = models.OneToOneField(VirtualMachine, on_delete=models.CASCADE, to_field="instance_id", related_name="seed")
+    token = models.CharField(max_length=40, unique=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    user_data = models.TextField()
+    meta_data = models.TextField()
+    network_config = models.TextField(null=True)
+
+    def generate_token(self):
+        self.token = secrets.token_hex(16)
+
+    def __str__(self) -> str:
+        return self.virtual_machine_id
+
+
+# History of the libvirt events of the virtual machines (lifecycle, reboot and guest
+# agent events), recorded by the domain event listener. Kept after the virtual
+# machine is terminated, so crashes and unexpected shutoffs can be looked up later.
+class DomainEvent(models.Model):
+    instance_id = models.CharField(max_length=20, db_index=True)
+    account = models.ForeignKey("identity.Account", on_delete=models.CASCADE, to_field="account_id")
+    host = models.ForeignKey(HostMachine, on_delete=models.SET_NULL, to_field="host_id", null=True)
+    created = models.DateTimeField(auto_now_add=True, null=False, db_index=True)
+    # e.g. "stopped", "reboot", "agent"
+    event = models.CharField(max_length=20)
+    # e.g. "crashed" for a stopped event
+    detail = models.CharField(max_length=40, null=True)
+    # Domain state after the event
+    state = models.CharField(max_length=16, null=True)
+    # Not requested through libvirt, e.g. a crash or the guest powering itself off
+    unexpected = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self) -> str:
+        return f"{self.instance_id} {self.event} at {self.created}"
+
+
+# Tracks the progress of an asynchronous operation (e.g. creating a virtual machine)
+# that is processed by the workers. Each stage of the operation is recorded with
+# its start and end time.
+class Job(models.Model):
+    job_id = models.CharField(max_length=20, unique=True, db_index=True)
+    account = models.ForeignKey("identity.Account", on_delete=models.CASCADE, to_field="account_id")
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    last_modified = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True)
+    # ID of the object the job is working on (e.g. the instance ID)
+    resource_id = models.CharField(max_length=40, null=True)
+    stage = models.CharField(max_length=40, null=True)
+    stages = models.JSONField(default=list)
+    error = models.TextField(null=True)
+    # Result per object for jobs working on many objects (e.g. per instance ID)
+    results = models.JSONField(default=dict)
+
+    class JobType(models.TextChoices):
+        CREATE_VM = 'CREATE_VM', 'Create Virtual Machine'
+        POWER_ACTION = 'POWER_ACTION', 'Start or Stop Virtual Machines'
+
+    job_type = models.CharField(
+        max_length=24,
+        choices=JobType.choices,
+    )
+
+    class State(models.TextChoices):
+        PENDING = 'PENDING', 'Pending'
+        RUNNING = 'RUNNING', 'Running'
+        SUCCEEDED = 'SUCCEEDED', 'Succeeded'
+        FAILED = 'FAILED', 'Failed'
+
+    state = models.CharField(
+        max_length=16,
+        choices=State.choices,
+        default=State.PENDING,
+    )
+
+
+    def generate_id(self):
+        if self.job_id is None or self.job_id == "":
+            self.job_id = IdGenerator.generate("job", 12)
+        else:
+            raise AttemptedOverrideOfImmutableIdException
+
+
+    def start(self):
+        self.state = self.State.RUNNING
+        self.save()
+
+
+    @contextmanager
+    def track_stage(self, name:str):
+        """Record the start and end time of a stage of the job"""
+        record = {"name": name, "started": timezone.now().isoformat()}
+        self.stage = name
+        self.stages.append(record)
+        self.save()
+
+        start = timezone.now()
+        try:
+            yield record
+        except Exception:
+            record["state"] = "failed"
+            raise
+        else:
+            record["state"] = "finished"
+        finally:
+            finished = timezone.now()
+            record["finished"] = finished.isoformat()
+            record["duration"] = (finished - start).total_seconds()
+            self.save()
+
+
+    def succeed(self):
+        self.state = self.State.SUCCEEDED
+        self.stage = None
+        self.finished = timezone.now()
+        self.save()
+
+
+    def fail(self, error:str):
+        self.state = self.State.FAILED
+        self.error = error
+        self.finished = timezone.now()
+        self.save()
+
+
+    def __str__(self) -> str:
+        return self.job_id
+
+
 class InstanceDefinition(models.Model):
     instance_definition_id = models.CharField(max_length=20, unique=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True, null=False)
@@ -100,6 +286,30 @@ class OperatingSystem(models.TextChoices):
     OTHER = 'OTHER', 'Other'
     NONE = 'NONE', 'None'
 
+# Content-addressed storage for image files. Identical images (by sha256)
+# share a single read-only file in the image store. A blob is referenced
+# by the images stored in it and by the linked clones/pooled disks that
+# use it as their backing file.
+class ImageBlob(models.Model):
+    digest = models.CharField(max_length=64, unique=True, db_index=True)
+    path = models.CharField(max_length=200)
+    size = models.BigIntegerField()
+    created = models.DateTimeField(auto_now_add=True, null=False)
+
+
+    @property
+    def reference_count(self) -> int:
+        """Number of images, volumes and pooled disks that depend on this blob."""
+        images = Image.objects.filter(blob=self).exclude(state=Image.State.DELETED).count()
+        volumes = Volume.objects.filter(backing_file=self.path).exclude(state=Volume.State.DELETED).count()
+        pooled_disks = PooledDisk.objects.filter(backing_file=self.path).count()
+        return images + volumes + pooled_disks
+
+
+    def __str__(self) -> str:
+        return self.digest
+
+
 # All images (disk images) derive from this model.
 # There's currently only two types:
 # GuestImage (gmi-): For ALL accounts/users on the server
@@ -119,6 +329,7 @@ class Image(models.Model):
     last_modified = models.DateTimeField(auto_now=True)
     account = models.ForeignKey("identity.Account", on_delete=models.CASCADE, to_field="account_id", null=True)
     image_path = models.CharField(max_length=200)
+    blob = models.ForeignKey(ImageBlob, on_delete=models.SET_NULL, to_field="digest", null=True)
     name = models.CharField(max_length=60)
     description = models.CharField(max_length=100)
 
@@ -159,6 +370,15 @@ class Image(models.Model):
         return True if self.state == Image.State.AVAILABLE and self.deactivated is False else False
 
 
+    @property
+    def is_in_use(self) -> bool:
+        """Helper property to determine if any volumes are still backed by this image. Images that are
+        in use by linked clones cannot be deleted."""
+        return Volume.objects.filter(parent_image=self.image_id, backing_file__isnull=False) \
+            .exclude(state=Volume.State.DELETED) \
+            .exists()
+
+
     @property
     def is_ready_for_kubernetes(self) -> bool:
         """Helper property to determine if this image can be used for Kubernetes. This must be an image
@@ -186,11 +406,11 @@ class Image(models.Model):
         obj = QemuImg().info(self.image_path)
         logger.debug(obj)
 
-        self.metadata = {
+        self.metadata.update({
             "format": obj["format"],
             "actual-size": obj["actual-size"],
             "virtual-size": obj["virtual-size"]
-        }
+        })
 
 
     def __str__(self) -> str:
@@ -206,10 +426,14 @@ class Volume(models.Model):
     virtual_machine = models.ForeignKey(VirtualMachine, on_delete=models.SET_NULL, to_field="instance_id", null=True)
     size = models.BigIntegerField(null=True)
     parent_image = models.CharField(max_length=60, null=True)
+    # Set when the volume is a copy-on-write overlay (linked clone) of the parent image
+    backing_file = models.CharField(max_length=200, null=True)
     format = models.CharField(max_length=12, null=True)
     metadata = models.JSONField(default=dict)
     path = models.CharField(max_length=200)
     tags = models.JSONField(default=dict)
+    # Disk profile the volume is attached with (see disk_profiles.py)
+    disk_profile = models.CharField(max_length=20, null=True)
 
     class State(models.TextChoices):
         CREATING = 'CREATING', 'Creating'
@@ -249,11 +473,64 @@ class Volume(models.Model):
         self.size = details["virtual-size"]
 
 
-    def new_volume_from_image(self, image:Image):
+    @property
+    def is_linked_clone(self) -> bool:
+        """Helper property to determine if this volume depends on a backing image."""
+        return self.backing_file is not None
+
+
+    def new_volume_from_image(self, image:Image, linked:bool = False):
         self.parent_image = image.image_id
         self.format = image.metadata["format"]
         self.operating_system = image.operating_system
 
+        if linked:
+            self.backing_file = image.image_path
+            self.format = "qcow2"
+
 
     def __str__(self) -> str:
         return self.volume_id
+
+
+# Warm pool of pre-provisioned boot disks, keyed by image and disk size.
+# DiskPool defines how many ready disks to keep around for an image/size
+# combination, PooledDisk is a single ready disk waiting to be claimed.
+class DiskPool(models.Model):
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, to_field="image_id")
+    disk_size = models.CharField(max_length=20)
+    depth = models.PositiveIntegerField(default=1)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [["image", "disk_size"]]
+
+
+    def __str__(self) -> str:
+        return f"{self.image_id}:{self.disk_size}"
+
+
+class PooledDisk(models.Model):
+    pool = models.ForeignKey(DiskPool, on_delete=models.CASCADE, related_name="disks")
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    path = models.CharField(max_length=200)
+    size = models.BigIntegerField(null=True)
+    format = models.CharField(max_length=12, null=True)
+    backing_file = models.CharField(max_length=200, null=True)
+    # False while the disk is being provisioned, the row reserves its slot in the pool
+    ready = models.BooleanField(default=True)
+
+
+    def discard(self):
+        """Remove the pooled disk file and its row."""
+        logger.debug(f"Discarding pooled disk: {self.path}")
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.delete()
+
+
+    def __str__(self) -> str:
+        return self.path
@@ -0,0 +1,149 @@
+import libvirt
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from itertools import chain, groupby, zip_longest
+from typing import Dict, List
+from echome.config import ecHomeConfig
+from echome.metrics import metrics
+from .models import Job, VirtualMachine
+from .libvirt_connection import connections, DEFAULT_LIBVIRT_URI
+from .shutdown import shutdown_coordinator, ALREADY_STOPPED
+
+logger = logging.getLogger(__name__)
+
+# Virtual machines started or stopped at the same time by a bulk action
+BULK_ACTION_CONCURRENCY = int(ecHomeConfig.VirtualMachines().bulk_action_concurrency)
+# Virtual machines started at the same time on one host
+HOST_START_CONCURRENCY = int(ecHomeConfig.VirtualMachines().host_start_concurrency)
+# Seconds a start keeps its slot on the host after the domain started, to let it boot
+HOST_START_DELAY = float(ecHomeConfig.VirtualMachines().host_start_delay)
+
+# Most virtual machines in a single bulk action
+MAX_BULK_ACTION_COUNT = 1000
+
+ACTIONS = ["start", "stop"]
+
+
+class BulkPowerAction:
+    """Starts or stops many virtual machines with a bounded pool of threads on the shared
+    libvirt connections, and records the result of each one in the job:
+
+        BulkPowerAction("start", job).run(vms)
+        # {"vm-1a2b3c4d": {"result": "started"}, "vm-5e6f7a8b": {"result": "error", "error": "..."}}
+
+    Virtual machines are started in the order of their start_order (lowest first), one group
+    after the other, and stopped in the reverse order. At most HOST_START_CONCURRENCY virtual
+    machines are started on a host at a time, so a cold boot of a host doesn't start all of
+    them at once. Stops are handed to the shutdown coordinator and waited on all at once.
+
+    Load the virtual machines with their host (select_related), the threads don't query them.
+    """
+
+    def __init__(self, action:str, job:Job = None, concurrency:int = BULK_ACTION_CONCURRENCY,
+            host_concurrency:int = HOST_START_CONCURRENCY, host_delay:float = HOST_START_DELAY) -> None:
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action: {action}")
+        self.action = action
+        self.job = job
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.host_delay = host_delay
+        self.results = {}
+        self._lock = threading.Lock()
+        self._host_slots = {}
+
+
+    def run(self, vms:List[VirtualMachine]) -> Dict[str, dict]:
+        reverse = self.action == "stop"
+        vms = sorted(vms, key=lambda vm: vm.start_order, reverse=reverse)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="power-action") as pool:
+            for order, group in groupby(vms, key=lambda vm: vm.start_order):
+                group = list(group)
+                if self.job:
+                    with self.job.track_stage(f"{self.action}_order_{order}"):
+                        self._run_group(pool, group)
+                else:
+                    self._run_group(pool, group)
+        return self.results
+
+
+    def _run_group(self, pool:ThreadPoolExecutor, vms:List[VirtualMachine]):
+        func = self._start if self.action == "start" else self._request_stop
+        futures = {pool.submit(func, vm): vm for vm in self._interleave_hosts(vms)}
+        shutdowns = {}
+        for future in as_completed(futures):
+            vm = futures[future]
+            try:
+                result = future.result()
+            except libvirt.libvirtError as e:
+                logger.error(f"Could not {self.action} {vm.instance_id}: {e}")
+                self._record(vm, "error", str(e))
+                continue
+            if isinstance(result, Future):
+                shutdowns[vm.instance_id] = (vm, result)
+            else:
+                self._record(vm, result)
+
+        # The whole group shuts down at the same time
+        for vm, shutdown in shutdowns.values():
+            try:
+                self._record(vm, shutdown.result())
+            except Exception as e:
+                logger.error(f"Could not stop {vm.instance_id}: {e}")
+                self._record(vm, "error", str(e))
+
+
+    def _start(self, vm:VirtualMachine) -> str:
+        uri = vm.host.libvirt_uri if vm.host else DEFAULT_LIBVIRT_URI
+        with self._host_slot(uri):
+            with connections.connection(uri) as conn:
+                domain = conn.lookupByName(vm.instance_id)
+                if domain.isActive():
+                    return "already_running"
+                domain.create()
+                domain.setAutostart(1)
+            logger.debug(f"Started {vm.instance_id}")
+            if self.host_delay:
+                # Keep the slot while the guest boots
+                time.sleep(self.host_delay)
+        return "started"
+
+
+    def _request_stop(self, vm:VirtualMachine):
+        """Returns the future of the shutdown, or the result if there's nothing to wait for"""
+        uri = vm.host.libvirt_uri if vm.host else DEFAULT_LIBVIRT_URI
+        with connections.connection(uri) as conn:
+            domain = conn.lookupByName(vm.instance_id)
+            if not domain.isActive():
+                return ALREADY_STOPPED
+            domain.setAutostart(0)
+        return shutdown_coordinator.shutdown(vm.instance_id, uri)
+
+
+    @staticmethod
+    def _interleave_hosts(vms:List[VirtualMachine]) -> List[VirtualMachine]:
+        """Take turns between the hosts, so the threads waiting for a slot on a busy host
+        don't keep the other hosts waiting"""
+        hosts = {}
+        for vm in vms:
+            hosts.setdefault(vm.host_id, []).append(vm)
+        return [vm for vm in chain.from_iterable(zip_longest(*hosts.values())) if vm is not None]
+
+
+    def _host_slot(self, uri:str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if uri not in self._host_slots:
+                self._host_slots[uri] = threading.BoundedSemaphore(self.host_concurrency)
+            return self._host_slots[uri]
+
+
+    def _record(self, vm:VirtualMachine, result:str, error:str = None):
+        metrics.increment("vm_power_action_total", action=self.action, result=result)
+        with self._lock:
+            self.results[vm.instance_id] = {"result": result, "error": error} if error else {"result": result}
+            if self.job:
+                self.job.results = self.results
+                Job.objects.filter(pk=self.job.pk).update(results=self.results)
@@ -0,0 +1,23 @@
+from typing import Dict, TypeVar
+from .models import OperatingSystem
+
+Profile = TypeVar("Profile")
+
+# Name of the profiles with emulated devices, for guests without virtio drivers
+LEGACY_PROFILE = "legacy"
+
+
+def select_profile(profiles:Dict[str, Profile], name:str = None, default:str = "balanced",
+        operating_system:str = None) -> Profile:
+    """Pick a device profile (see disk_profiles.py and interface_profiles.py): the profile with the
+    given name. Without one, the default profile (usually the instance type's), or the legacy
+    profile for Windows guests as their images don't ship with virtio drivers.
+
+    Raises:
+        KeyError: If there is no profile with the name.
+    """
+    if name:
+        return profiles[name]
+    if operating_system == OperatingSystem.WINDOWS:
+        return profiles[LEGACY_PROFILE]
+    return profiles[default]
@@ -0,0 +1,422 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+from django.db import transaction
+from django.db.models import Count, Sum
+from echome.config import ecHomeConfig
+from commander.qemuimg import size_to_bytes
+from identity.models import Account
+from .instance_definitions import InstanceDefinition, InvalidInstanceType
+from .models import HostMachine, VirtualMachine, Volume
+from .exceptions import PlacementError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STRATEGY = ecHomeConfig.VirtualMachines().placement_strategy
+
+# Host cores that are never picked for pinned virtual machines
+RESERVED_HOST_CPUS = {
+    int(cpu) for cpu in str(ecHomeConfig.VirtualMachines().reserved_host_cpus).split(",") if cpu.strip()
+}
+
+# Seconds before the capacity index is reloaded from the database to pick up
+# changes made by other processes (e.g. virtual machines terminated by a worker)
+REFRESH_INTERVAL = 30
+
+# Score penalty per launch that is in progress on a host, so concurrent launches
+# don't all compete for the disk I/O of the same host.
+IN_FLIGHT_PENALTY = 0.05
+
+
+@dataclass
+class ResourceRequest:
+    cpu: int
+    memory_mb: int
+    storage_bytes: int
+    # Pin the vCPUs (and emulator_cpus extra cores) to host cores of a single NUMA cell
+    pinned: bool = False
+    emulator_cpus: int = 0
+    hugepage_kb: int = None
+
+    @classmethod
+    def for_instance(cls, instance_def:InstanceDefinition, disk_size:str):
+        return cls(
+            cpu=instance_def.get_cpu(),
+            memory_mb=instance_def.get_memory(),
+            storage_bytes=size_to_bytes(disk_size),
+            pinned=instance_def.pinned,
+            emulator_cpus=instance_def.emulator_cpus,
+            hugepage_kb=instance_def.hugepage_kb,
+        )
+
+    @property
+    def host_cpus(self) -> int:
+        """Host cores committed to the request, the vCPUs and the isolated emulator cores"""
+        return self.cpu + self.emulator_cpus
+
+    @property
+    def hugepages(self) -> int:
+        """Number of hugepages needed to back the memory"""
+        return -(-self.memory_mb * 1024 // self.hugepage_kb) if self.hugepage_kb else 0
+
+
+@dataclass
+class HostCapacity:
+    host_id: str
+    cpu_total: int = None
+    memory_total_mb: int = None
+    storage_total: int = None
+    cpu_committed: int = 0
+    memory_committed_mb: int = 0
+    storage_committed: int = 0
+    vm_count: int = 0
+    in_flight: int = 0
+    # NUMA cells of the host from the inventory: id, memory_mb, cpu_ids and hugepages
+    cells: list = None
+    # Host cores, memory per cell and hugepages per (cell, page size) taken by pinned virtual machines
+    pinned_cpus: set = field(default_factory=set)
+    pinned_memory_mb: dict = field(default_factory=dict)
+    pinned_hugepages: dict = field(default_factory=dict)
+
+
+    def fits(self, request:ResourceRequest) -> bool:
+        if request.pinned and self.pick_cpus(request) is None:
+            return False
+        return all(
+            total is None or committed + requested <= total
+            for total, committed, requested in self._dimensions(request)
+        )
+
+
+    def pick_cpus(self, request:ResourceRequest) -> dict:
+        """Pick free host cores for a pinned request, all on one NUMA cell that also has the memory
+        (and hugepages) for it. Uses the cell with the fewest free cores that fits, keeping the larger
+        ones for larger virtual machines. Returns None if no cell fits or the topology is unknown."""
+        needed = request.cpu + request.emulator_cpus
+        best = None
+        for cell in self.cells or []:
+            free = [cpu for cpu in cell["cpu_ids"] if cpu not in self.pinned_cpus and cpu not in RESERVED_HOST_CPUS]
+            if len(free) < needed:
+                continue
+            if cell["memory_mb"] - self.pinned_memory_mb.get(cell["id"], 0) < request.memory_mb:
+                continue
+            if request.hugepage_kb:
+                page_size = str(request.hugepage_kb)
+                available = cell.get("hugepages", {}).get(page_size, 0) - self.pinned_hugepages.get((cell["id"], page_size), 0)
+                if available < request.hugepages:
+                    continue
+            if best is None or len(free) < len(best[1]):
+                best = (cell, free)
+
+        if best is None:
+            return None
+        cell, free = best
+        vcpus = free[:request.cpu]
+        return {
+            "numa_node": cell["id"],
+            "vcpus": vcpus,
+            # Isolated emulator threads get cores of their own, otherwise they share the vCPU cores
+            "emulator": free[request.cpu:needed] if request.emulator_cpus else vcpus,
+            "memory_mb": request.memory_mb,
+            "hugepage_kb": request.hugepage_kb,
+        }
+
+
+    def shared_cpus(self) -> list:
+        """Host cores that virtual machines without pinned vCPUs float on: all of them except the
+        ones taken by pinned virtual machines and RESERVED_HOST_CPUS. None if the topology is
+        unknown (or no core is left), the virtual machines can use any core then."""
+        cpus = sorted(
+            cpu for cell in self.cells or [] for cpu in cell["cpu_ids"]
+            if cpu not in self.pinned_cpus and cpu not in RESERVED_HOST_CPUS
+        )
+        return cpus if cpus else None
+
+
+    def reset_pinning(self):
+        self.pinned_cpus = set()
+        self.pinned_memory_mb = {}
+        self.pinned_hugepages = {}
+
+
+    def add_pinning(self, pinning:dict):
+        self._update_pinning(pinning, 1)
+
+
+    def remove_pinning(self, pinning:dict):
+        self._update_pinning(pinning, -1)
+
+
+    def _update_pinning(self, pinning:dict, sign:int):
+        cpus = set(pinning["vcpus"]) | set(pinning["emulator"])
+        if sign > 0:
+            self.pinned_cpus |= cpus
+        else:
+            self.pinned_cpus -= cpus
+        node = pinning["numa_node"]
+        self.pinned_memory_mb[node] = self.pinned_memory_mb.get(node, 0) + sign * pinning["memory_mb"]
+        if pinning.get("hugepage_kb"):
+            key = (node, str(pinning["hugepage_kb"]))
+            pages = -(-pinning["memory_mb"] * 1024 // pinning["hugepage_kb"])
+            self.pinned_hugepages[key] = self.pinned_hugepages.get(key, 0) + sign * pages
+
+
+    def free_fraction(self, request:ResourceRequest) -> float:
+        """Fraction of the scarcest resource that is left after placing the request (1.0 if the capacity is unknown)"""
+        fractions = [
+            (total - committed - requested) / total
+            for total, committed, requested in self._dimensions(request)
+            if total
+        ]
+        return min(fractions) if fractions else 1.0
+
+
+    def _dimensions(self, request:ResourceRequest):
+        return [
+            (self.cpu_total, self.cpu_committed, request.host_cpus),
+            (self.memory_total_mb, self.memory_committed_mb, request.memory_mb),
+            (self.storage_total, self.storage_committed, request.storage_bytes),
+        ]
+
+
+class CapacityIndex:
+    """In-memory view of the capacity of every host and what is committed to virtual machines.
+
+    The index is loaded from the database when it's first used and again every REFRESH_INTERVAL
+    seconds. In between, placements update it incrementally so that placing a virtual machine
+    doesn't need to scan the hosts, virtual machines and volumes.
+
+    The index is kept per process, so the host cores of pinned virtual machines are reloaded
+    from the database (with the host's row locked) before they're handed out, see reserve().
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._hosts: Dict[str, HostCapacity] = {}
+        self._loaded = 0
+
+
+    def hosts(self) -> List[HostCapacity]:
+        with self._lock:
+            if time.monotonic() - self._loaded > REFRESH_INTERVAL:
+                self.refresh()
+            return list(self._hosts.values())
+
+
+    def reserve(self, host_id:str, request:ResourceRequest) -> dict:
+        """Add a virtual machine that is being launched on a host. For pinned requests, returns
+        the host cores it gets (see HostCapacity.pick_cpus), otherwise None.
+
+        Pinned requests lock the host's row and pick from the cores saved in the database, as other
+        processes (the API server and the workers) place virtual machines too. Reserve them in a
+        transaction that also saves the VirtualMachine's cpu_pinning, so the row stays locked until
+        the cores are taken in the database.
+
+        Raises:
+            PlacementError: If the host cores were taken since the host was picked.
+        """
+        with self._lock:
+            host = self._hosts[host_id]
+            pinning = None
+            if request.pinned:
+                with transaction.atomic():
+                    HostMachine.objects.select_for_update().filter(host_id=host_id).exists()
+                    self._load_pinning(host)
+
+                    pinning = host.pick_cpus(request)
+                    if pinning is None:
+                        raise PlacementError("No NUMA cell of the host has enough free cores for this virtual machine.")
+                    host.add_pinning(pinning)
+            host.cpu_committed += request.host_cpus
+            host.memory_committed_mb += request.memory_mb
+            host.storage_committed += request.storage_bytes
+            host.vm_count += 1
+            host.in_flight += 1
+            return pinning
+
+
+    def release(self, host_id:str, request:ResourceRequest, pinning:dict = None):
+        """Remove a virtual machine that was reserved but is not going to be launched"""
+        with self._lock:
+            host = self._hosts.get(host_id)
+            if not host:
+                return
+            if pinning:
+                host.remove_pinning(pinning)
+            host.cpu_committed -= request.host_cpus
+            host.memory_committed_mb -= request.memory_mb
+            host.storage_committed -= request.storage_bytes
+            host.vm_count -= 1
+            host.in_flight -= 1
+
+
+    def shared_cpus(self, host_id:str) -> list:
+        """Shared cores of a host (see HostCapacity.shared_cpus), with the pinned cores read from the database"""
+        with self._lock:
+            host = next((host for host in self.hosts() if host.host_id == host_id), None)
+            if not host:
+                return None
+            self._load_pinning(host)
+            return host.shared_cpus()
+
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = 0
+
+
+    def refresh(self):
+        """Reload the capacity of all of the hosts from the database"""
+        logger.debug("Refreshing the host capacity index")
+        hosts = {
+            host.host_id: HostCapacity(
+                host_id=host.host_id,
+                cpu_total=host.cpu_count,
+                memory_total_mb=host.memory_mb,
+                storage_total=host.storage_bytes,
+                cells=host.metadata.get("inventory", {}).get("topology"),
+            )
+            for host in HostMachine.objects.all()
+        }
+
+        vms = VirtualMachine.objects \
+            .exclude(state__in=[VirtualMachine.State.TERMINATED, VirtualMachine.State.ERROR]) \
+            .exclude(host=None) \
+            .values("host_id", "instance_type", "instance_size", "state") \
+            .annotate(count=Count("id"))
+        for row in vms:
+            host = hosts.get(row["host_id"])
+            if not host:
+                continue
+            try:
+                instance_def = InstanceDefinition(row["instance_type"], row["instance_size"])
+            except InvalidInstanceType:
+                logger.warning(f"Unknown instance type {row['instance_type']}.{row['instance_size']} on host {host.host_id}")
+                continue
+            host.cpu_committed += (instance_def.get_cpu() + instance_def.emulator_cpus) * row["count"]
+            host.memory_committed_mb += instance_def.get_memory() * row["count"]
+            host.vm_count += row["count"]
+            if row["state"] == VirtualMachine.State.CREATING:
+                host.in_flight += row["count"]
+
+        for host_id, pinning in self._pinned_vms().values_list("host_id", "cpu_pinning"):
+            if host_id in hosts:
+                hosts[host_id].add_pinning(pinning)
+
+        volumes = Volume.objects \
+            .exclude(state=Volume.State.DELETED) \
+            .exclude(host=None) \
+            .values("host_id") \
+            .annotate(total=Sum("size"))
+        for row in volumes:
+            if row["host_id"] in hosts:
+                hosts[row["host_id"]].storage_committed += row["total"] or 0
+
+        with self._lock:
+            self._hosts = hosts
+            self._loaded = time.monotonic()
+
+
+    def _load_pinning(self, host:HostCapacity):
+        host.reset_pinning()
+        for pinned in self._pinned_vms().filter(host_id=host.host_id).values_list("cpu_pinning", flat=True):
+            host.add_pinning(pinned)
+
+
+    def _pinned_vms(self):
+        return VirtualMachine.objects \
+            .exclude(state__in=[VirtualMachine.State.TERMINATED, VirtualMachine.State.ERROR]) \
+            .exclude(host=None) \
+            .filter(cpu_pinning__has_key="vcpus")
+
+
+class PlacementStrategy:
+    """Scores the hosts that fit a request. The host with the highest score is picked."""
+    name = None
+
+    def score(self, host:HostCapacity, request:ResourceRequest) -> tuple:
+        raise NotImplementedError
+
+
+class SpreadStrategy(PlacementStrategy):
+    """Place virtual machines on the host with the most free capacity"""
+    name = "spread"
+
+    def score(self, host:HostCapacity, request:ResourceRequest) -> tuple:
+        return (host.free_fraction(request) - IN_FLIGHT_PENALTY * host.in_flight, -host.vm_count)
+
+
+class BinPackStrategy(PlacementStrategy):
+    """Fill up hosts before using the next one, keeping the others free for large virtual machines"""
+    name = "binpack"
+
+    def score(self, host:HostCapacity, request:ResourceRequest) -> tuple:
+        return (-host.free_fraction(request), -host.in_flight)
+
+
+STRATEGIES = {}
+
+
+def register_strategy(strategy:PlacementStrategy):
+    STRATEGIES[strategy.name] = strategy
+
+
+register_strategy(SpreadStrategy())
+register_strategy(BinPackStrategy())
+
+
+capacity_index = CapacityIndex()
+
+
+class PlacementScheduler:
+    """Picks the host to launch a virtual machine on"""
+
+    def __init__(self, index:CapacityIndex = None) -> None:
+        self.index = index if index else capacity_index
+
+
+    def place(self, request:ResourceRequest, strategy:str = None, account:Account = None) -> HostMachine:
+        """Pick a host for the request and reserve the capacity on it. The strategy is the
+        requested one, the account's or the server default, in that order.
+
+        The host cores picked for a pinned request are set in the cpu_pinning attribute of the
+        returned host (an empty dict if the request isn't pinned). Save them in the
+        VirtualMachine's cpu_pinning in the same transaction as the placement (see
+        CapacityIndex.reserve()).
+
+        Raises:
+            PlacementError: If the strategy is unknown or no host has enough free capacity.
+        """
+        strategy = self.get_strategy(strategy, account)
+
+        candidates = [host for host in self.index.hosts() if host.fits(request)]
+        if not candidates:
+            raise PlacementError("No host has enough free capacity for this virtual machine.")
+
+        best = max(candidates, key=lambda host: strategy.score(host, request))
+        pinning = self.index.reserve(best.host_id, request)
+        logger.debug(f"Placing virtual machine on host {best.host_id} ({strategy.name})")
+
+        try:
+            host = HostMachine.objects.get(host_id=best.host_id)
+        except HostMachine.DoesNotExist:
+            # Removed since the index was loaded
+            self.index.release(best.host_id, request, pinning)
+            self.index.invalidate()
+            return self.place(request, strategy.name, account)
+
+        host.cpu_pinning = pinning or {}
+        return host
+
+
+    def release(self, host:HostMachine, request:ResourceRequest):
+        self.index.release(host.host_id, request, getattr(host, "cpu_pinning", None))
+
+
+    def get_strategy(self, strategy:str = None, account:Account = None) -> PlacementStrategy:
+        name = strategy or (account.placement_strategy if account else None) or DEFAULT_STRATEGY
+        if name not in STRATEGIES:
+            raise PlacementError(f"Unknown placement strategy: {name}")
+        return STRATEGIES[name]
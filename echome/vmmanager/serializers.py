@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import VirtualMachine, Volume, Image
+from .models import DomainEvent, HostMachine, HostSample, VirtualMachine, Volume, Image, Job
   
 class VirtualMachineSerializer(serializers.ModelSerializer):
     # specify model and fields
@@ -20,3 +20,31 @@ class ImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
         exclude = ['id', 'account']
+
+
+class JobSerializer(serializers.ModelSerializer):
+    # specify model and fields
+    class Meta:
+        model = Job
+        exclude = ['id', 'account']
+
+
+class HostMachineSerializer(serializers.ModelSerializer):
+    # specify model and fields
+    class Meta:
+        model = HostMachine
+        exclude = ['id']
+
+
+class HostSampleSerializer(serializers.ModelSerializer):
+    # specify model and fields
+    class Meta:
+        model = HostSample
+        exclude = ['id', 'host']
+
+
+class DomainEventSerializer(serializers.ModelSerializer):
+    # specify model and fields
+    class Meta:
+        model = DomainEvent
+        exclude = ['id', 'account']
@@ -0,0 +1,251 @@
+import asyncio
+import libvirt
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
+from echome.config import ecHomeConfig
+from echome.metrics import metrics
+from .libvirt_connection import DEFAULT_LIBVIRT_URI, connections
+from .exceptions import ShutdownError
+
+logger = logging.getLogger(__name__)
+
+# Seconds the guest gets to shut down before it's destroyed
+SHUTDOWN_TIMEOUT = int(ecHomeConfig.VirtualMachines().shutdown_timeout)
+
+# Ask the qemu guest agent to shut down, with the ACPI power button as fallback
+# for guests without an agent
+SHUTDOWN_FLAGS = libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT | libvirt.VIR_DOMAIN_SHUTDOWN_ACPI_POWER_BTN
+
+# Threads destroying the virtual machines that didn't shut down in time, off the event loop
+DESTROY_WORKERS = 4
+
+# Results of a shutdown
+ALREADY_STOPPED = "already_stopped"
+SHUT_DOWN = "shutdown"
+DESTROYED = "destroyed"
+
+
+class _Shutdown:
+    def __init__(self, instance_id:str, uri:str) -> None:
+        self.instance_id = instance_id
+        self.uri = uri
+        self.future = Future()
+        self.started = time.monotonic()
+        self.timer = None
+
+
+class ShutdownCoordinator:
+    """Shuts down virtual machines gracefully without a thread (or a sleeping loop) per
+    virtual machine. The guest is asked to shut down once, and the shutdown finishes when
+    libvirt's stopped event arrives. If it doesn't within the timeout, the domain is destroyed.
+
+        future = shutdown_coordinator.shutdown("vm-1a2b3c4d", uri)
+        future.result()     # Celery / threads, or
+        await shutdown_coordinator.shutdown_async("vm-1a2b3c4d", uri)
+
+        shutdown_coordinator.shutdown_many([("vm-1a2b3c4d", uri), ("vm-5e6f7a8b", uri)])
+
+    The futures resolve to ALREADY_STOPPED, SHUT_DOWN or DESTROYED, or fail with ShutdownError.
+    The events and timeouts of all of the shutdowns of this process are handled by a single
+    thread running libvirt's event loop, on a connection per host of its own. Destroying a
+    domain can block, so it's done by a small pool of threads instead of the event loop.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (uri, instance ID) -> _Shutdown
+        self._pending = {}
+        self._connections = {}
+        self._thread = None
+        self._executor = None
+        self._pid = os.getpid()
+
+
+    def shutdown(self, instance_id:str, libvirt_uri:str = DEFAULT_LIBVIRT_URI, timeout:int = None) -> Future:
+        timeout = SHUTDOWN_TIMEOUT if timeout is None else timeout
+        key = (libvirt_uri, instance_id)
+
+        with self._lock:
+            self._start()
+            if key in self._pending:
+                # Already shutting down, don't ask the guest again
+                return self._pending[key].future
+            try:
+                conn = self._connection(libvirt_uri)
+            except libvirt.libvirtError as e:
+                future = Future()
+                future.set_exception(ShutdownError(f"Could not connect to {libvirt_uri}: {e}"))
+                return future
+            request = _Shutdown(instance_id, libvirt_uri)
+            # Registered before the guest is asked, so the stopped event can't be missed
+            self._pending[key] = request
+
+        try:
+            domain = conn.lookupByName(instance_id)
+            if not domain.isActive():
+                self._finish(key, ALREADY_STOPPED)
+                return request.future
+            logger.debug(f"Asking VM '{instance_id}' to shut down, destroying it in {timeout} seconds")
+            domain.shutdownFlags(SHUTDOWN_FLAGS)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() in (libvirt.VIR_ERR_OPERATION_INVALID, libvirt.VIR_ERR_NO_DOMAIN):
+                # Domain is not running, or not defined at all
+                self._finish(key, ALREADY_STOPPED)
+            else:
+                self._fail(key, ShutdownError(f"Could not shut down VM '{instance_id}': {e}"))
+            return request.future
+
+        timer = libvirt.virEventAddTimeout(int(timeout * 1000), self._on_timeout, key)
+        with self._lock:
+            if key in self._pending:
+                request.timer = timer
+            else:
+                # Stopped already
+                libvirt.virEventRemoveTimeout(timer)
+        return request.future
+
+
+    async def shutdown_async(self, instance_id:str, libvirt_uri:str = DEFAULT_LIBVIRT_URI, timeout:int = None) -> str:
+        return await asyncio.wrap_future(self.shutdown(instance_id, libvirt_uri, timeout))
+
+
+    def shutdown_many(self, targets:List[Tuple[str, str]], timeout:int = None) -> Dict[str, object]:
+        """Shut down many virtual machines at once (instance ID and libvirt URI), in about the
+        time the slowest one takes. Returns the result, or the exception, by instance ID."""
+        futures = {instance_id: self.shutdown(instance_id, uri, timeout) for instance_id, uri in targets}
+        wait(futures.values())
+        return {instance_id: future.exception() or future.result() for instance_id, future in futures.items()}
+
+
+    def pending(self) -> List[str]:
+        with self._lock:
+            return [instance_id for _, instance_id in self._pending]
+
+
+    def _start(self):
+        if os.getpid() != self._pid:
+            # The event loop thread and the connections stay with the parent of a fork
+            self._thread = None
+            self._executor = None
+            self._pending = {}
+            self._connections = {}
+            self._pid = os.getpid()
+        if self._thread:
+            return
+
+        self._executor = ThreadPoolExecutor(DESTROY_WORKERS, thread_name_prefix="libvirt-shutdown-destroy")
+        # Has to be registered before the connections are opened
+        libvirt.virEventRegisterDefaultImpl()
+        self._thread = threading.Thread(target=self._run, name="libvirt-shutdown-events", daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        while True:
+            try:
+                libvirt.virEventRunDefaultImpl()
+            except Exception as e:
+                logger.exception(e)
+
+
+    def _connection(self, uri:str) -> libvirt.virConnect:
+        conn = self._connections.get(uri)
+        if conn is not None:
+            try:
+                if conn.isAlive() == 1:
+                    return conn
+            except libvirt.libvirtError:
+                pass
+            self._connections.pop(uri)
+
+        conn = libvirt.open(uri)
+        conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle, uri)
+        conn.registerCloseCallback(self._on_close, uri)
+        self._connections[uri] = conn
+        return conn
+
+
+    def _finish(self, key:tuple, result:str):
+        with self._lock:
+            request = self._pending.pop(key, None)
+        if request is None:
+            return
+        if request.timer is not None:
+            libvirt.virEventRemoveTimeout(request.timer)
+
+        duration = time.monotonic() - request.started
+        metrics.increment("vm_shutdown_total", result=result)
+        if result != ALREADY_STOPPED:
+            metrics.observe("vm_shutdown_seconds", duration, result=result)
+            logger.info(f"VM '{request.instance_id}' stopped ({result}) after {duration:.1f} seconds")
+        request.future.set_result(result)
+
+
+    def _fail(self, key:tuple, e:Exception):
+        with self._lock:
+            request = self._pending.pop(key, None)
+        if request is None:
+            return
+        if request.timer is not None:
+            libvirt.virEventRemoveTimeout(request.timer)
+        metrics.increment("vm_shutdown_total", result="error")
+        request.future.set_exception(e)
+
+
+    def _on_lifecycle(self, conn, domain, event:int, detail:int, uri:str):
+        if event != libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            return
+        try:
+            key = (uri, domain.name())
+            self._finish(key, DESTROYED if detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_DESTROYED else SHUT_DOWN)
+        except Exception as e:
+            # Exceptions can't be raised into the event loop
+            logger.exception(e)
+
+
+    def _on_timeout(self, timer:int, key:tuple):
+        # Timeouts repeat until they are removed
+        libvirt.virEventRemoveTimeout(timer)
+        with self._lock:
+            request = self._pending.get(key)
+            if request is None:
+                return
+            request.timer = None
+        self._executor.submit(self._destroy, key)
+
+
+    def _destroy(self, key:tuple):
+        uri, instance_id = key
+        try:
+            with connections.connection(uri) as conn:
+                domain = conn.lookupByName(instance_id)
+                if not domain.isActive():
+                    # The stopped event was missed, e.g. the connection was lost
+                    self._finish(key, SHUT_DOWN)
+                    return
+                logger.warning(f"Timeout was reached and VM '{instance_id}' hasn't stopped yet. Force shutting down...")
+                domain.destroy()
+            self._finish(key, DESTROYED)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() in (libvirt.VIR_ERR_OPERATION_INVALID, libvirt.VIR_ERR_NO_DOMAIN):
+                self._finish(key, SHUT_DOWN)
+            else:
+                self._fail(key, ShutdownError(f"Could not destroy VM '{instance_id}': {e}"))
+        except Exception as e:
+            logger.exception(e)
+            self._fail(key, ShutdownError(str(e)))
+
+
+    def _on_close(self, conn, reason:int, uri:str):
+        # Pending shutdowns on this host are checked when they time out
+        logger.warning(f"Lost the connection to {uri} (reason {reason})")
+        with self._lock:
+            if self._connections.get(uri) is conn:
+                self._connections.pop(uri)
+
+
+shutdown_coordinator = ShutdownCoordinator()
@@ -3,6 +3,11 @@ from celery import shared_task
 from identity.models import User
 from .vm_manager import VmManager
 from .image_manager import ImageManager
+from .disk_pool import DiskPoolManager
+from .host_inventory import sample_hosts
+from .instance_definitions import InstanceDefinition
+from .power_actions import BulkPowerAction
+from .models import Image, Job, VirtualMachine
 
 logger = logging.getLogger(__name__)
 
@@ -15,12 +20,42 @@ def task_terminate_instance(vm_id:str, user_id:str):
 
 
 @shared_task
-def task_create_image(vm_id:str, user_id:str, prepared_id:str):
+def task_terminate_instances(vm_ids:list, user_id:str):
+    logger.debug(f"Received async task to terminate VMs: {', '.join(vm_ids)}")
+    user = User.objects.get(user_id=user_id)
+    if failed := VmManager().terminate_instances(vm_ids, user):
+        logger.error(f"Could not terminate VMs: {', '.join(failed)}")
+
+
+@shared_task
+def task_power_action(job_id:str, action:str, vm_ids:list):
+    logger.debug(f"Received async task to {action} VMs: {', '.join(vm_ids)}")
+    job = Job.objects.get(job_id=job_id)
+    job.start()
+    vms = VirtualMachine.objects.filter(
+        account=job.account,
+        instance_id__in=vm_ids
+    ).select_related("host")
+    try:
+        results = BulkPowerAction(action, job).run(list(vms))
+    except Exception as e:
+        logger.exception(e)
+        job.fail(f"{type(e).__name__}: {e}")
+        return
+
+    if failed := [vm_id for vm_id, result in results.items() if result["result"] == "error"]:
+        job.fail(f"Could not {action}: {', '.join(failed)}")
+    else:
+        job.succeed()
+
+
+@shared_task
+def task_create_image(vm_id:str, user_id:str, prepared_id:str, live:bool = False, quiesce:bool = False):
     logger.debug(f"Received async task to create disk image for: {vm_id}")
     user = User.objects.get(user_id=user_id)
     manager = ImageManager(prepared_id)
     try:
-        VmManager().create_virtual_machine_image(vm_id, user, prepared_manager=manager)
+        VmManager().create_virtual_machine_image(vm_id, user, prepared_manager=manager, live=live, quiesce=quiesce)
     except Exception as e:
         logger.error("Image creation process from VM failed")
         logger.error(e)
@@ -28,5 +63,46 @@ def task_create_image(vm_id:str, user_id:str, prepared_id:str):
 
 
 @shared_task
-def task_create_vm(vm_id:str, user_id:str, prepared_id:str):
-    pass
+def task_create_vm(user_id:str, prepared_id:str, job_id:str, instance_type:str, launch_config:dict):
+    logger.debug(f"Received async task to create VM: {prepared_id}")
+    user = User.objects.get(user_id=user_id)
+    job = Job.objects.get(job_id=job_id)
+    job.start()
+    try:
+        instance_class, instance_size = instance_type.split(".")
+        VmManager().create_vm(
+            user,
+            InstanceDefinition(instance_class, instance_size),
+            prepared_id=prepared_id,
+            job=job,
+            **launch_config
+        )
+    except Exception as e:
+        logger.error(f"VM creation process failed for {prepared_id}")
+        logger.error(e)
+        job.fail(f"{type(e).__name__}: {e}")
+        # create_vm() marks the virtual machine, unless it failed before it got that far
+        VirtualMachine.objects.filter(
+            instance_id=prepared_id,
+            state=VirtualMachine.State.CREATING,
+        ).update(state=VirtualMachine.State.ERROR)
+    else:
+        job.succeed()
+
+
+@shared_task
+def task_refill_disk_pool(image_id:str, disk_size:str):
+    logger.debug(f"Received async task to refill disk pool: {image_id}:{disk_size}")
+    try:
+        image = Image.objects.get(image_id=image_id)
+    except Image.DoesNotExist:
+        logger.debug(f"Image {image_id} no longer exists, skipping refill")
+        return
+
+    DiskPoolManager().refill(image, disk_size)
+
+
+@shared_task
+def task_sample_hosts():
+    logger.debug("Received periodic task to sample hosts")
+    sample_hosts()
@@ -1,4 +1,17 @@
+import errno
+import hashlib
+import io
+import libvirt
+import os
+import struct
+import tempfile
+import threading
+import xmltodict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
 from django.test import TestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
 from .xml_generator import (
     KvmXmlNetworkInterface,
     KvmXmlObject, 
@@ -8,6 +21,54 @@ from .xml_generator import (
     KvmXmlDisk,
     KvmXmlRemovableMedia
 )
+from .domain_config import DomainConfig, DomainDisk, DomainInterface, DomainGraphics
+from .scheduler import HostCapacity, ResourceRequest, CapacityIndex, PlacementScheduler
+from .disk_profiles import DISK_PROFILES, get_disk_profile
+from .interface_profiles import INTERFACE_PROFILES, get_interface_profile
+from .models import (
+    OperatingSystem,
+    Image,
+    ImageBlob,
+    DiskPool,
+    PooledDisk,
+    HostMachine,
+    VirtualMachine,
+    InstanceSeed,
+    DomainEvent,
+    Job,
+    Volume,
+)
+from .exceptions import (
+    ImageCopyError,
+    ImageAlreadyExistsError,
+    PlacementError,
+    VirtualMachineDoesNotExist,
+    InvalidImageUpload,
+    UploadOffsetMismatch,
+    LaunchError,
+    ImageInUseError,
+    InvalidLaunchConfiguration,
+    ImagePrepError,
+    VirtualMachineSnapshotError,
+)
+from .image_store import ImageStore
+from .image_manager import ImageManager
+from .image_info_cache import ImageInfoCache
+from .image_upload import ImageUpload
+from .image_build import ImageBuild
+from .metadata_service import MetadataService, SeedCache
+from .host_inventory import HostInventory
+from .libvirt_connection import LibvirtConnectionManager
+from identity.models import Account, User
+from .vm_manager import VmManager
+from .views import DescribeJob
+from .instance_definitions import InstanceDefinition
+from .vm_instance import VirtualMachineInstance, get_domain_states
+from network.models import VirtualNetwork
+from .shutdown import ShutdownCoordinator, ALREADY_STOPPED, SHUT_DOWN, DESTROYED
+from .power_actions import BulkPowerAction
+from .domain_events import DomainEventListener, DomainStateCache
+from . import disk_pool, domain_events, fast_copy, host_inventory, image_build, image_upload, tasks, scheduler, libvirt_connection, vm_manager, shutdown, power_actions, vm_instance
 
 # Create your tests here.
 class TestKvmXmlObject(TestCase):
@@ -55,3 +116,1803 @@ class TestKvmXmlObject(TestCase):
         rendered_xml_with_removable_media = '<domain type="kvm">\n <name>vm-12345678</name>\n <memory unit="MB">512M</memory>\n <vcpu>1</vcpu>\n <os>\n  <type arch="x86_64">hvm</type>\n  <boot dev="hd"/>\n </os>\n <features>\n  <acpi/>\n  <apic/>\n </features>\n <cpu mode="host-passthrough" match="exact"/>\n <clock offset="utc">\n  <timer name="rtc" tickpolicy="catchup"/>\n  <timer name="pit" tickpolicy="delay"/>\n  <timer name="hpet" present="no"/>\n </clock>\n <devices>\n  <emulator>/usr/bin/kvm-spice</emulator>\n  <console type="pty"/>\n  <disk type="file" device="disk">\n   <driver name="qemu" type="qcow2"/>\n   <source file="/test/directory/vm-12345678/vm-12345678.qcow2"/>\n   <alias name="vol-1234567890f"/>\n   <target dev="vda" bus="virtio"/>\n  </disk>\n  <disk type="file" device="cdrom">\n   <driver name="qemu" type="raw"/>\n   <source file="/test/directory/iso/daft-punk-live.iso"/>\n   <alias name="hda"/>\n   <target dev="hda" bus="ide"/>\n   <readonly/>\n  </disk>\n  <interface type="bridge">\n   <source bridge="br0"/>\n  </interface>\n </devices>\n</domain>'
         self.assertEqual(self.kvm_xml_object_instance_with_remov_media.render_xml(), rendered_xml_with_removable_media)
 
+
+class TestDomainConfig(TestCase):
+    # Trimmed XMLDesc() of a running domain
+    domain_xml = """<domain type='kvm' id='3'>
+  <name>vm-12345678</name>
+  <uuid>0b3c2a1e-7d6f-4e5a-9b8c-1d2e3f4a5b6c</uuid>
+  <memory unit='KiB'>1048576</memory>
+  <currentMemory unit='KiB'>524288</currentMemory>
+  <vcpu placement='static'>2</vcpu>
+  <devices>
+    <emulator>/usr/bin/kvm-spice</emulator>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/data/vm-12345678/vm-12345678.qcow2'/>
+      <target dev='vda' bus='virtio'/>
+      <alias name='vol-1234567890f'/>
+    </disk>
+    <disk type='file' device='cdrom'>
+      <driver name='qemu' type='raw'/>
+      <source file='/data/vm-12345678/cloudinit.iso'/>
+      <target dev='hdb' bus='ide'/>
+      <readonly/>
+    </disk>
+    <interface type='bridge'>
+      <mac address='52:54:00:6b:3c:58'/>
+      <source bridge='br0'/>
+      <target dev='vnet0'/>
+      <model type='virtio'/>
+    </interface>
+    <graphics type='vnc' port='5900' autoport='yes' listen='0.0.0.0'/>
+  </devices>
+</domain>"""
+
+    def test_from_xml(self):
+        config = DomainConfig.from_xml(self.domain_xml)
+
+        self.assertEqual(config.name, "vm-12345678")
+        self.assertEqual(config.uuid, "0b3c2a1e-7d6f-4e5a-9b8c-1d2e3f4a5b6c")
+        self.assertEqual(config.vcpu, 2)
+        self.assertEqual(config.memory_kb, 1048576)
+        self.assertEqual(config.current_memory_kb, 524288)
+        self.assertEqual(config.disks, [
+            DomainDisk(target_dev="vda", bus="virtio", source="/data/vm-12345678/vm-12345678.qcow2",
+                format="qcow2", alias="vol-1234567890f"),
+            DomainDisk(target_dev="hdb", bus="ide", device="cdrom", source="/data/vm-12345678/cloudinit.iso",
+                format="raw", read_only=True),
+        ])
+        self.assertEqual(config.interfaces, [
+            DomainInterface(type="bridge", source="br0", mac="52:54:00:6b:3c:58", model="virtio", target_dev="vnet0"),
+        ])
+        self.assertEqual(config.graphics, [DomainGraphics(type="vnc", port=5900, autoport=True, listen="0.0.0.0")])
+        self.assertEqual(config.disk("hdb").source, "/data/vm-12345678/cloudinit.iso")
+        self.assertIsNone(config.disk("vdb"))
+
+    def test_from_xml_without_devices(self):
+        config = DomainConfig.from_xml("<domain type='kvm'><name>vm-1</name><memory unit='MiB'>512</memory><vcpu>1</vcpu></domain>")
+
+        self.assertEqual(config.memory_kb, 512 * 1024)
+        self.assertEqual(config.vcpu, 1)
+        self.assertEqual(config.disks, [])
+        self.assertEqual(config.interfaces, [])
+        self.assertEqual(config.graphics, [])
+
+
+class TestCpuPinning(TestCase):
+
+    def test_render_pinned_core(self):
+        core = KvmXmlCore(
+            memory=4096,
+            cpu_count=2,
+            vcpu_pins=[2, 3],
+            emulator_pins=[4],
+            numa_nodeset="0",
+            hugepage_kb=2048,
+        )
+        xml_object = KvmXmlObject(
+            name="vm-12345678",
+            core=core,
+            hard_disks={},
+            network_interfaces=[KvmXmlNetworkInterface(type="bridge", source="br0")],
+        )
+        domain = xmltodict.parse(xml_object.render_xml())["domain"]
+
+        self.assertEqual(domain["cputune"]["vcpupin"], [
+            {"@vcpu": "0", "@cpuset": "2"},
+            {"@vcpu": "1", "@cpuset": "3"},
+        ])
+        self.assertEqual(domain["cputune"]["emulatorpin"], {"@cpuset": "4"})
+        self.assertEqual(domain["numatune"]["memory"], {"@mode": "strict", "@nodeset": "0"})
+        self.assertEqual(domain["memoryBacking"]["hugepages"]["page"], {"@size": "2048", "@unit": "KiB"})
+        # 4096 MiB is 2048 pages of 2 MiB, MB wouldn't be a whole number of pages
+        self.assertEqual(domain["memory"], {"@unit": "MiB", "#text": "4096"})
+
+
+    def test_render_unpinned_core(self):
+        xml_object = KvmXmlObject(
+            name="vm-12345678",
+            core=KvmXmlCore(memory=512, cpu_count=1),
+            hard_disks={},
+            network_interfaces=[KvmXmlNetworkInterface(type="bridge", source="br0")],
+        )
+        domain = xmltodict.parse(xml_object.render_xml())["domain"]
+        for element in ["cputune", "numatune", "memoryBacking"]:
+            self.assertNotIn(element, domain)
+
+
+    def test_render_shared_cpuset(self):
+        core = KvmXmlCore(memory=512, cpu_count=2, cpuset=[1, 4, 5])
+        xml_object = KvmXmlObject(
+            name="vm-12345678",
+            core=core,
+            hard_disks={},
+            network_interfaces=[KvmXmlNetworkInterface(type="bridge", source="br0")],
+        )
+        domain = xmltodict.parse(xml_object.render_xml())["domain"]
+        self.assertEqual(domain["vcpu"], {"@placement": "static", "@cpuset": "1,4,5", "#text": "2"})
+        self.assertNotIn("cputune", domain)
+
+
+    def test_shared_cpus(self):
+        host = HostCapacity(
+            host_id="host-1",
+            cells=[
+                {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3]},
+                {"id": 1, "memory_mb": 16384, "cpu_ids": [4, 5, 6, 7]},
+            ],
+        )
+        host.add_pinning({"numa_node": 1, "vcpus": [4, 5], "emulator": [6], "memory_mb": 1024})
+
+        with mock.patch.object(scheduler, "RESERVED_HOST_CPUS", {0}):
+            self.assertEqual(host.shared_cpus(), [1, 2, 3, 7])
+        # Unknown topology
+        self.assertIsNone(HostCapacity(host_id="host-2").shared_cpus())
+
+
+    def test_configure_shared_core(self):
+        with mock.patch.object(vm_instance, "connections"):
+            instance = VirtualMachineInstance()
+        instance.configure_core(InstanceDefinition("standard", "small"), cpu_pinning={"cpuset": [1, 2, 3]})
+        self.assertEqual(instance.core.cpuset, [1, 2, 3])
+        self.assertIsNone(instance.core.vcpu_pins)
+
+
+    def test_set_shared_cpus(self):
+        domain = mock.Mock()
+        domain.isActive.return_value = 1
+        domain.info.return_value = [1, 2048, 2048, 2, 0]
+        conn = mock.Mock()
+        conn.lookupByName.return_value = domain
+        conn.getCPUMap.return_value = (6, [True] * 6, 6)
+
+        flags = {"VIR_DOMAIN_AFFECT_CONFIG": 2, "VIR_DOMAIN_AFFECT_LIVE": 1}
+        with mock.patch.object(vm_instance, "connections") as connections, \
+                mock.patch.multiple(vm_instance.libvirt, create=True, **flags):
+            connections.get.return_value = conn
+            VirtualMachineInstance("vm-1").set_shared_cpus([1, 4, 5])
+
+        cpumap = (False, True, False, False, True, True)
+        self.assertEqual(domain.pinVcpuFlags.call_args_list, [mock.call(0, cpumap, 3), mock.call(1, cpumap, 3)])
+        domain.pinEmulator.assert_called_once_with(cpumap, 3)
+
+
+    def test_pick_cpus(self):
+        host = HostCapacity(
+            host_id="host-1",
+            cells=[
+                {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3], "hugepages": {"1048576": 8}},
+                {"id": 1, "memory_mb": 16384, "cpu_ids": [4, 5, 6, 7, 8, 9], "hugepages": {"1048576": 6}},
+            ],
+        )
+        request = ResourceRequest(cpu=2, memory_mb=4096, storage_bytes=0, pinned=True, emulator_cpus=1, hugepage_kb=1048576)
+
+        # Core 0 is reserved for the host, leaving exactly 3 on cell 0
+        patcher = mock.patch.object(scheduler, "RESERVED_HOST_CPUS", {0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pinning = host.pick_cpus(request)
+        self.assertEqual(pinning["numa_node"], 0)
+        self.assertEqual(pinning["vcpus"], [1, 2])
+        self.assertEqual(pinning["emulator"], [3])
+        host.add_pinning(pinning)
+
+        pinning = host.pick_cpus(request)
+        self.assertEqual(pinning["numa_node"], 1)
+        self.assertEqual(pinning["vcpus"], [4, 5])
+        host.add_pinning(pinning)
+        self.assertEqual(host.pinned_hugepages[(1, "1048576")], 4)
+
+        # Cell 1 has the cores left but not the hugepages
+        self.assertIsNone(host.pick_cpus(request))
+        self.assertFalse(host.fits(request))
+
+
+class TestPlacementScheduler(TestCase):
+
+    def setUp(self):
+        self.account = Account.objects.create(account_id="acct-1", name="test")
+        self.small = self.add_host("host-small", cpu_count=8, memory_mb=16384)
+        self.large = self.add_host("host-large", cpu_count=32, memory_mb=65536)
+        self.index = CapacityIndex()
+        self.scheduler = PlacementScheduler(self.index)
+        self.request = ResourceRequest(cpu=2, memory_mb=4096, storage_bytes=0)
+
+
+    def add_host(self, host_id:str, **kwargs) -> HostMachine:
+        return HostMachine.objects.create(host_id=host_id, name=host_id, ip="10.0.0.1", **kwargs)
+
+
+    def add_vm(self, instance_id:str, host:HostMachine, instance_size:str = "medium", cpu_pinning:dict = None):
+        return VirtualMachine.objects.create(instance_id=instance_id, account=self.account, host=host,
+            instance_type="standard", instance_size=instance_size, cpu_pinning=cpu_pinning or {})
+
+
+    def test_spread(self):
+        self.add_vm("vm-1", self.small, "large")
+        self.assertEqual(self.scheduler.place(self.request, "spread").host_id, "host-large")
+
+
+    def test_binpack(self):
+        self.add_vm("vm-1", self.large, "xlarge")
+        self.assertEqual(self.scheduler.place(self.request, "binpack").host_id, "host-large")
+
+
+    def test_reservations_count_until_released(self):
+        hosts = [self.scheduler.place(self.request, "binpack") for _ in range(4)]
+        self.assertEqual([host.host_id for host in hosts], ["host-small"] * 4)
+        # The small host is full now
+        self.assertEqual(self.scheduler.place(self.request, "binpack").host_id, "host-large")
+
+        self.scheduler.release(hosts[0], self.request)
+        self.assertEqual(self.scheduler.place(self.request, "binpack").host_id, "host-small")
+
+
+    def test_no_host_fits(self):
+        with self.assertRaises(PlacementError):
+            self.scheduler.place(ResourceRequest(cpu=64, memory_mb=1024, storage_bytes=0))
+        with self.assertRaises(PlacementError):
+            self.scheduler.place(self.request, "unknown")
+
+
+    def test_pinned_cores_are_reloaded(self):
+        HostMachine.objects.exclude(host_id="host-small").delete()
+        self.small.metadata = {"inventory": {"topology": [
+            {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3, 4, 5, 6, 7]},
+        ]}}
+        self.small.save()
+        request = ResourceRequest(cpu=2, memory_mb=1024, storage_bytes=0, pinned=True)
+
+        with mock.patch.object(scheduler, "RESERVED_HOST_CPUS", {0}):
+            self.index.refresh()
+            # Pinned by another process after the index was loaded
+            self.add_vm("vm-1", self.small, cpu_pinning={"numa_node": 0, "vcpus": [1, 2], "emulator": [1, 2], "memory_mb": 1024})
+            host = self.scheduler.place(request)
+
+        self.assertEqual(host.cpu_pinning["vcpus"], [3, 4])
+
+
+    def test_emulator_cores_are_committed(self):
+        HostMachine.objects.exclude(host_id="host-small").delete()
+        self.small.metadata = {"inventory": {"topology": [
+            {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3, 4, 5, 6, 7]},
+        ]}}
+        self.small.save()
+        request = ResourceRequest(cpu=2, memory_mb=1024, storage_bytes=0, pinned=True, emulator_cpus=1)
+
+        host = self.scheduler.place(request)
+        self.assertEqual(self.index.hosts()[0].cpu_committed, 3)
+        self.scheduler.release(host, request)
+        self.assertEqual(self.index.hosts()[0].cpu_committed, 0)
+
+        VirtualMachine.objects.create(instance_id="vm-1", account=self.account, host=self.small,
+            instance_type="hpc", instance_size="large")
+        self.index.refresh()
+        self.assertEqual(self.index.hosts()[0].cpu_committed, 5)
+
+
+    def test_shared_cpus_exclude_pinned_cores(self):
+        self.small.metadata = {"inventory": {"topology": [
+            {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3, 4, 5, 6, 7]},
+        ]}}
+        self.small.save()
+
+        with mock.patch.object(scheduler, "RESERVED_HOST_CPUS", {0}):
+            self.index.refresh()
+            self.assertEqual(self.index.shared_cpus("host-small"), [1, 2, 3, 4, 5, 6, 7])
+            # Pinned by another process after the index was loaded
+            self.add_vm("vm-1", self.small, cpu_pinning={"numa_node": 0, "vcpus": [1, 2], "emulator": [3], "memory_mb": 1024})
+            self.assertEqual(self.index.shared_cpus("host-small"), [4, 5, 6, 7])
+            # No topology in the inventory
+            self.assertIsNone(self.index.shared_cpus("host-large"))
+
+
+    def test_unpinned_vms_are_moved(self):
+        self.small.metadata = {"inventory": {"topology": [
+            {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3, 4, 5, 6, 7]},
+        ]}}
+        self.small.save()
+        self.add_vm("vm-1", self.small, cpu_pinning={"cpuset": [1, 2, 3, 4, 5, 6, 7]})
+        self.add_vm("vm-2", self.small, cpu_pinning={"cpuset": [5, 6, 7]})
+        manager = VmManager()
+        manager.vm_db = self.add_vm("vm-3", self.small,
+            cpu_pinning={"numa_node": 0, "vcpus": [1, 2], "emulator": [1, 2], "memory_mb": 1024})
+
+        with mock.patch.object(scheduler, "RESERVED_HOST_CPUS", {0}), \
+                mock.patch.object(vm_manager, "capacity_index", self.index), \
+                mock.patch.object(vm_manager, "VirtualMachineInstance") as instance:
+            manager._update_shared_cpus()
+
+        instance.assert_called_once_with("vm-1", self.small)
+        instance.return_value.set_shared_cpus.assert_called_once_with([3, 4, 5, 6, 7])
+        self.assertEqual(VirtualMachine.objects.get(instance_id="vm-1").cpu_pinning, {"cpuset": [3, 4, 5, 6, 7]})
+        self.assertEqual(VirtualMachine.objects.get(instance_id="vm-2").cpu_pinning, {"cpuset": [5, 6, 7]})
+
+
+class TestMetadataService(TestCase):
+
+    def setUp(self):
+        account = Account.objects.create(account_id="acct-1", name="test")
+        self.vm = VirtualMachine.objects.create(instance_id="vm-1", account=account,
+            instance_type="standard", instance_size="micro")
+        self.seed = InstanceSeed(virtual_machine=self.vm, user_data="#cloud-config\n", meta_data="instance-id: vm-1\n")
+        self.seed.generate_token()
+        self.seed.save()
+        self.cache = SeedCache()
+        self.app = MetadataService(self.cache)
+
+
+    def request(self, path:str, method:str = "GET", remote_addr:str = "10.0.0.5"):
+        response = {}
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+
+        body = b"".join(self.app({"REQUEST_METHOD": method, "PATH_INFO": path, "REMOTE_ADDR": remote_addr}, start_response))
+        return response["status"], response["headers"], body
+
+
+    def test_seed_by_token(self):
+        status, _, body = self.request(f"/{self.seed.token}/user-data")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, b"#cloud-config\n")
+
+        status, headers, body = self.request(f"/{self.seed.token}/meta-data", "HEAD")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Length"], str(len("instance-id: vm-1\n")))
+        self.assertEqual(body, b"")
+
+        # Not generated for this virtual machine
+        self.assertEqual(self.request(f"/{self.seed.token}/network-config")[0], "404 Not Found")
+
+
+    def test_not_found(self):
+        for path in ["/unknown/user-data", f"/{self.seed.token}/passwords", "/user-data", f"/a/{self.seed.token}/user-data"]:
+            self.assertEqual(self.request(path)[0], "404 Not Found", path)
+        self.assertEqual(self.request(f"/{self.seed.token}/user-data", "POST")[0], "405 Method Not Allowed")
+
+
+    def test_terminated_vm_is_not_served(self):
+        self.vm.state = VirtualMachine.State.TERMINATED
+        self.vm.save()
+        self.assertEqual(self.request(f"/{self.seed.token}/user-data")[0], "404 Not Found")
+
+
+class TestLibvirtConnectionManager(TestCase):
+
+    def setUp(self):
+        self.manager = LibvirtConnectionManager()
+        patcher = mock.patch.object(libvirt_connection.libvirt, "open", create=True, side_effect=self.connect)
+        self.open = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def connect(self, uri:str):
+        # Connecting doesn't hold up the other connections of the process
+        self.assertFalse(self.manager._lock.locked())
+        conn = mock.Mock()
+        conn.isAlive.return_value = 1
+        return conn
+
+
+    def test_connection_is_shared(self):
+        conn = self.manager.get("qemu:///system")
+        self.assertIs(self.manager.get("qemu:///system"), conn)
+        self.assertIsNot(self.manager.get("qemu+ssh://root@host-2/system"), conn)
+        self.assertEqual(self.open.call_count, 2)
+
+
+    def test_reconnect(self):
+        conn = self.manager.get("qemu:///system")
+        conn.isAlive.return_value = 0
+
+        new_conn = self.manager.get("qemu:///system")
+        self.assertIsNot(new_conn, conn)
+        conn.close.assert_called_once()
+        self.assertEqual(self.manager.health("qemu:///system")["qemu:///system"]["connects"], 2)
+
+        # Dropped after a connection error, only the current connection is dropped
+        self.manager.invalidate("qemu:///system", conn)
+        self.assertIs(self.manager.get("qemu:///system"), new_conn)
+        self.manager.invalidate("qemu:///system", new_conn)
+        self.assertIsNot(self.manager.get("qemu:///system"), new_conn)
+
+
+    def test_fork_reset(self):
+        conn = self.manager.get("qemu:///system")
+        # As if this was the child of a forked process
+        self.manager._pid = -1
+
+        self.assertIsNot(self.manager.get("qemu:///system"), conn)
+        conn.close.assert_not_called()
+        self.assertEqual(self.manager.health()["qemu:///system"]["connects"], 1)
+
+
+class TestTerminateInstance(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(vm_manager, "VM_ROOT_DIR", self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        account = Account.objects.create(account_id="acct-1", name="test")
+        self.user = mock.Mock(account=account)
+        VirtualMachine.objects.create(instance_id="vm-1", account=account, instance_type="standard", instance_size="micro")
+
+
+    def test_never_defined(self):
+        with mock.patch.object(vm_manager, "VirtualMachineInstance", side_effect=VirtualMachineDoesNotExist):
+            self.assertTrue(VmManager().terminate_instance("vm-1", self.user))
+        self.assertFalse(VirtualMachine.objects.filter(instance_id="vm-1").exists())
+
+
+    def test_running_domain_is_destroyed_before_undefine(self):
+        instance = mock.Mock()
+        # Started again while it was being stopped
+        instance.virsh_domain.isActive.return_value = 1
+        with mock.patch.object(vm_manager, "VirtualMachineInstance", return_value=instance):
+            VmManager().terminate_instance("vm-1", self.user)
+
+        self.assertEqual(
+            [name for name, _, _ in instance.mock_calls if name in ("stop", "virsh_domain.destroy", "terminate")],
+            ["stop", "virsh_domain.destroy", "terminate"]
+        )
+
+
+class TestShutdownCoordinator(TestCase):
+
+    def setUp(self):
+        self.coordinator = ShutdownCoordinator()
+        # No event loop thread, the events and timeouts are delivered by the tests
+        self.coordinator._thread = mock.Mock()
+        self.coordinator._executor = ThreadPoolExecutor(1)
+        self.addCleanup(self.coordinator._executor.shutdown)
+
+        self.domain = mock.Mock()
+        self.domain.isActive.return_value = 1
+        self.conn = mock.Mock()
+        self.conn.isAlive.return_value = 1
+        self.conn.lookupByName.return_value = self.domain
+
+        self.timeouts = []
+        for name, value in [
+            ("open", mock.Mock(return_value=self.conn)),
+            ("virEventAddTimeout", mock.Mock(side_effect=lambda ms, callback, key: self.timeouts.append((callback, key)) or len(self.timeouts))),
+            ("virEventRemoveTimeout", mock.Mock()),
+            ("VIR_DOMAIN_EVENT_STOPPED", 5),
+            ("VIR_DOMAIN_EVENT_STOPPED_DESTROYED", 1),
+        ]:
+            patcher = mock.patch.object(shutdown.libvirt, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+    def test_already_stopped(self):
+        self.domain.isActive.return_value = 0
+        self.assertEqual(self.coordinator.shutdown("vm-1").result(timeout=1), ALREADY_STOPPED)
+        self.domain.shutdownFlags.assert_not_called()
+
+
+    def test_stopped_event(self):
+        future = self.coordinator.shutdown("vm-1", "qemu:///system")
+        # The guest is asked once
+        self.assertIs(self.coordinator.shutdown("vm-1", "qemu:///system"), future)
+        self.domain.shutdownFlags.assert_called_once()
+        self.assertEqual(self.coordinator.pending(), ["vm-1"])
+
+        self.domain.name.return_value = "vm-1"
+        self.coordinator._on_lifecycle(self.conn, self.domain, 5, 0, "qemu:///system")
+        self.assertEqual(future.result(timeout=1), SHUT_DOWN)
+        self.assertEqual(self.coordinator.pending(), [])
+
+
+    def test_timeout_destroys_off_the_event_loop(self):
+        destroyed_by = []
+        self.domain.destroy.side_effect = lambda: destroyed_by.append(threading.current_thread())
+        future = self.coordinator.shutdown("vm-1", "qemu:///system")
+
+        callback, key = self.timeouts[0]
+        with mock.patch.object(shutdown, "connections") as connections:
+            connections.connection.return_value.__enter__.return_value = self.conn
+            callback(1, key)
+            self.assertEqual(future.result(timeout=1), DESTROYED)
+
+        self.assertNotEqual(destroyed_by, [threading.current_thread()])
+        self.assertEqual(len(destroyed_by), 1)
+
+
+class TestBulkPowerAction(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.active = set()
+        self.conn = mock.Mock()
+        self.conn.lookupByName.side_effect = self.domain
+        patcher = mock.patch.object(power_actions, "connections")
+        connections = patcher.start()
+        self.addCleanup(patcher.stop)
+        connections.connection.return_value.__enter__.return_value = self.conn
+
+
+    def domain(self, instance_id:str):
+        domain = mock.Mock()
+        domain.isActive.side_effect = lambda: instance_id in self.active
+        domain.create.side_effect = lambda: self.calls.append(("create", instance_id))
+        return domain
+
+
+    def vm(self, instance_id:str, start_order:int = 0, host_id:str = None) -> VirtualMachine:
+        return VirtualMachine(instance_id=instance_id, start_order=start_order, host_id=host_id)
+
+
+    def test_start_order(self):
+        vms = [self.vm("vm-3", 2), self.vm("vm-1", 0), self.vm("vm-2", 1)]
+        # Started since the cache was updated, the live state is checked
+        self.active.add("vm-2")
+
+        results = BulkPowerAction("start", concurrency=1, host_delay=0).run(vms)
+
+        self.assertEqual(self.calls, [("create", "vm-1"), ("create", "vm-3")])
+        self.assertEqual(results["vm-2"], {"result": "already_running"})
+        self.assertEqual(results["vm-3"], {"result": "started"})
+
+
+    def test_stop_order(self):
+        self.active.update(["vm-1", "vm-2"])
+        vms = [self.vm("vm-1", 0), self.vm("vm-2", 1), self.vm("vm-3", 1)]
+        stopped = []
+        def stop(instance_id, uri):
+            stopped.append(instance_id)
+            future = Future()
+            future.set_result(SHUT_DOWN)
+            return future
+
+        with mock.patch.object(power_actions.shutdown_coordinator, "shutdown", side_effect=stop):
+            results = BulkPowerAction("stop", concurrency=1).run(vms)
+
+        self.assertEqual(stopped, ["vm-2", "vm-1"])
+        self.assertEqual(results["vm-3"], {"result": ALREADY_STOPPED})
+
+
+    def test_hosts_take_turns(self):
+        vms = [self.vm("vm-1", host_id="host-1"), self.vm("vm-2", host_id="host-1"), self.vm("vm-3", host_id="host-1"),
+            self.vm("vm-4", host_id="host-2")]
+        self.assertEqual(
+            [vm.instance_id for vm in BulkPowerAction._interleave_hosts(vms)],
+            ["vm-1", "vm-4", "vm-2", "vm-3"]
+        )
+
+
+class TestDiskProfiles(TestCase):
+
+    def render(self, disks:dict, core:KvmXmlCore = None, removable_media:list = None) -> dict:
+        xml_object = KvmXmlObject(
+            name="vm-12345678",
+            core=core or KvmXmlCore(memory=2048, cpu_count=2),
+            hard_disks=disks,
+            network_interfaces=[KvmXmlNetworkInterface(type="bridge", source="br0")],
+            removable_media=removable_media or [],
+        )
+        return xmltodict.parse(xml_object.render_xml(), force_list=("disk",))["domain"]
+
+
+    def test_virtio_blk_with_iothread(self):
+        profile = DISK_PROFILES["performance"]
+        disk = KvmXmlDisk(
+            file_path="/test/vm-12345678.qcow2",
+            alias="vol-1234567890f",
+            bus=profile.bus,
+            cache=profile.cache,
+            io=profile.io,
+            discard=profile.discard,
+            detect_zeroes=profile.detect_zeroes,
+            queues=2,
+            iothread=profile.iothread,
+        )
+        domain = self.render({"vda": disk})
+
+        self.assertEqual(domain["iothreads"], "1")
+        rendered = domain["devices"]["disk"][0]
+        self.assertEqual(rendered["driver"], {
+            "@name": "qemu",
+            "@type": "qcow2",
+            "@cache": "none",
+            "@io": "io_uring",
+            "@discard": "unmap",
+            "@detect_zeroes": "unmap",
+            "@queues": "2",
+            "@iothread": "1",
+        })
+        self.assertEqual(rendered["target"], {"@dev": "vda", "@bus": "virtio"})
+        self.assertNotIn("controller", domain["devices"])
+
+
+    def test_virtio_scsi(self):
+        disk = KvmXmlDisk(
+            file_path="/test/vm-12345678.qcow2",
+            alias="vol-1234567890f",
+            bus="scsi",
+            cache="none",
+            io="native",
+            queues=4,
+            iothread=True,
+        )
+        domain = self.render({"vda": disk})
+
+        self.assertEqual(domain["iothreads"], "1")
+        self.assertEqual(domain["devices"]["controller"], {
+            "@type": "scsi",
+            "@index": "0",
+            "@model": "virtio-scsi",
+            "driver": {"@queues": "4", "@iothread": "1"},
+        })
+        rendered = domain["devices"]["disk"][0]
+        self.assertEqual(rendered["target"], {"@dev": "sda", "@bus": "scsi"})
+        # Capturing the disk finds it by its file, not as vda
+        config = DomainConfig.from_xml(xmltodict.unparse({"domain": domain}))
+        self.assertIsNone(config.disk("vda"))
+        self.assertEqual(config.disk_by_source("/test/vm-12345678.qcow2").target_dev, "sda")
+        # The queues and iothread are the controller's
+        self.assertNotIn("@queues", rendered["driver"])
+        self.assertNotIn("@iothread", rendered["driver"])
+
+
+    def test_legacy_ide_with_efi(self):
+        disk = KvmXmlDisk(file_path="/test/vm-12345678.qcow2", alias="vol-1234567890f", bus="ide")
+        cdrom = KvmXmlRemovableMedia(file_path="/test/seed.iso", alias="hdb")
+        domain = self.render({"vda": disk}, KvmXmlCore(memory=2048, cpu_count=2, efi_boot=True), [cdrom])
+
+        self.assertNotIn("iothreads", domain)
+        disks = domain["devices"]["disk"]
+        self.assertEqual(disks[0]["driver"], {"@name": "qemu", "@type": "qcow2"})
+        self.assertEqual(disks[0]["target"], {"@dev": "sda", "@bus": "sata"})
+        self.assertEqual(disks[1]["target"], {"@dev": "sdb", "@bus": "sata"})
+
+
+    def test_get_disk_profile(self):
+        self.assertEqual(get_disk_profile("scsi").name, "scsi")
+        self.assertEqual(get_disk_profile(None, "performance").name, "performance")
+        self.assertEqual(get_disk_profile(None, "performance", OperatingSystem.WINDOWS).name, "legacy")
+        with self.assertRaises(KeyError):
+            get_disk_profile("nvme")
+
+
+class TestInterfaceProfiles(TestCase):
+
+    def render_interface(self, interface:KvmXmlNetworkInterface) -> dict:
+        xml_object = KvmXmlObject(
+            name="vm-12345678",
+            core=KvmXmlCore(memory=2048, cpu_count=4),
+            hard_disks={},
+            network_interfaces=[interface],
+        )
+        return xmltodict.parse(xml_object.render_xml())["domain"]["devices"]["interface"]
+
+
+    def test_virtio_multiqueue(self):
+        interface = self.render_interface(KvmXmlNetworkInterface(
+            type="bridge",
+            source="br0",
+            model="virtio",
+            driver="vhost",
+            queues=4,
+            rx_queue_size=1024,
+            mtu=9000,
+            host_offloads={"tso4": "off"},
+            guest_offloads={"tso4": "off"},
+        ))
+
+        self.assertEqual(interface["source"], {"@bridge": "br0"})
+        self.assertEqual(interface["model"], {"@type": "virtio"})
+        self.assertEqual(interface["driver"], {
+            "@name": "vhost",
+            "@queues": "4",
+            "@rx_queue_size": "1024",
+            "host": {"@tso4": "off"},
+            "guest": {"@tso4": "off"},
+        })
+        self.assertEqual(interface["mtu"], {"@size": "9000"})
+
+
+    def test_legacy(self):
+        interface = self.render_interface(KvmXmlNetworkInterface(type="nat", source="default"))
+        self.assertEqual(interface, {"@type": "network", "source": {"@network": "default"}})
+
+
+    def test_virtio_options_need_virtio(self):
+        vnet = VirtualNetwork(name="default", type=VirtualNetwork.Type.NAT, config={"disabled_offloads": ["tso4"]})
+        with mock.patch.object(vm_instance, "connections"):
+            instance = VirtualMachineInstance()
+            instance.configure_network(vnet, INTERFACE_PROFILES["legacy"], 4)
+            legacy = instance.virtual_network
+            instance.configure_network(vnet, INTERFACE_PROFILES["throughput"], 4)
+            throughput = instance.virtual_network
+
+        self.assertNotIn("driver", self.render_interface(legacy))
+        self.assertEqual(self.render_interface(throughput)["driver"], {
+            "@name": "vhost",
+            "@queues": "4",
+            "@rx_queue_size": "1024",
+            "host": {"@tso4": "off"},
+            "guest": {"@tso4": "off"},
+        })
+
+
+    def test_get_interface_profile(self):
+        self.assertEqual(get_interface_profile("throughput").name, "throughput")
+        self.assertEqual(get_interface_profile(None, "throughput").name, "throughput")
+        self.assertEqual(get_interface_profile(None, "throughput", OperatingSystem.WINDOWS).name, "legacy")
+        with self.assertRaises(KeyError):
+            get_interface_profile("sriov")
+
+
+class TestDiskPool(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(disk_pool, "VM_ROOT_DIR", self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        delay = mock.patch("vmmanager.tasks.task_refill_disk_pool.delay")
+        self.delay = delay.start()
+        self.addCleanup(delay.stop)
+
+        self.image = Image(
+            image_type=Image.ImageType.GUEST,
+            image_path=f"{self.tmp.name}/image.qcow2",
+            name="image",
+            description="image",
+            metadata={"format": "qcow2"},
+            state=Image.State.AVAILABLE,
+        )
+        self.image.generate_id()
+        self.image.save()
+        self.pool = DiskPool.objects.create(image=self.image, disk_size="10G", depth=2)
+
+
+    def provision(self, image, destination_dir, file_name, size, linked=False):
+        path = Path(destination_dir) / f"{file_name}.qcow2"
+        # Nothing is locked or reserved beyond the slot of this disk while it's provisioned
+        self.assertEqual(PooledDisk.objects.filter(ready=False).count(), 1)
+        path.write_text("disk")
+        return path
+
+
+    def test_refill(self):
+        with mock.patch("vmmanager.disk_pool.ImageManager.provision_disk", side_effect=self.provision), \
+                mock.patch("vmmanager.disk_pool.QemuImg.info", return_value={"virtual-size": 10, "format": "qcow2"}):
+            disk_pool.DiskPoolManager().refill(self.image, "10G")
+
+        disks = PooledDisk.objects.filter(pool=self.pool)
+        self.assertEqual(disks.count(), 2)
+        for disk in disks:
+            self.assertTrue(disk.ready)
+            self.assertEqual(disk.format, "qcow2")
+            self.assertTrue(os.path.exists(disk.path))
+
+
+    def test_refill_failure_removes_partial_disk(self):
+        def fail(image, destination_dir, file_name, size, linked=False):
+            (Path(destination_dir) / f"{file_name}.qcow2").write_text("partial")
+            raise ImageCopyError("copy failed")
+
+        with mock.patch("vmmanager.disk_pool.ImageManager.provision_disk", side_effect=fail):
+            disk_pool.DiskPoolManager().refill(self.image, "10G")
+
+        self.assertFalse(PooledDisk.objects.exists())
+        self.assertEqual(list(Path(self.tmp.name, "disk_pool", self.image.image_id).iterdir()), [])
+
+
+    def test_claim(self):
+        ready = Path(self.tmp.name, "pool-1.qcow2")
+        ready.write_text("disk")
+        PooledDisk.objects.create(pool=self.pool, path=str(ready), format="qcow2")
+        destination = Path(self.tmp.name, "vm-1")
+        destination.mkdir()
+
+        disk = disk_pool.DiskPoolManager().claim(self.image, "10G", destination, "vm-1")
+
+        self.assertEqual(disk.path, str(destination.absolute() / "vm-1.qcow2"))
+        self.assertTrue(os.path.exists(disk.path))
+        self.assertFalse(PooledDisk.objects.exists())
+        self.delay.assert_called_once_with(self.image.image_id, "10G")
+
+
+    def test_claim_does_not_queue_refill_in_flight(self):
+        PooledDisk.objects.create(pool=self.pool, path=f"{self.tmp.name}/pool-2", ready=False)
+
+        disk = disk_pool.DiskPoolManager().claim(self.image, "10G", Path(self.tmp.name), "vm-1")
+
+        # The reserved disk can't be claimed, and the refill that's provisioning it fills the pool
+        self.assertIsNone(disk)
+        self.delay.assert_not_called()
+
+
+    def test_claim_does_not_queue_refill_when_full(self):
+        self.pool.depth = 0
+        self.pool.save()
+
+        disk_pool.DiskPoolManager().claim(self.image, "10G", Path(self.tmp.name), "vm-1")
+        self.delay.assert_not_called()
+
+
+class TestFastCopy(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.source = Path(self.tmp.name, "source.img")
+        self.source.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+        self.destination = Path(self.tmp.name, "destination.img")
+
+
+    def test_copy(self):
+        result = fast_copy.copy_file(str(self.source), str(self.destination))
+        self.assertEqual(result.bytes_copied, self.source.stat().st_size)
+        self.assertEqual(self.destination.read_bytes(), self.source.read_bytes())
+
+
+    def test_fallback_to_next_mechanism(self):
+        def unsupported(src_fd, dst_fd, size):
+            os.write(dst_fd, b"partial")
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        mechanisms = [("unsupported", unsupported), (fast_copy.Mechanism.USERSPACE, fast_copy._userspace)]
+        with mock.patch.object(fast_copy, "_MECHANISMS", mechanisms):
+            result = fast_copy.copy_file(str(self.source), str(self.destination))
+
+        self.assertEqual(result.mechanism, fast_copy.Mechanism.USERSPACE)
+        self.assertEqual(self.destination.read_bytes(), self.source.read_bytes())
+
+
+    def test_real_errors_are_raised(self):
+        def denied(src_fd, dst_fd, size):
+            raise OSError(errno.EPERM, "Operation not permitted")
+
+        mechanisms = [("denied", denied), (fast_copy.Mechanism.USERSPACE, fast_copy._userspace)]
+        with mock.patch.object(fast_copy, "_MECHANISMS", mechanisms):
+            with self.assertRaises(PermissionError):
+                fast_copy.copy_file(str(self.source), str(self.destination))
+
+
+    def test_short_copy_is_raised(self):
+        def short(src_fd, dst_fd, size):
+            return fast_copy._userspace(src_fd, dst_fd, size) - 17
+
+        with mock.patch.object(fast_copy, "_MECHANISMS", [("short", short)]):
+            with self.assertRaises(OSError) as e:
+                fast_copy.copy_file(str(self.source), str(self.destination))
+        self.assertEqual(e.exception.errno, errno.EIO)
+
+
+class TestImageInfoCache(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.image = Path(self.tmp.name, "image.raw")
+        self.image.write_bytes(b"\0" * 4096)
+        self.cache = ImageInfoCache(max_size=2)
+        self.cache._shared = False
+
+
+    def test_changed_image_is_not_served(self):
+        key = self.cache.key(str(self.image))
+        self.cache.put(key, {"format": "raw", "virtual-size": 4096})
+        self.assertEqual(self.cache.get(self.cache.key(str(self.image)))["virtual-size"], 4096)
+
+        self.image.write_bytes(b"\0" * 8192)
+        self.assertIsNone(self.cache.get(self.cache.key(str(self.image))))
+        self.assertIsNone(self.cache.key(str(Path(self.tmp.name, "missing.raw"))))
+
+
+    def test_least_recently_used_is_evicted(self):
+        for i in range(3):
+            self.cache.put(("image", i), {"index": i})
+        self.assertIsNone(self.cache.get(("image", 0)))
+        self.assertEqual(self.cache.get(("image", 2)), {"index": 2})
+
+
+class TestImageStore(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = ImageStore(Path(self.tmp.name, "store"))
+        self.image_file = Path(self.tmp.name, "guest.qcow2")
+        self.image_file.write_bytes(b"guest image")
+
+
+    def test_ingest_copies_guest_images(self):
+        blob = self.store.ingest(str(self.image_file))
+
+        self.assertEqual(blob.digest, ImageStore.hash_file(str(self.image_file)))
+        self.assertEqual(Path(blob.path).read_bytes(), b"guest image")
+        self.assertNotEqual(os.stat(blob.path).st_ino, self.image_file.stat().st_ino)
+        # Only the copy in the store is read-only, the administrator's file is left alone
+        self.assertTrue(self.image_file.stat().st_mode & 0o200)
+        self.assertFalse(os.stat(blob.path).st_mode & 0o222)
+
+
+    def test_ingest_deduplicates(self):
+        blob = self.store.ingest(str(self.image_file))
+        upload = Path(self.tmp.name, "upload.qcow2")
+        upload.write_bytes(b"guest image")
+
+        self.assertEqual(self.store.ingest(str(upload), move=True), blob)
+        self.assertFalse(upload.exists())
+        self.assertEqual(ImageBlob.objects.count(), 1)
+
+
+    def test_ingest_moves(self):
+        upload = Path(self.tmp.name, "upload.qcow2")
+        upload.write_bytes(b"user image")
+
+        blob = self.store.ingest(str(upload), move=True)
+        self.assertFalse(upload.exists())
+        self.assertEqual(Path(blob.path).read_bytes(), b"user image")
+
+
+    def test_release(self):
+        blob = self.store.ingest(str(self.image_file))
+        image = Image(image_type=Image.ImageType.GUEST, image_path=blob.path, blob=blob, name="guest",
+            description="guest", state=Image.State.AVAILABLE)
+        image.generate_id()
+        image.save()
+
+        self.assertFalse(self.store.release(blob))
+        self.assertTrue(os.path.exists(blob.path))
+
+        image.state = Image.State.DELETED
+        image.save()
+        self.assertTrue(self.store.release(blob))
+        self.assertFalse(os.path.exists(blob.path))
+        self.assertFalse(ImageBlob.objects.exists())
+
+
+    def test_register_same_guest_image_twice(self):
+        info = {"format": "qcow2", "actual-size": 11, "virtual-size": 11}
+        with mock.patch("vmmanager.image_manager.ImageStore", return_value=self.store), \
+                mock.patch("vmmanager.models.QemuImg.info", return_value=info):
+            ImageManager().register_guest_image(str(self.image_file), "guest", "guest")
+            with self.assertRaises(ImageAlreadyExistsError):
+                ImageManager().register_guest_image(str(self.image_file), "guest", "guest")
+
+
+class TestImageUpload(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = ImageStore(Path(self.tmp.name, "store"))
+
+        patches = [
+            mock.patch.object(image_upload, "get_image_store_dir", return_value=Path(self.tmp.name)),
+            mock.patch("vmmanager.image_manager.ImageStore", return_value=self.store),
+            mock.patch.object(image_upload, "UPLOAD_CHUNK_SIZE", 1024),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.image_manager = ImageManager()
+        self.image_manager.prepare_guest_image("upload", "upload")
+
+
+    def start(self, data:bytes) -> ImageUpload:
+        upload = ImageUpload(self.image_manager)
+        upload.start(len(data))
+        return upload
+
+
+    def test_resumed_upload(self):
+        data = os.urandom(5000)
+        upload = self.start(data)
+
+        # The connection drops after 3000 bytes
+        self.assertEqual(upload.write(io.BytesIO(data[:3000]), 0), 3000)
+        self.assertEqual(upload.offset, 3000)
+        self.assertEqual(self.image_manager.image.state, Image.State.CREATING)
+
+        self.assertEqual(upload.write(io.BytesIO(data[3000:]), 3000), 5000)
+
+        image = Image.objects.get(image_id=self.image_manager.image.image_id)
+        self.assertEqual(image.state, Image.State.AVAILABLE)
+        self.assertEqual(image.metadata["sha256"], hashlib.sha256(data).hexdigest())
+        self.assertEqual(image.blob.digest, hashlib.sha256(data).hexdigest())
+        self.assertEqual(image.metadata["upload"]["format"], "raw")
+        self.assertEqual(Path(image.image_path).read_bytes(), data)
+        self.assertFalse(upload.part_path.exists())
+
+
+    def test_resumed_in_another_process(self):
+        data = os.urandom(5000)
+        upload = self.start(data)
+        upload.write(io.BytesIO(data[:2500]), 0)
+
+        # The saved hash state is only kept by the process that received the first part
+        image_upload._upload_hashes.clear()
+        upload.write(io.BytesIO(data[2500:]), 2500)
+
+        image = Image.objects.get(image_id=self.image_manager.image.image_id)
+        self.assertEqual(image.metadata["sha256"], hashlib.sha256(data).hexdigest())
+
+
+    def test_wrong_offset(self):
+        data = os.urandom(2000)
+        upload = self.start(data)
+        upload.write(io.BytesIO(data[:1000]), 0)
+
+        for offset in [0, 500, 1500]:
+            with self.assertRaises(UploadOffsetMismatch) as e:
+                upload.write(io.BytesIO(data[offset:]), offset)
+            self.assertEqual(e.exception.offset, 1000)
+
+        # Nothing was written by the rejected requests
+        self.assertEqual(upload.offset, 1000)
+        self.assertEqual(upload.part_path.read_bytes(), data[:1000])
+
+
+    def test_too_much_data(self):
+        upload = self.start(b"\0" * 1000)
+        with self.assertRaises(InvalidImageUpload):
+            upload.write(io.BytesIO(b"\0" * 2000), 0)
+
+
+    def test_qcow2_with_backing_file(self):
+        header = struct.pack(">4sIQIIQ", b"QFI\xfb", 3, 72, 11, 16, 1024 ** 3)
+        data = header.ljust(2048, b"\0")
+        upload = self.start(data)
+
+        with self.assertRaises(InvalidImageUpload):
+            upload.write(io.BytesIO(data), 0)
+
+        self.assertEqual(Image.objects.get(image_id=self.image_manager.image.image_id).state, Image.State.CREATING)
+
+
+    def test_qcow2_header(self):
+        header = struct.pack(">4sIQIIQ", b"QFI\xfb", 3, 0, 0, 16, 1024 ** 3)
+        data = header.ljust(2048, b"\0")
+        upload = self.start(data)
+
+        # The header arrives over several requests
+        upload.write(io.BytesIO(data[:10]), 0)
+        self.assertNotIn("format", self.image_manager.image.metadata["upload"])
+        upload.write(io.BytesIO(data[10:1000]), 10)
+
+        upload_metadata = self.image_manager.image.metadata["upload"]
+        self.assertEqual(upload_metadata["format"], "qcow2")
+        self.assertEqual(upload_metadata["qcow2-version"], 3)
+        self.assertEqual(upload_metadata["virtual-size"], 1024 ** 3)
+
+
+    def test_failed_registration(self):
+        data = os.urandom(1000)
+        upload = self.start(data)
+
+        with mock.patch.object(ImageManager, "finish_upload", side_effect=ImageAlreadyExistsError):
+            with self.assertRaises(ImageAlreadyExistsError):
+                upload.write(io.BytesIO(data), 0)
+
+        self.assertEqual(Image.objects.get(image_id=self.image_manager.image.image_id).state, Image.State.ERROR)
+        with self.assertRaises(InvalidImageUpload):
+            upload.write(io.BytesIO(b""), 1000)
+
+
+class TestDomainEventListener(TestCase):
+
+    def setUp(self):
+        self.account = Account.objects.create(account_id="acct-1", name="test")
+        self.host = HostMachine.objects.create(host_id="host-1", name="host-1", ip="10.0.0.1")
+        for instance_id in ["vm-1", "vm-2"]:
+            VirtualMachine.objects.create(instance_id=instance_id, account=self.account, host=self.host,
+                instance_type="standard", instance_size="micro")
+
+        self.conn = mock.Mock()
+        self.conn.domainEventRegisterAny.side_effect = range(100)
+        self.conn.getAllDomainStats.return_value = []
+        self.listener = DomainEventListener()
+
+
+    def domain(self, instance_id:str):
+        domain = mock.Mock()
+        domain.name.return_value = instance_id
+        return domain
+
+
+    def lifecycle(self, instance_id:str, event:int, detail:int) -> DomainEvent:
+        self.listener._on_lifecycle(self.conn, self.domain(instance_id), event, detail, self.host)
+        return DomainEvent.objects.filter(instance_id=instance_id).order_by("id").last()
+
+
+    def test_cache_writes_through(self):
+        cache = DomainStateCache()
+        self.assertTrue(cache.set("vm-1", libvirt.VIR_DOMAIN_RUNNING, "booted"))
+
+        vm = VirtualMachine.objects.get(instance_id="vm-1")
+        self.assertEqual(vm.domain_state, "running")
+        self.assertEqual(vm.domain_state_code, libvirt.VIR_DOMAIN_RUNNING)
+        self.assertEqual(vm.domain_state_reason, "booted")
+        changed = vm.state_changed
+        self.assertIsNotNone(changed)
+
+        # Unchanged states are not written
+        self.assertFalse(cache.set("vm-1", libvirt.VIR_DOMAIN_RUNNING, "reconciled"))
+        vm.refresh_from_db()
+        self.assertEqual(vm.state_changed, changed)
+        self.assertEqual(vm.domain_state_reason, "booted")
+
+        # A new cache starts from the database
+        cache = DomainStateCache()
+        cache.load(self.host)
+        self.assertEqual(cache.get("vm-1"), {"code": libvirt.VIR_DOMAIN_RUNNING, "reason": "booted"})
+
+
+    def test_reconcile(self):
+        VirtualMachine.objects.filter(instance_id="vm-2").update(domain_state_code=libvirt.VIR_DOMAIN_RUNNING)
+        self.listener.cache.load(self.host)
+        self.conn.getAllDomainStats.return_value = [
+            (self.domain("vm-1"), {"state.state": libvirt.VIR_DOMAIN_SHUTOFF}),
+            (self.domain("other"), {"state.state": libvirt.VIR_DOMAIN_RUNNING}),
+        ]
+
+        self.listener.reconcile(self.host, self.conn)
+
+        # vm-1 was defined and vm-2 undefined while nobody was listening
+        self.assertEqual(VirtualMachine.objects.get(instance_id="vm-1").domain_state, "shutoff")
+        self.assertIsNone(VirtualMachine.objects.get(instance_id="vm-2").domain_state_code)
+        self.assertEqual(
+            sorted(DomainEvent.objects.values_list("instance_id", "event", "state")),
+            [("vm-1", "reconciled", "shutoff"), ("vm-2", "reconciled", None)],
+        )
+
+        # Nothing changed since
+        self.listener.reconcile(self.host, self.conn)
+        self.assertEqual(DomainEvent.objects.count(), 2)
+
+
+    def test_crash(self):
+        event = self.lifecycle("vm-1", libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED)
+        self.assertTrue(event.unexpected)
+        self.assertEqual((event.event, event.detail, event.state), ("stopped", "crashed", "shutoff"))
+
+        event = self.lifecycle("vm-2", libvirt.VIR_DOMAIN_EVENT_CRASHED, 0)
+        self.assertTrue(event.unexpected)
+        self.assertEqual(VirtualMachine.objects.get(instance_id="vm-2").domain_state, "crashed")
+
+
+    def test_requested_stop(self):
+        event = self.lifecycle("vm-1", libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_DESTROYED)
+        self.assertFalse(event.unexpected)
+        event = self.lifecycle("vm-2", libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
+        self.assertFalse(event.unexpected)
+
+
+    def test_guest_shutoff(self):
+        event = self.lifecycle("vm-1", libvirt.VIR_DOMAIN_EVENT_SHUTDOWN, libvirt.VIR_DOMAIN_EVENT_SHUTDOWN_GUEST)
+        self.assertFalse(event.unexpected)
+        self.assertEqual(self.listener._guest_shutdowns, {"vm-1"})
+
+        # The guest powered itself off
+        event = self.lifecycle("vm-1", libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
+        self.assertTrue(event.unexpected)
+        self.assertEqual(self.listener._guest_shutdowns, set())
+
+        # The next shutdown was requested
+        event = self.lifecycle("vm-1", libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
+        self.assertFalse(event.unexpected)
+
+
+    def test_unknown_domain(self):
+        self.assertIsNone(self.lifecycle("other", libvirt.VIR_DOMAIN_EVENT_CRASHED, 0))
+
+
+    def test_reconnect(self):
+        with mock.patch.object(domain_events.libvirt, "open", return_value=self.conn, create=True) as libvirt_open:
+            self.listener.watch_hosts()
+            callback_ids = self.listener._watches["host-1"][2]
+            self.assertEqual(len(callback_ids), 3)
+
+            self.listener._on_close(self.conn, 0, "host-1")
+            self.conn.close.assert_not_called()
+
+            self.listener.release_lost_hosts()
+            self.assertEqual(
+                [call.args[0] for call in self.conn.domainEventDeregisterAny.call_args_list],
+                callback_ids,
+            )
+            self.conn.close.assert_called_once()
+            self.assertNotIn("host-1", self.listener._watches)
+
+            self.listener.watch_hosts()
+            self.assertEqual(libvirt_open.call_count, 2)
+            self.assertIn("host-1", self.listener._watches)
+
+
+    def test_get_states(self):
+        listening = HostMachine.objects.create(host_id="host-2", name="host-2", ip="10.0.0.2",
+            events_heartbeat=domain_events.timezone.now())
+        VirtualMachine.objects.create(instance_id="vm-3", account=self.account, host=listening,
+            instance_type="standard", instance_size="micro", domain_state="running",
+            domain_state_code=libvirt.VIR_DOMAIN_RUNNING)
+        # Not defined
+        VirtualMachine.objects.create(instance_id="vm-4", account=self.account, host=listening,
+            instance_type="standard", instance_size="micro")
+        vms = list(VirtualMachine.objects.select_related("host").order_by("instance_id"))
+
+        live = {"vm-1": {"state": "running"}}
+        with mock.patch.object(domain_events, "get_domain_states", return_value=dict(live)) as get_domain_states:
+            states = domain_events.get_states(vms)
+
+        # Only the virtual machines on hosts without a listener are read from libvirt
+        self.assertEqual([vm.instance_id for vm in get_domain_states.call_args.args[0]], ["vm-1", "vm-2"])
+        self.assertEqual(sorted(states), ["vm-1", "vm-3"])
+        self.assertEqual(states["vm-3"]["state"], "running")
+        self.assertIsNone(states["vm-3"]["stats"])
+
+        # Stats are not cached
+        with mock.patch.object(domain_events, "get_domain_states", return_value=dict(live)) as get_domain_states:
+            domain_events.get_states(vms, stats=True)
+        self.assertEqual(len(get_domain_states.call_args.args[0]), 4)
+
+
+class TestCreateVmJob(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(vm_manager, "VM_ROOT_DIR", self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.account = Account.objects.create(account_id="acct-1", name="test")
+        self.user = User.objects.create(username="user-1", user_id="user-1", account=self.account)
+        HostMachine.objects.create(host_id="host-1", name="host-1", ip="10.0.0.1", cpu_count=8, memory_mb=16384)
+        # Reload the hosts of this test (and drop the reservations of the others)
+        scheduler.capacity_index.invalidate()
+
+
+    def launch(self, count:int = 1, private_ips:list = None, **kwargs) -> list:
+        with mock.patch.object(VmManager, "validate_launch_config"), \
+                mock.patch.object(tasks.task_create_vm, "delay") as delay:
+            launched = VmManager().launch_vms(self.user, InstanceDefinition("standard", "micro"), count,
+                private_ips, ImageId="gmi-1", **kwargs)
+        self.assertEqual(delay.call_count, count)
+        self.assertEqual([call.args[4]["PrivateIp"] for call in delay.call_args_list], [vm["private_ip"] for vm in launched])
+        return launched
+
+
+    def run_task(self, vm:dict, error:Exception = None):
+        def create(manager, instance_def, **kwargs):
+            with manager._stage("provision_disk"):
+                pass
+            with manager._stage("define_domain"):
+                if error:
+                    raise error
+
+        with mock.patch.object(VmManager, "_create_virtual_machine", autospec=True, side_effect=create):
+            tasks.task_create_vm(self.user.user_id, vm["virtual_machine_id"], vm["job_id"], "standard.micro",
+                {"ImageId": "gmi-1", "PrivateIp": vm["private_ip"]})
+
+
+    def test_launch(self):
+        launched = self.launch(2)
+
+        for vm in launched:
+            self.assertEqual(VirtualMachine.objects.get(instance_id=vm["virtual_machine_id"]).state, VirtualMachine.State.CREATING)
+            job = Job.objects.get(job_id=vm["job_id"])
+            self.assertEqual(job.state, Job.State.PENDING)
+            self.assertEqual(job.resource_id, vm["virtual_machine_id"])
+
+
+    def test_launch_private_ips(self):
+        launched = self.launch(3, ["10.0.0.10", "10.0.0.11", "10.0.0.12"])
+        self.assertEqual([vm["private_ip"] for vm in launched], ["10.0.0.10", "10.0.0.11", "10.0.0.12"])
+
+        # A single PrivateIp is fine for a single VM
+        self.assertEqual(self.launch(1, PrivateIp="10.0.0.20")[0]["private_ip"], "10.0.0.20")
+
+
+    def test_invalid_count(self):
+        for count, private_ips, kwargs in [
+            (0, None, {}),
+            (vm_manager.MAX_LAUNCH_COUNT + 1, None, {}),
+            # A count that doesn't match the IP addresses
+            (2, ["10.0.0.10", "10.0.0.11", "10.0.0.12"], {}),
+            (3, ["10.0.0.10", "10.0.0.11"], {}),
+            (2, ["10.0.0.10", "10.0.0.10"], {}),
+            (2, None, {"PrivateIp": "10.0.0.10"}),
+        ]:
+            with self.subTest(count=count, private_ips=private_ips, kwargs=kwargs), \
+                    self.assertRaises(InvalidLaunchConfiguration):
+                self.launch(count, private_ips, **kwargs)
+
+        self.assertFalse(VirtualMachine.objects.exists())
+        self.assertFalse(Job.objects.exists())
+
+
+    def test_launch_that_does_not_fit(self):
+        # The host has 8 CPUs for 1 CPU each
+        with self.assertRaises(PlacementError):
+            self.launch(9)
+
+        # Rejected as a whole
+        self.assertFalse(VirtualMachine.objects.exists())
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(len(self.launch(8)), 8)
+
+
+    def test_succeeded(self):
+        vm = self.launch()[0]
+        self.run_task(vm)
+
+        job = Job.objects.get(job_id=vm["job_id"])
+        self.assertEqual(job.state, Job.State.SUCCEEDED)
+        self.assertIsNone(job.stage)
+        self.assertEqual([stage["name"] for stage in job.stages], ["provision_disk", "define_domain"])
+        self.assertEqual({stage["state"] for stage in job.stages}, {"finished"})
+
+
+    def test_failed(self):
+        for clean_up in [True, False]:
+            with self.subTest(clean_up=clean_up), mock.patch.object(vm_manager, "CLEAN_UP_ON_FAIL", clean_up):
+                vm = self.launch()[0]
+                self.run_task(vm, LaunchError("No space left on device"))
+
+                job = Job.objects.get(job_id=vm["job_id"])
+                self.assertEqual(job.state, Job.State.FAILED)
+                self.assertEqual(job.error, "LaunchError: No space left on device")
+                self.assertEqual(job.stage, "define_domain")
+                self.assertEqual([stage["state"] for stage in job.stages], ["finished", "failed"])
+                self.assertIsNotNone(job.finished)
+                self.assertEqual(VirtualMachine.objects.get(instance_id=vm["virtual_machine_id"]).state, VirtualMachine.State.ERROR)
+
+
+    def test_failed_before_creating(self):
+        vm = self.launch()[0]
+        tasks.task_create_vm(self.user.user_id, vm["virtual_machine_id"], vm["job_id"], "standard.missing", {"ImageId": "gmi-1"})
+
+        self.assertEqual(Job.objects.get(job_id=vm["job_id"]).state, Job.State.FAILED)
+        self.assertEqual(VirtualMachine.objects.get(instance_id=vm["virtual_machine_id"]).state, VirtualMachine.State.ERROR)
+
+
+    def test_describe_job(self):
+        vm = self.launch()[0]
+        self.run_task(vm, LaunchError("No space left on device"))
+
+        factory = APIRequestFactory()
+        request = factory.get(f"/api/v1/vm/job/describe/{vm['job_id']}")
+        force_authenticate(request, user=self.user)
+        response = DescribeJob.as_view()(request, job_id=vm["job_id"])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"]["state"], Job.State.FAILED)
+        self.assertEqual(response.data["results"]["error"], "LaunchError: No space left on device")
+
+        request = factory.get("/api/v1/vm/job/describe/job-missing")
+        force_authenticate(request, user=self.user)
+        self.assertEqual(DescribeJob.as_view()(request, job_id="job-missing").status_code, 404)
+
+
+class TestLinkedClones(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.account = Account.objects.create(account_id="acct-1", name="test")
+
+        image_file = Path(self.tmp.name, "guest.qcow2")
+        image_file.write_bytes(b"guest image")
+        self.image = Image(image_type=Image.ImageType.GUEST, image_path=str(image_file), name="guest",
+            description="guest", state=Image.State.AVAILABLE,
+            metadata={"format": "qcow2", "virtual-size": 10 * 1024 ** 3, "actual-size": 11})
+        self.image.generate_id()
+        self.image.save()
+        self.image_manager = ImageManager(self.image.image_id)
+
+
+    def add_volume(self, volume_id:str, linked:bool) -> Volume:
+        volume = Volume(volume_id=volume_id, account=self.account, path=f"{self.tmp.name}/{volume_id}.qcow2")
+        volume.new_volume_from_image(self.image, linked)
+        volume.save()
+        return volume
+
+
+    def test_provision_linked_clone(self):
+        with mock.patch("vmmanager.image_manager.QemuImg") as qemu_img:
+            qemu_img.return_value.create.return_value = True
+            path = self.image_manager.provision_disk(self.image, Path(self.tmp.name), "vm-1", "20G", linked=True)
+
+        self.assertEqual(path, Path(self.tmp.name, "vm-1.qcow2"))
+        qemu_img.return_value.create.assert_called_once_with(str(path), "qcow2", "20G",
+            backing_file=self.image.image_path, backing_format="qcow2")
+        qemu_img.return_value.resize.assert_not_called()
+
+
+    def test_linked_clone_smaller_than_image(self):
+        with mock.patch("vmmanager.image_manager.QemuImg") as qemu_img:
+            qemu_img.return_value.create.return_value = True
+            self.image_manager.clone_image(self.image, Path(self.tmp.name), "vm-1", "5G")
+
+        # The overlay keeps the size of the image
+        self.assertIsNone(qemu_img.return_value.create.call_args.args[2])
+
+
+    def test_volume_from_image(self):
+        linked = self.add_volume("vol-linked", linked=True)
+        self.assertEqual(linked.parent_image, self.image.image_id)
+        self.assertEqual(linked.backing_file, self.image.image_path)
+        self.assertEqual(linked.format, "qcow2")
+
+        copy = self.add_volume("vol-copy", linked=False)
+        self.assertEqual(copy.parent_image, self.image.image_id)
+        self.assertIsNone(copy.backing_file)
+
+
+    def test_is_in_use(self):
+        # Full copies don't depend on the image
+        self.add_volume("vol-copy", linked=False)
+        self.assertFalse(self.image.is_in_use)
+
+        volume = self.add_volume("vol-linked", linked=True)
+        self.assertTrue(self.image.is_in_use)
+
+        volume.state = Volume.State.DELETED
+        volume.save()
+        self.assertFalse(self.image.is_in_use)
+
+
+    def test_delete_backing_image(self):
+        volume = self.add_volume("vol-linked", linked=True)
+
+        with self.assertRaises(ImageInUseError):
+            self.image_manager.delete_image()
+
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.state, Image.State.AVAILABLE)
+        self.assertFalse(self.image.deactivated)
+        self.assertTrue(os.path.exists(self.image.image_path))
+
+        # Once the linked clone is gone
+        volume.state = Volume.State.DELETED
+        volume.save()
+        self.image_manager.delete_image()
+
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.state, Image.State.DELETED)
+        self.assertTrue(self.image.deactivated)
+        self.assertFalse(os.path.exists(self.image.image_path))
+
+
+class TestDomainStates(TestCase):
+
+    def setUp(self):
+        account = Account.objects.create(account_id="acct-1", name="test")
+        remote = HostMachine.objects.create(host_id="host-1", name="host-1", ip="10.0.0.1",
+            libvirt_uri="qemu+ssh://10.0.0.1/system")
+        for instance_id, host in [("vm-1", None), ("vm-2", None), ("vm-3", remote), ("vm-4", remote)]:
+            VirtualMachine.objects.create(instance_id=instance_id, account=account, host=host,
+                instance_type="standard", instance_size="micro")
+        self.vms = list(VirtualMachine.objects.select_related("host").order_by("instance_id"))
+
+        self.conns = {}
+        for uri, records in [
+            ("qemu:///system", [("vm-1", libvirt.VIR_DOMAIN_RUNNING), ("other", libvirt.VIR_DOMAIN_RUNNING)]),
+            # vm-4 isn't defined
+            ("qemu+ssh://10.0.0.1/system", [("vm-3", libvirt.VIR_DOMAIN_SHUTOFF)]),
+        ]:
+            conn = mock.Mock()
+            conn.getAllDomainStats.return_value = [
+                (self.domain(name), {"state.state": state, "state.reason": 1, "cpu.time": 10, "balloon.current": 1024})
+                for name, state in records
+            ]
+            self.conns[uri] = conn
+
+        patcher = mock.patch.object(vm_instance, "connections")
+        self.connections = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connections.connection.side_effect = lambda uri: mock.MagicMock(
+            __enter__=mock.Mock(return_value=self.conns[uri]))
+
+
+    def domain(self, name:str):
+        domain = mock.Mock()
+        domain.name.return_value = name
+        return domain
+
+
+    def test_grouped_by_host(self):
+        states = get_domain_states(self.vms)
+
+        self.assertEqual(sorted(states), ["vm-1", "vm-3"])
+        self.assertEqual(states["vm-1"]["state"], "running")
+        self.assertEqual(states["vm-1"]["stats"], {"cpu_time": 10, "memory_kb": 1024, "max_memory_kb": None})
+        self.assertEqual(states["vm-3"]["state"], "shutoff")
+        # A single call per host
+        for conn in self.conns.values():
+            conn.getAllDomainStats.assert_called_once()
+
+
+    def test_retry_on_connection_error(self):
+        conn = self.conns["qemu:///system"]
+        conn.getAllDomainStats.side_effect = [libvirt.libvirtError("connection closed"), conn.getAllDomainStats.return_value]
+
+        with mock.patch.object(vm_instance, "is_connection_error", return_value=True):
+            states = get_domain_states(self.vms)
+
+        self.assertEqual(sorted(states), ["vm-1", "vm-3"])
+        self.assertEqual(conn.getAllDomainStats.call_count, 2)
+
+
+    def test_unreachable_host(self):
+        self.conns["qemu+ssh://10.0.0.1/system"].getAllDomainStats.side_effect = libvirt.libvirtError("unreachable")
+
+        with mock.patch.object(vm_instance, "is_connection_error", return_value=True):
+            states = get_domain_states(self.vms)
+
+        # The other host is still read
+        self.assertEqual(sorted(states), ["vm-1"])
+
+
+CAPABILITIES_XML = """<capabilities>
+  <host>
+    <cpu>
+      <arch>x86_64</arch>
+      <model>Skylake-Server</model>
+      <vendor>Intel</vendor>
+    </cpu>
+    <topology>
+      <cells num="2">
+        <cell id="0">
+          <memory unit="KiB">16777216</memory>
+          <pages unit="KiB" size="4">4194304</pages>
+          <pages unit="KiB" size="2048">512</pages>
+          <cpus num="4">
+            <cpu id="0" socket_id="0" core_id="0" siblings="0"/>
+            <cpu id="1" socket_id="0" core_id="1" siblings="1"/>
+            <cpu id="2" socket_id="0" core_id="2" siblings="2"/>
+            <cpu id="3" socket_id="0" core_id="3" siblings="3"/>
+          </cpus>
+        </cell>
+        <cell id="1">
+          <memory unit="KiB">16777216</memory>
+          <pages unit="KiB" size="4">4194304</pages>
+          <cpus num="4">
+            <cpu id="4" socket_id="1" core_id="0" siblings="4"/>
+            <cpu id="5" socket_id="1" core_id="1" siblings="5"/>
+            <cpu id="6" socket_id="1" core_id="2" siblings="6"/>
+            <cpu id="7" socket_id="1" core_id="3" siblings="7"/>
+          </cpus>
+        </cell>
+      </cells>
+    </topology>
+  </host>
+</capabilities>"""
+
+
+class TestHostInventory(TestCase):
+
+    def setUp(self):
+        self.host = HostMachine.objects.create(host_id="host-1", name="host-1", ip="10.0.0.1")
+        self.conn = mock.Mock()
+        self.conn.getInfo.return_value = ["x86_64", 32768, 8, 2400, 2, 2, 4, 1]
+        self.conn.getCapabilities.return_value = CAPABILITIES_XML
+        self.conn.getFreeMemory.return_value = 20 * 1024 ** 3
+        self.conn.getCellsFreeMemory.return_value = [8 * 1024 ** 3, 12 * 1024 ** 3]
+
+        for name, value in [
+            ("connections", mock.MagicMock()),
+            ("CPU_ALLOCATION_RATIO", 4.0),
+            ("RESERVED_HOST_MEMORY_MB", 2048),
+            ("RESERVED_HOST_CPUS", {0, 1}),
+        ]:
+            patcher = mock.patch.object(host_inventory, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        host_inventory.connections.connection.return_value.__enter__.return_value = self.conn
+        patcher = mock.patch.object(HostInventory, "get_storage", return_value=(10 * 1024 ** 4, 4 * 1024 ** 4))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_sample(self):
+        sample = HostInventory(self.host).sample()
+
+        self.assertEqual((sample.cpu_count, sample.memory_mb, sample.free_memory_mb), (8, 32768, 20480))
+        self.assertEqual((sample.storage_bytes, sample.free_storage_bytes), (10 * 1024 ** 4, 4 * 1024 ** 4))
+        self.assertEqual([cell["free_memory_mb"] for cell in sample.numa_cells], [8192, 12288])
+
+        host = HostMachine.objects.get(host_id="host-1")
+        # 6 cores left after the reserved ones, 4 vCPUs each
+        self.assertEqual(host.cpu_count, 24)
+        self.assertEqual(host.memory_mb, 30720)
+        self.assertEqual(host.storage_bytes, 10 * 1024 ** 4)
+
+        inventory = host.metadata["inventory"]
+        self.assertEqual((inventory["cpu_model"], inventory["cpu_vendor"]), ("Skylake-Server", "Intel"))
+        self.assertEqual((inventory["sockets"], inventory["cores"], inventory["threads"]), (2, 4, 1))
+        self.assertEqual(inventory["numa_nodes"], 2)
+        self.assertEqual(inventory["topology"], [
+            {"id": 0, "memory_mb": 16384, "cpu_ids": [0, 1, 2, 3], "hugepages": {"2048": 512}},
+            {"id": 1, "memory_mb": 16384, "cpu_ids": [4, 5, 6, 7], "hugepages": {}},
+        ])
+
+
+    def test_sample_without_topology(self):
+        self.conn.getCapabilities.return_value = "<capabilities><host><cpu><arch>x86_64</arch></cpu></host></capabilities>"
+        with mock.patch.object(host_inventory, "RESERVED_HOST_CPUS", set()):
+            HostInventory(self.host).sample()
+
+        host = HostMachine.objects.get(host_id="host-1")
+        self.assertEqual(host.cpu_count, 32)
+        self.assertEqual(host.metadata["inventory"]["topology"], [])
+
+
+class TestImageBuild(TestCase):
+
+    def setUp(self):
+        self.image = Image(image_type=Image.ImageType.GUEST, name="capture", description="capture")
+        self.image.generate_id()
+        self.image.save()
+        self.build = ImageBuild(self.image, ["capture", "sparsify"])
+
+
+    def saved_build(self) -> dict:
+        return Image.objects.get(image_id=self.image.image_id).metadata["build"]
+
+
+    def test_stages(self):
+        self.assertEqual(self.saved_build()["state"], "pending")
+
+        with mock.patch.object(image_build, "PROGRESS_SAVE_INTERVAL", 0):
+            with self.build.stage("capture") as stage:
+                stage.progress(12.53, 1024)
+                saved = self.saved_build()
+                self.assertEqual(saved["state"], "running")
+                self.assertEqual(saved["stage"], "capture")
+                self.assertEqual(saved["stages"][0]["progress"], 12.5)
+                self.assertEqual(saved["stages"][0]["bytes"], 1024)
+                self.assertEqual(saved["stages"][1]["state"], "pending")
+
+            with self.build.stage("sparsify"):
+                pass
+
+        saved = self.saved_build()
+        self.assertEqual(saved["state"], "finished")
+        self.assertNotIn("stage", saved)
+        self.assertIsNotNone(saved["finished"])
+        for record in saved["stages"]:
+            self.assertEqual(record["state"], "finished")
+            self.assertEqual(record["progress"], 100)
+
+
+    def test_progress_is_throttled(self):
+        with self.build.stage("capture") as stage:
+            stage.progress(50)
+            # Saved every PROGRESS_SAVE_INTERVAL seconds at most
+            self.assertEqual(self.saved_build()["stages"][0]["progress"], 0)
+            self.assertEqual(self.image.metadata["build"]["stages"][0]["progress"], 50)
+
+
+    def test_failed_stage(self):
+        with self.assertRaises(ValueError):
+            with self.build.stage("capture"):
+                raise ValueError("Failed copying image")
+
+        saved = self.saved_build()
+        self.assertEqual(saved["state"], "failed")
+        self.assertEqual(saved["stage"], "capture")
+        self.assertEqual(saved["stages"][0]["state"], "failed")
+        self.assertEqual(saved["stages"][0]["error"], "Failed copying image")
+        self.assertEqual(saved["stages"][1]["state"], "pending")
+
+
+class TestLiveCapture(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(vm_manager, "VM_ROOT_DIR", self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        account = Account.objects.create(account_id="acct-1", name="test")
+        self.user = User.objects.create(username="test", user_id="user-1", account=account)
+        self.disk_path = f"{self.tmp.name}/vm-1.qcow2"
+        Volume.objects.create(volume_id="vol-1", account=account, path=self.disk_path)
+        VirtualMachine.objects.create(instance_id="vm-1", account=account, instance_type="standard",
+            instance_size="micro", image_metadata={"volume_id": "vol-1"})
+        Path(self.tmp.name, "acct-1", "vm-1").mkdir(parents=True)
+
+        self.domain = mock.Mock()
+        self.domain.XMLDesc.return_value = f"""<domain><name>vm-1</name><devices>
+            <disk type='file' device='disk'><driver type='qcow2'/><source file='{self.disk_path}'/><target dev='vda' bus='virtio'/></disk>
+            <disk type='file' device='disk'><driver type='qcow2'/><source file='{self.tmp.name}/data.qcow2'/><target dev='vdb' bus='virtio'/></disk>
+        </devices></domain>"""
+        self.domain.state.return_value = (libvirt.VIR_DOMAIN_RUNNING, 1)
+        self.domain.snapshotCreateXML.side_effect = self.create_overlay
+        self.domain.blockJobInfo.side_effect = [{"cur": 0, "end": 0}, {"cur": 5, "end": 10}, {"cur": 10, "end": 10}]
+        self.overlays = []
+
+        conn = mock.Mock()
+        conn.lookupByName.return_value = self.domain
+        for patcher in [
+            mock.patch.object(vm_instance, "connections", **{"get.return_value": conn}),
+            mock.patch.object(vm_instance.time, "sleep"),
+            mock.patch.object(vm_manager, "COMPRESS_IMAGES", False),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+    def create_overlay(self, xml:str, flags:int):
+        # libvirt creates the overlay and switches the disk to it
+        disks = xmltodict.parse(xml)["domainsnapshot"]["disks"]["disk"]
+        overlay = Path(disks[0]["source"]["@file"])
+        overlay.write_bytes(b"overlay")
+        self.overlays.append(overlay)
+
+
+    def capture(self, convert:bool = True, sysprep:bool = True):
+        with mock.patch.object(vm_manager, "QemuImg") as qemu_img, \
+                mock.patch.object(vm_manager, "VirtTools") as virt_tools:
+            # A linked clone, flattened with qemu-img convert
+            qemu_img.return_value.info.return_value = {"format": "qcow2", "virtual-size": 1024, "backing-filename": "base.qcow2"}
+            qemu_img.return_value.convert.return_value = convert
+            virt_tools.return_value.sysprep.side_effect = lambda path: self.assert_committed() or sysprep
+            with self.assertRaises(ImagePrepError):
+                VmManager().create_virtual_machine_image("vm-1", self.user, "capture", "capture", live=True)
+
+
+    def assert_committed(self):
+        self.domain.snapshotCreateXML.assert_called_once()
+        xml = self.domain.snapshotCreateXML.call_args[0][0]
+        self.assertIn(f"<disk name='vda' snapshot='external'><driver type='qcow2'/><source file='{self.overlays[0]}'/></disk>", xml)
+        self.assertIn("<disk name='vdb' snapshot='no'/>", xml)
+        self.domain.blockCommit.assert_called_once_with("vda", None, None, 0,
+            libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE | libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW)
+        self.domain.blockJobAbort.assert_called_once_with("vda", libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+        self.assertFalse(self.overlays[0].exists())
+
+
+    def saved_build(self) -> dict:
+        return Image.objects.get(image_type=Image.ImageType.USER).metadata["build"]
+
+
+    def test_convert_fails(self):
+        self.capture(convert=False)
+
+        self.assert_committed()
+        self.assertEqual(self.overlays[0].parent, Path(self.tmp.name, "acct-1", "vm-1"))
+        # The VM kept running
+        self.domain.shutdown.assert_not_called()
+        self.domain.destroy.assert_not_called()
+        saved = self.saved_build()
+        self.assertEqual(saved["stage"], "capture")
+        self.assertEqual(saved["stages"][0]["state"], "failed")
+        self.assertEqual(saved["stages"][1]["state"], "pending")
+
+
+    def test_sysprep_fails(self):
+        # The overlay is merged back right after the capture, before sysprep
+        self.capture(sysprep=False)
+
+        self.assert_committed()
+        saved = self.saved_build()
+        self.assertEqual(saved["stage"], "sysprep")
+        self.assertEqual(saved["stages"][0]["state"], "finished")
+        self.assertEqual(saved["stages"][1]["state"], "failed")
+
+
+    def test_commit_job_ends_unexpectedly(self):
+        self.domain.blockJobInfo.side_effect = [{"cur": 5, "end": 10}, {}]
+        instance = VirtualMachineInstance("vm-1")
+        instance.create_disk_snapshot("vda", f"{self.tmp.name}/overlay.qcow2")
+
+        with self.assertRaises(VirtualMachineSnapshotError):
+            instance.commit_disk_snapshot("vda")
+        self.domain.blockJobAbort.assert_not_called()
@@ -2,13 +2,21 @@ from django.urls import path
 from .views import (
     CreateVM,
     DescribeVM,
+    DescribeVMEvents,
     TerminateVM,
+    BulkTerminateVM,
     ModifyVM,
+    BulkModifyVM,
+    DescribeJob,
+    DescribeHost,
+    LaunchMetrics,
     CreateVolume,
     DescribeVolume,
     DeleteVolume,
     ModifyVolume,
     RegisterImage,
+    UploadImage,
+    UploadImageData,
     DescribeImage,
     DeleteImage,
     ModifyImage,
@@ -18,13 +26,21 @@ app_name = 'vmmanager'
 urlpatterns = [
     path('vm/create', CreateVM.as_view()),
     path('vm/describe/<str:vm_id>', DescribeVM.as_view()),
+    path('vm/events/<str:vm_id>', DescribeVMEvents.as_view()),
+    path('vm/terminate', BulkTerminateVM.as_view()),
     path('vm/terminate/<str:vm_id>', TerminateVM.as_view()),
+    path('vm/modify', BulkModifyVM.as_view()),
     path('vm/modify/<str:vm_id>', ModifyVM.as_view()),
+    path('job/describe/<str:job_id>', DescribeJob.as_view()),
+    path('host/describe/<str:host_id>', DescribeHost.as_view()),
+    path('metrics/launch', LaunchMetrics.as_view()),
     path('volume/create', CreateVolume.as_view()),
     path('volume/describe/<str:vol_id>', DescribeVolume.as_view()),
     path('volume/terminate/<str:vol_id>', DeleteVolume.as_view()),
     path('volume/modify/<str:vol_id>', ModifyVolume.as_view()),
     path('image/guest/register', RegisterImage.as_view()),
+    path('image/<str:img_type>/upload', UploadImage.as_view()),
+    path('image/<str:img_type>/upload/<str:img_id>', UploadImageData.as_view()),
     path('image/<str:img_type>/describe/<str:img_id>', DescribeImage.as_view()),
     path('image/<str:img_type>/delete/<str:img_id>', DeleteImage.as_view()),
     path('image/<str:img_type>/modify/<str:img_id>', ModifyImage.as_view()),
@@ -2,21 +2,41 @@ import logging
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework import status
+from rest_framework.response import Response
 from api.api_view import HelperView
+from echome.metrics import metrics, summarize
+from network.manager import VirtualNetworkManager
 from .instance_definitions import InstanceDefinition, InvalidInstanceType
-from .models import VirtualMachine, Volume, Image
-from .serializers import VirtualMachineSerializer, VolumeSerializer, ImageSerializer
+from .models import DomainEvent, HostMachine, VirtualMachine, Volume, Image, Job
+from .serializers import (
+    DomainEventSerializer,
+    HostMachineSerializer,
+    HostSampleSerializer,
+    VirtualMachineSerializer,
+    VolumeSerializer,
+    ImageSerializer,
+    JobSerializer
+)
 from .image_manager import ImageManager
-from .vm_manager import VmManager
-from .tasks import task_create_image, task_terminate_instance
+from .image_upload import ImageUpload
+from .vm_manager import VmManager, MAX_LAUNCH_COUNT
+from .scheduler import STRATEGIES, capacity_index
+from .disk_profiles import DISK_PROFILES
+from .libvirt_connection import connections
+from .tasks import task_create_image, task_terminate_instance, task_terminate_instances, task_power_action
+from .power_actions import ACTIONS as POWER_ACTIONS, MAX_BULK_ACTION_COUNT
 from .vm_instance import VirtualMachineInstance
+from .domain_events import get_cached_state, get_states
 from .exceptions import (
     InvalidLaunchConfiguration, 
     LaunchError,
     VirtualMachineDoesNotExist,
     VirtualMachineConfigurationError, 
     InvalidImagePath, 
-    ImageAlreadyExistsError
+    ImageAlreadyExistsError,
+    InvalidImageUpload,
+    UploadOffsetMismatch,
+    PlacementError
 )
 
 logger = logging.getLogger(__name__)
@@ -53,50 +73,90 @@ class CreateVM(HelperView, APIView):
                 status.HTTP_400_BAD_REQUEST
             )
         
+        if "PlacementStrategy" in request.POST and request.POST["PlacementStrategy"] not in STRATEGIES:
+            return self.error_response(
+                f"Provided PlacementStrategy is not valid. Valid strategies: {', '.join(STRATEGIES)}",
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        if "StartOrder" in request.POST and not request.POST["StartOrder"].lstrip("-").isdigit():
+            return self.error_response(
+                "Provided StartOrder is not a number.",
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        if "DiskProfile" in request.POST and request.POST["DiskProfile"] not in DISK_PROFILES:
+            return self.error_response(
+                f"Provided DiskProfile is not valid. Valid profiles: {', '.join(DISK_PROFILES)}",
+                status.HTTP_400_BAD_REQUEST
+            )
+
         tags = self.unpack_tags(request)
 
         disk_size = request.POST["DiskSize"] if "DiskSize" in request.POST else "10G"
-        
-        vm = VmManager()
+
+        # Sent to the worker, so only JSON serializable values
+        launch_config = {
+            "Tags": tags,
+            "KeyName": request.POST["KeyName"] if "KeyName" in request.POST else None,
+            "NetworkProfile": request.POST["NetworkProfile"],
+            "PrivateIp": request.POST["PrivateIp"] if "PrivateIp" in request.POST else "",
+            "ImageId": request.POST["ImageId"],
+            "DiskSize": disk_size,
+            "EnableVnc": "true" if "EnableVnc" in request.POST and request.POST["EnableVnc"] == "true" else "false",
+            "VncPort": request.POST["VncPort"] if "VncPort" in request.POST else None,
+            "UserDataScript": request.POST["UserDataScript"] if "UserDataScript" in request.POST else None,
+            "EfiBoot": "false", #TODO: Configurable Option
+            "PlacementStrategy": request.POST["PlacementStrategy"] if "PlacementStrategy" in request.POST else None,
+            "StartOrder": request.POST["StartOrder"] if "StartOrder" in request.POST else None,
+            "DiskProfile": request.POST["DiskProfile"] if "DiskProfile" in request.POST else None,
+        }
 
         try:
-            vm_id = vm.create_vm(
-                user=request.user, 
-                instance_def=instanceDefinition, 
-                Tags=tags,
-                KeyName=request.POST["KeyName"] if "KeyName" in request.POST else None,
-                NetworkProfile=request.POST["NetworkProfile"],
-                PrivateIp=request.POST["PrivateIp"] if "PrivateIp" in request.POST else "",
-                ImageId=request.POST["ImageId"],
-                DiskSize=disk_size,
-                EnableVnc=True if "EnableVnc" in request.POST and request.POST["EnableVnc"] == "true" else False,
-                VncPort=request.POST["VncPort"] if "VncPort" in request.POST else None,
-                UserDataScript=request.POST["UserDataScript"] if "UserDataScript" in request.POST else None,
-                EfiBoot="false", #TODO: Configurable Option
+            count = int(request.POST["Count"]) if "Count" in request.POST else 1
+            if "PrivateIps" in request.POST:
+                private_ips = [ip.strip() for ip in self.unpack_comma_separated_list("PrivateIps", request.POST)]
+            elif "PrivateIpRange" in request.POST:
+                private_ips = VirtualNetworkManager().expand_ip_range(request.POST["PrivateIpRange"], MAX_LAUNCH_COUNT)
+            else:
+                private_ips = None
+
+            # The VMs are created in the CREATING state, the workers do the rest
+            launched = VmManager().launch_vms(
+                request.user,
+                instanceDefinition,
+                count=count,
+                private_ips=private_ips,
+                **launch_config
             )
         except InvalidLaunchConfiguration as e:
             logger.debug(e)
             return self.error_response(
-                "InvalidLaunchConfiguration: A supplied value was invalid and could not successfully build the virtual machine.",
+                f"InvalidLaunchConfiguration: {e}",
                 status = status.HTTP_400_BAD_REQUEST
             )
+        except PlacementError as e:
+            logger.debug(e)
+            return self.error_response(
+                f"PlacementError: {e}",
+                status = status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         except ValueError as e:
             logger.debug(e)
             return self.error_response(
                 "ValueError: A supplied value was invalid and could not successfully build the virtual machine.",
                 status = status.HTTP_400_BAD_REQUEST
             )
-        except LaunchError as e:
-            logger.exception(e)
-            return self.error_response(
-                "There was an error when creating the instance.",
-                status = status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
         except Exception as e:
             logger.exception(e)
             return self.internal_server_error_response()
-                
-        return self.success_response({"virtual_machine_id": vm_id})
+
+        if "Count" not in request.POST:
+            return self.success_response({
+                "virtual_machine_id": launched[0]["virtual_machine_id"],
+                "job_id": launched[0]["job_id"],
+            })
+        return self.success_response({"virtual_machines": launched})
 
 
 class DescribeVM(HelperView, APIView):
@@ -107,23 +167,33 @@ class DescribeVM(HelperView, APIView):
 
         try:
             if vm_id == "all":
-                vms = VirtualMachine.objects.filter(
+                vms = list(VirtualMachine.objects.filter(
                     account=request.user.account
-                )
+                ).select_related("host"))
             else:
                 vms = []
-                vms.append(VirtualMachine.objects.get(
+                vms.append(VirtualMachine.objects.select_related("host").get(
                     account=request.user.account,
                     instance_id=vm_id
                 ))
             
+            # From the domain event listener's cache, or one call per host for all of the
+            # VMs. Stats are not cached, they are always read from libvirt.
+            domain_states = get_states(vms, stats=request.query_params.get("Stats") == "true")
+
             for vm in vms:
                 j_obj = VirtualMachineSerializer(vm).data
-                state, state_int, _  = VirtualMachineInstance(vm.instance_id).get_vm_state()
+                domain_state = domain_states.get(vm.instance_id)
+                if domain_state:
+                    state, state_int, stats = domain_state["state"], domain_state["code"], domain_state["stats"]
+                else:
+                    # Not defined in libvirt (yet), e.g. while the VM is being created
+                    state, state_int, stats = vm.state.lower(), None, None
                 j_obj["state"] = {
                     "code": state_int,
                     "state": state,
                 }
+                j_obj["stats"] = stats
                 i.append(j_obj)
         except VirtualMachine.DoesNotExist as e:
             logger.debug(e)
@@ -135,14 +205,172 @@ class DescribeVM(HelperView, APIView):
         return self.success_response(i)
 
 
+class DescribeVMEvents(HelperView, APIView):
+    """History of the lifecycle, reboot and guest agent events of a virtual machine, recorded by
+    the domain event listener. Also available after the virtual machine is terminated."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, vm_id:str):
+        events = DomainEvent.objects.filter(
+            account=request.user.account,
+            instance_id=vm_id
+        )
+        # Only crashes, unexpected shutoffs and the like
+        if request.query_params.get("Unexpected") == "true":
+            events = events.filter(unexpected=True)
+
+        try:
+            limit = int(request.query_params.get("Limit", 100))
+        except ValueError:
+            return self.error_response("Limit must be a number.", status=status.HTTP_400_BAD_REQUEST)
+
+        return self.success_response(DomainEventSerializer(events[:limit], many=True).data)
+
+
+class DescribeJob(HelperView, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id:str):
+        try:
+            job = Job.objects.get(
+                account=request.user.account,
+                job_id=job_id
+            )
+        except Job.DoesNotExist as e:
+            logger.debug(e)
+            return self.not_found_response()
+        except Exception as e:
+            logger.exception(e)
+            return self.internal_server_error_response()
+
+        return self.success_response(JobSerializer(job).data)
+
+
+class DescribeHost(HelperView, APIView):
+    """Capacity of the hosts: what can be allocated to virtual machines, what is committed to them
+    and the latest sample of the host's resources. Read from the host inventory and the scheduler's
+    capacity index, without connecting to the hosts."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, host_id:str):
+        try:
+            if host_id == "all":
+                hosts = HostMachine.objects.all()
+            else:
+                hosts = [HostMachine.objects.get(host_id=host_id)]
+        except HostMachine.DoesNotExist as e:
+            logger.debug(e)
+            return self.not_found_response()
+
+        committed = {capacity.host_id: capacity for capacity in capacity_index.hosts()}
+
+        i = []
+        for host in hosts:
+            host_data = HostMachineSerializer(host).data
+            sample = host.samples.first()
+            host_data["latest_sample"] = HostSampleSerializer(sample).data if sample else None
+            capacity = committed.get(host.host_id)
+            host_data["committed"] = {
+                "cpu": capacity.cpu_committed,
+                "memory_mb": capacity.memory_committed_mb,
+                "storage_bytes": capacity.storage_committed,
+                "virtual_machines": capacity.vm_count,
+                "in_flight": capacity.in_flight,
+                "pinned_cpus": sorted(capacity.pinned_cpus),
+            } if capacity else None
+            # Connection of this process to the host, if it has one
+            host_data["connection"] = connections.health(host.libvirt_uri).get(host.libvirt_uri)
+            i.append(host_data)
+
+        return self.success_response(i)
+
+
+class LaunchMetrics(HelperView, APIView):
+    """Launch latency of the most recent virtual machines, per image and instance type, with a
+    breakdown per stage of the creation process. Also returns the metrics of this API process."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            limit = int(request.GET.get("Limit", 1000))
+        except ValueError:
+            return self.error_response(
+                "ValueError: Limit must be a number.",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+
+        vms = VirtualMachine.objects.filter(
+            account=request.user.account,
+            metadata__has_key="timings",
+        ).order_by("-created")
+        if "InstanceType" in request.GET:
+            instance_class, _, instance_size = request.GET["InstanceType"].partition(".")
+            vms = vms.filter(instance_type=instance_class, instance_size=instance_size)
+
+        groups = {}
+        for vm in vms[:limit]:
+            image_id = vm.image_metadata["image_id"] if vm.image_metadata else None
+            if "ImageId" in request.GET and image_id != request.GET["ImageId"]:
+                continue
+
+            key = (image_id, f"{vm.instance_type}.{vm.instance_size}")
+            group = groups.setdefault(key, {"total": [], "stages": {}})
+            timings = vm.metadata["timings"]
+            group["total"].append(timings["total"])
+            for stage, duration in timings["stages"].items():
+                group["stages"].setdefault(stage, []).append(duration)
+
+        launches = [
+            {
+                "image_id": image_id,
+                "instance_type": instance_type,
+                "total": summarize(group["total"]),
+                "stages": {stage: summarize(durations) for stage, durations in group["stages"].items()},
+            }
+            for (image_id, instance_type), group in groups.items()
+        ]
+
+        return self.success_response({
+            "launches": launches,
+            "process": metrics.snapshot(),
+        })
+
+
+class BulkVMSelection:
+    """Selects the virtual machines of a bulk action by ID (VmIds) or by tags"""
+
+    def select_vms(self, request, vms):
+        """Returns the IDs of the selected virtual machines, or the error response"""
+        tags = self.unpack_tags(request)
+        if "VmIds" in request.POST:
+            vms = vms.filter(instance_id__in=[vm_id.strip() for vm_id in self.unpack_comma_separated_list("VmIds", request.POST)])
+        elif tags:
+            # Virtual machines with all of the tags
+            vms = vms.filter(tags__contains=tags)
+        else:
+            return self.error_response(
+                "Select the virtual machines with VmIds or tags (Tag.1.Key, Tag.1.Value, ...).",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+
+        vm_ids = list(vms.values_list("instance_id", flat=True)[:MAX_BULK_ACTION_COUNT + 1])
+        if not vm_ids:
+            return self.not_found_response()
+        if len(vm_ids) > MAX_BULK_ACTION_COUNT:
+            return self.error_response(
+                f"More than {MAX_BULK_ACTION_COUNT} virtual machines selected.",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+        return vm_ids
+
+
 class TerminateVM(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, vm_id:str):
 
-        try:
-            instance = VirtualMachineInstance(vm_id)
-        except VirtualMachineDoesNotExist:
+        # The worker also terminates virtual machines that were never defined in libvirt
+        if not VirtualMachine.objects.filter(account=request.user.account, instance_id=vm_id).exists():
             return self.not_found_response()
 
         try:
@@ -154,6 +382,27 @@ class TerminateVM(HelperView, APIView):
         return self.request_success_response()
 
 
+class BulkTerminateVM(BulkVMSelection, HelperView, APIView):
+    """Terminate many virtual machines at once, selected by ID or by tags. They are shut down
+    at the same time by the worker, see VmManager.terminate_instances()."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        vm_ids = self.select_vms(request, VirtualMachine.objects.filter(account=request.user.account))
+        if isinstance(vm_ids, Response):
+            return vm_ids
+
+        try:
+            task_terminate_instances.delay(vm_ids, request.user.user_id)
+        except Exception as e:
+            logger.exception(e)
+            return self.internal_server_error_response()
+
+        return self.success_response({
+            "virtual_machines": vm_ids,
+        })
+
+
 class ModifyVM(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
@@ -162,13 +411,31 @@ class ModifyVM(HelperView, APIView):
             return self.missing_parameter_response(missing_params)
 
         try:
-            instance = VirtualMachineInstance(vm_id)
-        except VirtualMachineDoesNotExist:
+            vm = VirtualMachine.objects.select_related("host").get(
+                account=request.user.account,
+                instance_id=vm_id
+            )
+        except VirtualMachine.DoesNotExist:
             return self.not_found_response()
 
         action = request.POST['Action'].lower()
         logger.debug(f"Action: {action}")
 
+        # Checked with the domain event listener's cache, without calling libvirt. Start and stop
+        # check the live state of the domain, the cache may not have caught up with it yet.
+        cached = get_cached_state(vm)
+        if cached:
+            if action == 'create-image' and request.POST.get("Quiesce") == "true" and cached["guest_agent_connected"] is False:
+                return self.error_response(
+                    "Quiesce requires the qemu guest agent, which is not connected in the VM.",
+                    status = status.HTTP_409_CONFLICT
+                )
+
+        try:
+            instance = VirtualMachineInstance(vm_id)
+        except VirtualMachineDoesNotExist:
+            return self.not_found_response()
+
         if action == 'stop':
             try:
                 instance.stop(wait=False)
@@ -204,7 +471,9 @@ class ModifyVM(HelperView, APIView):
             task_create_image.delay(
                 vm_id, 
                 request.user.user_id, 
-                prepared_id = new_vmi_id
+                prepared_id = new_vmi_id,
+                live = True if "Live" in request.POST and request.POST["Live"] == "true" else False,
+                quiesce = True if "Quiesce" in request.POST and request.POST["Quiesce"] == "true" else False,
             )
 
             return self.request_success_response(new_vmi_id)
@@ -216,6 +485,50 @@ class ModifyVM(HelperView, APIView):
         return self.success_response()
 
 
+class BulkModifyVM(BulkVMSelection, HelperView, APIView):
+    """Start or stop many virtual machines at once, selected by ID or by tags. The workers run
+    the action with a bounded concurrency (see power_actions.py), the result of each virtual
+    machine is in the job."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if missing_params := self.require_parameters(request, ["Action"]):
+            return self.missing_parameter_response(missing_params)
+
+        action = request.POST['Action'].lower()
+        if action not in POWER_ACTIONS:
+            return self.error_response(
+                f"Unknown action. Valid actions: {', '.join(POWER_ACTIONS)}",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+
+        vm_ids = self.select_vms(request, VirtualMachine.objects.filter(
+            account=request.user.account,
+            state=VirtualMachine.State.AVAILABLE
+        ))
+        if isinstance(vm_ids, Response):
+            return vm_ids
+
+        job = Job(
+            account=request.user.account,
+            job_type=Job.JobType.POWER_ACTION,
+        )
+        job.generate_id()
+        job.save()
+
+        try:
+            task_power_action.delay(job.job_id, action, vm_ids)
+        except Exception as e:
+            logger.exception(e)
+            job.fail(f"{type(e).__name__}: {e}")
+            return self.internal_server_error_response()
+
+        return self.success_response({
+            "job_id": job.job_id,
+            "virtual_machines": vm_ids,
+        })
+
+
 class CreateVolume(HelperView, APIView):
     pass
 
@@ -286,6 +599,122 @@ class RegisterImage(HelperView, APIView):
         return self.success_response(id)
 
 
+class UploadImage(HelperView, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, img_type:str):
+        """Start a new image upload. Returns the image ID to upload the image data to."""
+        if img_type not in ["guest", "user"]:
+            return self.error_response(
+                "Unknown type",
+                status = status.HTTP_404_NOT_FOUND
+            )
+
+        if missing_params := self.require_parameters(request, ["ImageName", "ImageDescription", "ImageSize"]):
+            return self.missing_parameter_response(missing_params)
+
+        image_manager = ImageManager()
+        try:
+            size = int(request.POST["ImageSize"])
+            if img_type == "guest":
+                image_id = image_manager.prepare_guest_image(
+                    request.POST["ImageName"],
+                    request.POST["ImageDescription"],
+                )
+            else:
+                image_id = image_manager.prepare_user_image(
+                    request.user,
+                    request.POST["ImageName"],
+                    request.POST["ImageDescription"],
+                    self.unpack_tags(request),
+                )
+            ImageUpload(image_manager).start(size)
+        except (ValueError, InvalidImageUpload) as e:
+            logger.debug(e)
+            if image_manager.image:
+                image_manager.mark_image_as_failed()
+            return self.error_response(
+                "ValueError: ImageSize must be a positive number of bytes.",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            logger.exception(e)
+            return self.internal_server_error_response()
+
+        return self.success_response({"image_id": image_id, "offset": 0})
+
+
+class UploadImageData(HelperView, APIView):
+    """Receives the data of an image upload. The request body is the raw image data starting at
+    the offset in the `Upload-Offset` header. If the connection drops, get the offset that was 
+    received with a GET request and resume the upload from there."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, img_type:str, img_id:str):
+        try:
+            upload = self._get_upload(request, img_type, img_id)
+        except Image.DoesNotExist:
+            return self.not_found_response()
+
+        return self.success_response({
+            "image_id": img_id,
+            "state": upload.image.state,
+            "offset": upload.offset if upload.image.state == Image.State.CREATING else None,
+            "size": upload.size if "upload" in upload.image.metadata else None,
+        })
+
+
+    def put(self, request, img_type:str, img_id:str):
+        try:
+            upload = self._get_upload(request, img_type, img_id)
+        except Image.DoesNotExist:
+            return self.not_found_response()
+
+        try:
+            offset = int(request.headers.get("Upload-Offset", "0"))
+        except ValueError:
+            return self.error_response(
+                "ValueError: Upload-Offset must be a number.",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            # request.stream reads the body as it arrives instead of loading it into memory
+            new_offset = upload.write(request.stream, offset)
+        except UploadOffsetMismatch as e:
+            return Response({
+                'success': False,
+                'details': str(e),
+                'results': {"offset": e.offset},
+            }, status=status.HTTP_409_CONFLICT)
+        except InvalidImageUpload as e:
+            return self.error_response(
+                f"InvalidImageUpload: {e}",
+                status = status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            logger.exception(e)
+            return self.internal_server_error_response()
+
+        upload.image.refresh_from_db()
+        return self.success_response({
+            "image_id": img_id,
+            "state": upload.image.state,
+            "offset": new_offset,
+        })
+
+
+    def _get_upload(self, request, img_type:str, img_id:str) -> ImageUpload:
+        if img_type == "guest":
+            Image.objects.get(image_type=Image.ImageType.GUEST, image_id=img_id)
+        elif img_type == "user":
+            Image.objects.get(image_type=Image.ImageType.USER, image_id=img_id, account=request.user.account)
+        else:
+            raise Image.DoesNotExist
+
+        return ImageUpload(ImageManager(img_id))
+
+
 class DeleteImage(HelperView, APIView):
     pass  
 
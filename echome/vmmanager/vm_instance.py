@@ -1,16 +1,91 @@
 import libvirt
-import xmltodict
 import logging
 import time
 from typing import List, Dict
 from network.models import VirtualNetwork
-from .models import Volume, VirtualMachine
+from .models import Volume, VirtualMachine, HostMachine
 from .instance_definitions import InstanceDefinition
+from .domain_config import DomainConfig
+from .disk_profiles import DISK_PROFILES
+from .interface_profiles import INTERFACE_PROFILES, InterfaceProfile, HOST_OFFLOADS, GUEST_OFFLOADS
 from .xml_generator import KvmXmlRemovableMedia, KvmXmlCore, KvmXmlDisk, KvmXmlNetworkInterface, KvmXmlObject, KvmXmlVncConfiguration
-from .exceptions import VirtualMachineDoesNotExist, VirtualMachineConfigurationError
+from .libvirt_connection import connections, is_connection_error, DEFAULT_LIBVIRT_URI
+from .shutdown import shutdown_coordinator
+from .exceptions import VirtualMachineDoesNotExist, VirtualMachineConfigurationError, VirtualMachineSnapshotError, ShutdownError
 
 logger = logging.getLogger(__name__)
 
+DOMAIN_STATES = {
+    libvirt.VIR_DOMAIN_NOSTATE: "no_state",
+    libvirt.VIR_DOMAIN_RUNNING: "running",
+    libvirt.VIR_DOMAIN_BLOCKED: "blocked",
+    libvirt.VIR_DOMAIN_PAUSED: "paused",
+    libvirt.VIR_DOMAIN_SHUTDOWN: "shutdown",
+    libvirt.VIR_DOMAIN_SHUTOFF: "shutoff",
+    libvirt.VIR_DOMAIN_CRASHED: "crashed",
+    # power management (entered into s3 state)
+    libvirt.VIR_DOMAIN_PMSUSPENDED: "pm_suspended",
+}
+
+# Stats returned by get_domain_states()
+DOMAIN_STATS = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON
+
+
+def domain_state(state_int:int, reason) -> tuple:
+    """Returns the name, code and reason of a libvirt domain state"""
+    if state_int not in DOMAIN_STATES:
+        return "unknown", 0, "Unknown state"
+    return DOMAIN_STATES[state_int], state_int, str(reason)
+
+
+def get_domain_states(vms:List[VirtualMachine]) -> Dict[str, dict]:
+    """State and stats of many virtual machines at once, by instance ID. Uses a single
+    getAllDomainStats() call per host instead of looking up each domain and parsing its XML.
+    Virtual machines that are not defined in libvirt (or whose host can't be reached) are left out.
+    """
+    uris = {}
+    for vm in vms:
+        uri = vm.host.libvirt_uri if vm.host else DEFAULT_LIBVIRT_URI
+        uris.setdefault(uri, set()).add(vm.instance_id)
+
+    states = {}
+    for uri, instance_ids in uris.items():
+        try:
+            records = _get_all_domain_stats(uri)
+        except libvirt.libvirtError as e:
+            logger.error(f"Could not get the domain stats of {uri}: {e}")
+            continue
+
+        for domain, stats in records:
+            name = domain.name()
+            if name not in instance_ids:
+                continue
+            state_str, state_int, reason = domain_state(stats.get("state.state"), stats.get("state.reason"))
+            states[name] = {
+                "state": state_str,
+                "code": state_int,
+                "reason": reason,
+                "stats": {
+                    "cpu_time": stats.get("cpu.time"),
+                    "memory_kb": stats.get("balloon.current"),
+                    "max_memory_kb": stats.get("balloon.maximum"),
+                },
+            }
+    return states
+
+
+def _get_all_domain_stats(uri:str) -> list:
+    try:
+        with connections.connection(uri) as conn:
+            return conn.getAllDomainStats(DOMAIN_STATS)
+    except libvirt.libvirtError as e:
+        if not is_connection_error(e):
+            raise
+    # The shared connection broke, retry once with a new one
+    with connections.connection(uri) as conn:
+        return conn.getAllDomainStats(DOMAIN_STATS)
+
+
 class VirtualMachineInstance():
     """Class responsible for creating, managing, and deleting virtual machine instances directly through the libvirt API"""
 
@@ -22,9 +97,13 @@ class VirtualMachineInstance():
     virtual_network: KvmXmlNetworkInterface = None
     removable_media: List[KvmXmlRemovableMedia] = None
     vnc: KvmXmlVncConfiguration = None
+    smbios_url: str = None
 
-    def __init__(self, vm_id:str = None):
-        self.libvirt_conn = libvirt.open('qemu:///system')
+    def __init__(self, vm_id:str = None, host:HostMachine = None):
+        self._config = None
+        # Shared with the other instances in this process, see libvirt_connection.py
+        self.libvirt_uri = self.__get_libvirt_uri(vm_id, host)
+        self.libvirt_conn = connections.get(self.libvirt_uri)
 
         self.virtual_disks = {}
         self.removable_media = []
@@ -38,19 +117,32 @@ class VirtualMachineInstance():
                 raise
 
             self.id = vm_id
-            self._build_config_from_xml()
 
-    
-    def _build_config_from_xml(self):
-        """Returns an object with the configuration details of a defined VM. (dump xml)"""
-        domain = self.__get_libvirt_domain(self.id)
-        xmldoc = domain.XMLDesc()
-        item = xmltodict.parse(xmldoc)
-        #logger.debug(item)
+
+    @property
+    def config(self) -> DomainConfig:
+        """Configuration of the domain (disks, interfaces, vCPUs, memory, graphics), parsed from
+        its XML the first time it's needed. Only the callers that need the topology of the VM
+        pay for the XML, reading the state doesn't. Cached until the domain changes, see
+        invalidate_config()."""
+        if self._config is None:
+            self._config = DomainConfig.from_xml(self.virsh_domain.XMLDesc())
+        return self._config
 
 
-    def configure_network(self, virtual_network:VirtualNetwork):
-        """Configure networking"""
+    def invalidate_config(self):
+        """Parse the XML again on the next access of config, e.g. after the domain was redefined
+        or started (running domains have their assigned devices and ports in the XML)."""
+        self._config = None
+
+
+    def configure_network(self, virtual_network:VirtualNetwork, profile:InterfaceProfile = None, queues:int = None):
+        """Configure networking. The interface gets the model and backend of the profile ('legacy'
+        if not set), with `queues` queue pairs (usually one per vCPU) if the profile has multiqueue.
+        The MTU and offloads are the virtual network's (config "mtu" and "disabled_offloads"), the
+        offloads and the rx queue size only apply to virtio interfaces."""
+        profile = profile if profile else INTERFACE_PROFILES["legacy"]
+        logger.debug(f"Configuring network {virtual_network.network_id} with interface profile: {profile.name}")
         
         if virtual_network.type == VirtualNetwork.Type.BRIDGE_TO_LAN:
             type = "bridge"
@@ -59,12 +151,27 @@ class VirtualMachineInstance():
             type = "nat"
             source = virtual_network.name
         
+        virtio = profile.model == "virtio"
+        disabled_offloads = (virtual_network.config.get("disabled_offloads") or []) if virtio else []
         self.virtual_network = KvmXmlNetworkInterface(
             type = type,
-            source = source
+            source = source,
+            model = profile.model,
+            driver = "vhost" if profile.vhost else None,
+            queues = queues if profile.multiqueue else None,
+            rx_queue_size = profile.rx_queue_size if virtio else None,
+            mtu = virtual_network.config.get("mtu"),
+            host_offloads = {name: "off" for name in disabled_offloads if name in HOST_OFFLOADS},
+            guest_offloads = {name: "off" for name in disabled_offloads if name in GUEST_OFFLOADS},
         )
     
 
+    def configure_smbios(self, seed_url:str):
+        """Point cloud-init at a NoCloud-net seed through the SMBIOS serial number, instead of a seed image"""
+        logger.debug(f"Configuring SMBIOS with seed URL: {seed_url}")
+        self.smbios_url = seed_url
+
+
     def add_removable_media(self, file_path:str, target_dev:str):
         logger.debug(f"Adding removable media with target dev: {target_dev}")
         self.removable_media.append(KvmXmlRemovableMedia(
@@ -78,14 +185,25 @@ class VirtualMachineInstance():
         pass
 
 
-    def add_virtual_disk(self, volume:Volume, target_dev:str):
-        logger.debug(f"Adding virtual disk with target dev: {target_dev}")
+    def add_virtual_disk(self, volume:Volume, target_dev:str, queues:int = None):
+        """Attach a volume with its disk profile (see disk_profiles.py). Volumes without one are
+        attached with the 'legacy' profile, the way they always were. Profiles with multiqueue
+        get `queues` virtio queues (usually one per vCPU)."""
+        profile = DISK_PROFILES.get(volume.disk_profile or "legacy", DISK_PROFILES["legacy"])
+        logger.debug(f"Adding virtual disk with target dev: {target_dev}, profile: {profile.name}")
         self.virtual_disks[target_dev] = KvmXmlDisk(
             file_path=volume.path,
             alias=volume.volume_id,
             type=volume.format,
             operating_system=volume.operating_system,
-            target_dev=target_dev
+            target_dev=target_dev,
+            bus=profile.bus,
+            cache=profile.cache,
+            io=profile.io,
+            discard=profile.discard,
+            detect_zeroes=profile.detect_zeroes,
+            queues=queues if profile.multiqueue else None,
+            iothread=profile.iothread,
         )
 
 
@@ -107,13 +225,27 @@ class VirtualMachineInstance():
         self.vnc = vnc_xml_def
     
 
-    def configure_core(self, instance_def:InstanceDefinition, efi_boot:bool = False):
-        logger.debug(f"configure_core, efi_boot: {efi_boot}")
+    def configure_core(self, instance_def:InstanceDefinition, efi_boot:bool = False, cpu_pinning:dict = None):
+        """Set the CPUs and memory of the virtual machine. Instance types with pinned vCPUs need
+        the host cores the scheduler picked for them (VirtualMachine.cpu_pinning), the others float
+        on the shared cores of the host if the scheduler set them."""
+        logger.debug(f"configure_core, efi_boot: {efi_boot}, cpu_pinning: {cpu_pinning}")
+        cpu_pinning = cpu_pinning or {}
+        if instance_def.pinned and "vcpus" not in cpu_pinning:
+            raise VirtualMachineConfigurationError(f"Instance type {instance_def} requires pinned host cores.")
+
         self.core = KvmXmlCore(
             cpu_count=instance_def.get_cpu(),
             memory=instance_def.get_memory(),
             efi_boot=efi_boot,
         )
+        if "vcpus" in cpu_pinning:
+            self.core.vcpu_pins = cpu_pinning["vcpus"]
+            self.core.emulator_pins = cpu_pinning["emulator"]
+            self.core.numa_nodeset = str(cpu_pinning["numa_node"])
+            self.core.hugepage_kb = cpu_pinning.get("hugepage_kb")
+        elif "cpuset" in cpu_pinning:
+            self.core.cpuset = cpu_pinning["cpuset"]
 
 
     def define(self, vm_db:VirtualMachine):
@@ -134,8 +266,9 @@ class VirtualMachineInstance():
         if self.vnc:
             xmldoc.vnc_configuration = self.vnc
         
-        xmldoc.enable_smbios = False
-        xmldoc.smbios_url = ""
+        # cloud-init seed from the metadata service (NoCloud-net)
+        xmldoc.enable_smbios = True if self.smbios_url else False
+        xmldoc.smbios_url = self.smbios_url if self.smbios_url else ""
 
         # Render the XML doc        
         doc = xmldoc.render_xml()
@@ -153,6 +286,7 @@ class VirtualMachineInstance():
             
         self.virsh_domain = dom
         self.id = vm_db.instance_id
+        self.invalidate_config()
     
 
     def check_components(self):
@@ -178,30 +312,7 @@ class VirtualMachineInstance():
     def get_state(self):
         """Get the state of the virtual machine as defined in libvirt."""
         state_int, reason = self.virsh_domain.state()
-
-        if state_int == libvirt.VIR_DOMAIN_NOSTATE:
-            state_str = "no_state"
-        elif state_int == libvirt.VIR_DOMAIN_RUNNING:
-            state_str = "running"
-        elif state_int == libvirt.VIR_DOMAIN_BLOCKED:
-            state_str = "blocked"
-        elif state_int == libvirt.VIR_DOMAIN_PAUSED:
-            state_str = "paused"
-        elif state_int == libvirt.VIR_DOMAIN_SHUTDOWN:
-            state_str = "shutdown"
-        elif state_int == libvirt.VIR_DOMAIN_SHUTOFF:
-            state_str = "shutoff"
-        elif state_int == libvirt.VIR_DOMAIN_CRASHED:
-            state_str = "crashed"
-        elif state_int == libvirt.VIR_DOMAIN_PMSUSPENDED:
-            # power management (entered into s3 state)
-            state_str = "pm_suspended"
-        else:
-            state_str = "unknown"
-            state_int = 0
-            reason = "Unknown state"
-
-        return state_str, state_int, str(reason)
+        return domain_state(state_int, reason)
 
 
     def start(self):
@@ -216,13 +327,16 @@ class VirtualMachineInstance():
         except libvirt.libvirtError as e:
             logger.debug(f"Unable to start Virtual Machine {self.id}: {e}")
             raise VirtualMachineConfigurationError
+        self.invalidate_config()
         
         logger.debug("Setting autostart to 1 for started instances")
         self.virsh_domain.setAutostart(1)
             
 
-    def stop(self, wait:bool = True):
-        """Stop an instance"""
+    def stop(self, wait:bool = True, timeout:int = None):
+        """Stop an instance. The guest is asked to shut down once and destroyed if it's still
+        running after the timeout (shutdown_timeout), see ShutdownCoordinator. With wait=False,
+        the future of the shutdown is returned right away."""
 
         logger.debug(f"Stopping vm: {self.id}")
 
@@ -233,38 +347,122 @@ class VirtualMachineInstance():
         logger.debug("Setting autostart to 0 for stopped instances")
         self.virsh_domain.setAutostart(0)
 
-        vm_force_stop_time = 240
-        seconds_waited = 0
+        future = shutdown_coordinator.shutdown(self.id, self.libvirt_uri, timeout)
+        future.add_done_callback(lambda _: self.invalidate_config())
+        if not wait:
+            return future
 
-        while self.virsh_domain.isActive():
-            logger.debug("Domain is active")
-            try:
-                if seconds_waited % 5 == 0:
-                    logger.debug(f"Waited {seconds_waited} seconds")
-                # TODO: Is this needed?
-                # Supposedly, destroy() will do exactly this, which is shutdown gracefully, wait,
-                # then force shutdown, without having to do this in Python
-                self.virsh_domain.shutdown()
-                if not wait:
-                    return 
-                time.sleep(1)
-                seconds_waited += 1
-                if seconds_waited >= vm_force_stop_time:
-                    logger.warning(f"Timeout was reached and VM '{self.id}' hasn't stopped yet. Force shutting down...")
-                    self.virsh_domain.destroy()
-            except libvirt.libvirtError as e:
-                # Error code 55 = Not valid operation: domain is not running
-                if (e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID):
-                    return
-                else:
-                    logger.exception("Got error code other than VIR_ERR_OPERATION_INVALID")
-                    logger.error(e)
-                    raise VirtualMachineError(e)
+        try:
+            future.result()
+        except ShutdownError as e:
+            logger.error(e)
+            raise VirtualMachineError(e)
+        return True
     
 
+    def set_shared_cpus(self, cpus:List[int]):
+        """Move the vCPUs and emulator threads of a VM that isn't pinned to these host cores, e.g.
+        after a pinned VM took some of its cores. Changes the running VM and its definition."""
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if self.virsh_domain.isActive():
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+
+        host_cpus = self.libvirt_conn.getCPUMap()[0]
+        cpumap = tuple(cpu in cpus for cpu in range(host_cpus))
+        logger.debug(f"Moving {self.id} to host cores {cpus}")
+        try:
+            for vcpu in range(self.virsh_domain.info()[3]):
+                self.virsh_domain.pinVcpuFlags(vcpu, cpumap, flags)
+            self.virsh_domain.pinEmulator(cpumap, flags)
+        except libvirt.libvirtError as e:
+            logger.error(f"Unable to move {self.id} to host cores {cpus}: {e}")
+            raise VirtualMachineConfigurationError(e)
+        finally:
+            self.invalidate_config()
+
+
+    def get_disk_path(self, target_dev:str) -> str:
+        """Returns the path of the file currently backing the disk with the given target dev."""
+        disk = self.config.disk(target_dev)
+        return disk.source if disk else None
+
+
+    def create_disk_snapshot(self, target_dev:str, overlay_path:str, quiesce:bool = False):
+        """Create an external, disk-only snapshot of a disk of a running VM. The VM keeps running
+        and writes to a new qcow2 overlay at overlay_path, leaving the current disk file unchanged
+        so it can be read safely. Merge the overlay back with commit_disk_snapshot().
+
+        With quiesce, the guest file systems are frozen while the snapshot is taken. This requires
+        the qemu guest agent to be running in the VM.
+        """
+        disks_xml = ""
+        for disk in self.config.disks:
+            if disk.target_dev == target_dev:
+                disks_xml += f"<disk name='{disk.target_dev}' snapshot='external'><driver type='qcow2'/><source file='{overlay_path}'/></disk>"
+            else:
+                disks_xml += f"<disk name='{disk.target_dev}' snapshot='no'/>"
+        snapshot_xml = f"<domainsnapshot><disks>{disks_xml}</disks></domainsnapshot>"
+
+        flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY \
+            | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA \
+            | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+        if quiesce:
+            flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE
+
+        logger.debug(f"Creating disk snapshot of {self.id}:{target_dev} with overlay {overlay_path}")
+        try:
+            self.virsh_domain.snapshotCreateXML(snapshot_xml, flags)
+        except libvirt.libvirtError as e:
+            logger.error(f"Unable to create disk snapshot of {self.id}:{target_dev}: {e}")
+            raise VirtualMachineSnapshotError(e)
+        finally:
+            # The disk is backed by the overlay now
+            self.invalidate_config()
+
+
+    def commit_disk_snapshot(self, target_dev:str, timeout:int = 600):
+        """Merge the active overlay of a disk (created with create_disk_snapshot()) back into
+        its backing file while the VM is running and switch the VM back to the backing file."""
+        logger.debug(f"Committing disk snapshot of {self.id}:{target_dev}")
+        flags = libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE | libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW
+        try:
+            self.virsh_domain.blockCommit(target_dev, None, None, 0, flags)
+
+            # An active commit keeps mirroring new writes until it is pivoted, wait until
+            # the overlay has been fully merged before pivoting.
+            seconds_waited = 0
+            while True:
+                info = self.virsh_domain.blockJobInfo(target_dev, 0)
+                if not info:
+                    raise VirtualMachineSnapshotError(f"Block commit job for {self.id}:{target_dev} ended unexpectedly")
+                if info["end"] > 0 and info["cur"] == info["end"]:
+                    break
+                if seconds_waited >= timeout:
+                    self.virsh_domain.blockJobAbort(target_dev, 0)
+                    raise VirtualMachineSnapshotError(f"Timed out committing disk snapshot of {self.id}:{target_dev}")
+                time.sleep(0.5)
+                seconds_waited += 0.5
+
+            self.virsh_domain.blockJobAbort(target_dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+        except libvirt.libvirtError as e:
+            logger.error(f"Unable to commit disk snapshot of {self.id}:{target_dev}: {e}")
+            raise VirtualMachineSnapshotError(e)
+        finally:
+            self.invalidate_config()
+
+
     def terminate(self):
         if self.virsh_domain:
             self.virsh_domain.undefine()
+            self.invalidate_config()
+
+
+    def __get_libvirt_uri(self, vm_id:str = None, host:HostMachine = None) -> str:
+        """Returns the libvirt URI of the host, or of the host the VM runs on"""
+        if host is None and vm_id:
+            vm_db = VirtualMachine.objects.filter(instance_id=vm_id).select_related("host").first()
+            host = vm_db.host if vm_db else None
+        return host.libvirt_uri if host else DEFAULT_LIBVIRT_URI
 
 
     def __get_libvirt_domain(self, vm_id:str):
@@ -284,6 +482,18 @@ class VirtualMachineInstance():
         except libvirt.libvirtError as e:
             if (e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN):
                 raise VirtualMachineDoesNotExist
+            if not is_connection_error(e):
+                raise
+
+        # The shared connection broke, retry once with a new one
+        connections.invalidate(self.libvirt_uri, self.libvirt_conn)
+        self.libvirt_conn = connections.get(self.libvirt_uri)
+        try:
+            return self.libvirt_conn.lookupByName(vm_id)
+        except libvirt.libvirtError as e:
+            if (e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN):
+                raise VirtualMachineDoesNotExist
+            raise
 
 
     def __str__(self):
@@ -291,12 +501,7 @@ class VirtualMachineInstance():
             return self.core.id
         else:
             return "GenericInstance"
-    
 
-    # def __del__(self):
-    #     logger.debug("Deleting VirtualMachineInstance object")
-    #     logger.debug("Closing libvirt connection")
-    #     self.libvirt_conn.close()
 
 
 
@@ -2,31 +2,50 @@ import logging
 import shutil
 import base64
 import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import List
+from django.db import transaction
+from django.utils import timezone
 from echome.config import ecHomeConfig
-from commander.qemuimg import QemuImg
+from echome.metrics import metrics
+from commander.qemuimg import QemuImg, size_to_bytes
 from commander.virt_tools import VirtTools
 from identity.models import User
 from network.models import VirtualNetwork
 from network.manager import VirtualNetworkManager
 from keys.models import UserKey
 from .image_manager import ImageManager
-from .models import VirtualMachine, HostMachine, Volume, Image
+from .disk_pool import DiskPoolManager
+from .fast_copy import copy_file
+from .image_build import ImageBuild, BuildStage
+from .models import VirtualMachine, HostMachine, InstanceSeed, Volume, Image, Job
 from .instance_definitions import InstanceDefinition
 from .cloudinit import CloudInit, CloudInitFailedValidation, CloudInitIsoCreationError
 from .vm_instance import VirtualMachineInstance
+from .shutdown import shutdown_coordinator
+from .libvirt_connection import DEFAULT_LIBVIRT_URI
+from .scheduler import PlacementScheduler, ResourceRequest, capacity_index
+from .disk_profiles import DISK_PROFILES, get_disk_profile
+from .interface_profiles import get_interface_profile
+from .metadata_service import get_seed_url, seed_cache, is_configured as metadata_service_configured
 from .exceptions import (
     LaunchError, 
     InvalidLaunchConfiguration, 
     VirtualMachineDoesNotExist, 
     VirtualMachineConfigurationError, 
     ImagePrepError,
-    ImageDoesNotExistError
+    ImageDoesNotExistError,
+    ImageCopyError
 )
 
 logger = logging.getLogger(__name__)
 
 VM_ROOT_DIR = ecHomeConfig.VirtualMachines().user_dir
+DISK_PROVISIONING = ecHomeConfig.VirtualMachines().disk_provisioning
+COMPRESS_IMAGES = str(ecHomeConfig.VirtualMachines().compress_images).lower() == "true"
+CLOUDINIT_DATASOURCE = ecHomeConfig.VirtualMachines().cloudinit_datasource
 
 # if at any point during the VM Creation process fails,
 # clean up after itself. Useful to disable for debugging,
@@ -34,6 +53,9 @@ VM_ROOT_DIR = ecHomeConfig.VirtualMachines().user_dir
 # and files wasting space for non-functioning VMs
 CLEAN_UP_ON_FAIL = os.getenv("VM_CLEAN_UP_ON_FAIL", 'true').lower() == 'true'
 
+# Maximum number of virtual machines that can be launched at once with launch_vms()
+MAX_LAUNCH_COUNT = 50
+
 # Flow for VM Creation
 # 1. Generate a VM Id
 # 2. Generate the cloudinit config
@@ -48,8 +70,130 @@ class VmManager:
     cloudinit:CloudInit = None
     vm_db:VirtualMachine = None
     instance:VirtualMachineInstance = None
+    job:Job = None
+
+    def launch_vms(self, user: User, instance_def:InstanceDefinition, count:int = 1, private_ips:list = None, **kwargs) -> list:
+        """Launch one or more identical virtual machines. The launch configuration is validated once,
+        then the virtual machines are prepared (in the CREATING state) and created in parallel by the
+        workers, see create_vm() for the kwargs.
+
+        Args:
+            user (User): User object for identifying which account the VMs are created for.
+            instance_def (InstanceDefinition): Instance type for the virtual machines to use.
+            count (int, optional): Number of virtual machines to launch. Defaults to 1.
+            private_ips (list, optional): Private IP address for each of the virtual machines. Must have
+                `count` addresses if set.
+
+        Raises:
+            InvalidLaunchConfiguration: If supplied arguments are invalid for these virtual machines.
+            PlacementError: If there is not enough free capacity on the hosts for all of the virtual machines.
+
+        Returns:
+            list: A dict with the virtual_machine_id, job_id and private_ip of each virtual machine.
+        """
+        # Imported here as the tasks module depends on this module
+        from .tasks import task_create_vm
+
+        if count < 1 or count > MAX_LAUNCH_COUNT:
+            raise InvalidLaunchConfiguration(f"Count must be between 1 and {MAX_LAUNCH_COUNT}.")
+
+        if private_ips:
+            if len(private_ips) != count:
+                raise InvalidLaunchConfiguration("The number of private IP addresses does not match Count.")
+            if len(set(private_ips)) != len(private_ips):
+                raise InvalidLaunchConfiguration("The private IP addresses must be unique.")
+        else:
+            private_ips = [kwargs.get("PrivateIp", "")] * count
+            if count > 1 and private_ips[0]:
+                raise InvalidLaunchConfiguration("A single PrivateIp cannot be used for more than one virtual machine.")
+
+        self.validate_launch_config(user, private_ips, **kwargs)
+
+        # Place and prepare all of the virtual machines in one transaction before creating any
+        # of them, so a launch that doesn't fit is rejected as a whole. Each one is saved before
+        # the next is placed, the scheduler reads the host cores taken by pinned VMs from the database.
+        scheduler = PlacementScheduler()
+        request = ResourceRequest.for_instance(instance_def, kwargs.get("DiskSize", "10G"))
+        hosts = []
+        launched = []
+        try:
+            with transaction.atomic():
+                for private_ip in private_ips:
+                    host = scheduler.place(request, kwargs.get("PlacementStrategy"), user.account)
+                    hosts.append(host)
+                    instance_id = self.prepare_vm_db(user, instance_def, kwargs["Tags"] if "Tags" in kwargs else {}, host,
+                        start_order=int(kwargs.get("StartOrder") or 0), cpu_pinning=host.cpu_pinning)
+                    job = Job(
+                        account=user.account,
+                        job_type=Job.JobType.CREATE_VM,
+                        resource_id=instance_id,
+                    )
+                    job.generate_id()
+                    job.save()
+                    launched.append({
+                        "virtual_machine_id": instance_id,
+                        "job_id": job.job_id,
+                        "private_ip": private_ip,
+                    })
+        except Exception:
+            for host in hosts:
+                scheduler.release(host, request)
+            raise
+
+        instance_type = f"{instance_def.instance_class}.{instance_def.instance_size}"
+        for vm in launched:
+            launch_config = {**kwargs, "PrivateIp": vm["private_ip"]}
+            task_create_vm.delay(user.user_id, vm["virtual_machine_id"], vm["job_id"], instance_type, launch_config)
+
+        return launched
+
+
+    def validate_launch_config(self, user: User, private_ips:list = None, **kwargs):
+        """Checks the parts of a launch configuration that can be checked before creating a virtual machine:
+        the image, disk size, network profile, private IP addresses, key and disk profile.
+
+        Raises:
+            InvalidLaunchConfiguration: If a supplied argument is invalid.
+        """
+        if "ImageId" not in kwargs:
+            raise InvalidLaunchConfiguration("ImageId was not found in launch configuration.")
+        try:
+            image = ImageManager().get_image_from_id(kwargs["ImageId"], user)
+        except ImageDoesNotExistError:
+            raise InvalidLaunchConfiguration("Provided ImageId does not exist.")
+        if not image.is_ready_for_use:
+            raise InvalidLaunchConfiguration("Provided ImageId is not available.")
 
-    def create_vm(self, user: User, instance_def:InstanceDefinition, **kwargs):
+        try:
+            size_to_bytes(kwargs.get("DiskSize", "10G"))
+        except ValueError:
+            raise InvalidLaunchConfiguration("Provided DiskSize is not a valid size.")
+
+        try:
+            vnet = VirtualNetwork.objects.get(
+                name=kwargs.get("NetworkProfile"),
+                account=user.account
+            )
+        except VirtualNetwork.DoesNotExist:
+            raise InvalidLaunchConfiguration("Provided NetworkProfile does not exist.")
+
+        if vnet.type == VirtualNetwork.Type.BRIDGE_TO_LAN:
+            vnet_manager = VirtualNetworkManager()
+            for private_ip in private_ips or []:
+                try:
+                    if private_ip and not vnet_manager.validate_ip(private_ip, vnet):
+                        raise InvalidLaunchConfiguration(f"Private IP address {private_ip} is not valid for the specified network profile.")
+                except ValueError:
+                    raise InvalidLaunchConfiguration(f"Private IP address {private_ip} is not a valid IP address.")
+
+        if kwargs.get("KeyName") and not UserKey.objects.filter(account=user.account, name=kwargs["KeyName"]).exists():
+            raise InvalidLaunchConfiguration("Specified SSH Key Name does not exist.")
+
+        if kwargs.get("DiskProfile") and kwargs["DiskProfile"] not in DISK_PROFILES:
+            raise InvalidLaunchConfiguration("Provided DiskProfile does not exist.")
+
+
+    def create_vm(self, user: User, instance_def:InstanceDefinition, prepared_id:str = None, job:Job = None, **kwargs):
         """Create a virtual machine
         This function does not create the VM but instead passes all of the arguments to the internal
         function _create_virtual_machine(). If this process fails, the function will clean up after
@@ -59,6 +203,9 @@ class VmManager:
         Args:
             user (User): User object for identifying which account the VM is created for.
             instance_def (InstanceDefinition): Instance type for the virtual machine to use.
+            prepared_id (str, optional): ID of a virtual machine prepared with prepare_vm_db() to create.
+                A new one is prepared if not set.
+            job (Job, optional): Job to record the progress of the stages of the creation in.
         
         Kwargs:
             NetworkProfile (str): Network profile to use for the virtual machine. Use the name rather than the ID.
@@ -72,10 +219,16 @@ class VmManager:
             VncPort (str, optional): Value for the VNC port (if enabled above).
             Files (List[CloudInitFile], optional): Files to upload to the virtual machine
             RunCommands (List[str], optional): List of commands to run
+            PlacementStrategy (str, optional): How to pick the host if the virtual machine was not
+                placed yet ('spread' or 'binpack'). Defaults to the account's or server's strategy.
+            StartOrder (int, optional): Order bulk power actions start the virtual machine in (lowest first).
+            DiskProfile (str, optional): Disk profile of the boot disk, see disk_profiles.py. Defaults to the
+                instance type's ('legacy' for Windows images).
 
         Raises:
             InvalidLaunchConfiguration: If supplied arguments are invalid for this virtual machine.
             LaunchError: If there was an error during build of the virtual machine.
+            PlacementError: If no host has enough free capacity for the virtual machine.
 
         Returns:
             dict: [description]
@@ -89,9 +242,21 @@ class VmManager:
             raise InvalidLaunchConfiguration(msg)
         
         self.user = user
+        self.job = job
+        self.timings = {}
+        self.launch_started = time.monotonic()
 
         # Create our VirtualMachine Database object
-        instance_id = self.prepare_vm_db(user, instance_def, kwargs["Tags"] if "Tags" in kwargs else {})
+        if prepared_id:
+            self.vm_db = VirtualMachine.objects.get(instance_id=prepared_id, account=user.account)
+            instance_id = prepared_id
+        else:
+            instance_id = self.prepare_vm_db(user, instance_def, kwargs["Tags"] if "Tags" in kwargs else {},
+                start_order=int(kwargs.get("StartOrder") or 0))
+
+        if prepared_id:
+            # Time spent waiting for a worker
+            self.timings["queued"] = (timezone.now() - self.vm_db.created).total_seconds()
 
         # Creating the directory for the virtual machine
         self.vm_dir = self.__generate_vm_path(user.account, instance_id)
@@ -122,18 +287,19 @@ class VmManager:
         """Actual method that creates a virtual machine."""
         logger.debug(kwargs)
 
-        # Create our new VirtualMachineInstance
-        self.instance = VirtualMachineInstance()
-        
-        # Determine host to run this VM on:
-        try:
-            hosts = HostMachine.objects.all()
-            # TODO: Allow setting the host (or picking one that fits)
-        # When we can add multiple servers
-            self.vm_db.host = hosts[0]
-        except Exception as e:
-            logger.exception(e)
-            raise 
+        # Determine host to run this VM on, unless launch_vms() already placed it
+        if self.vm_db.host is None:
+            with transaction.atomic():
+                self.vm_db.host = PlacementScheduler().place(
+                    ResourceRequest.for_instance(instance_def, kwargs.get("DiskSize", "10G")),
+                    kwargs.get("PlacementStrategy"),
+                    self.user.account,
+                )
+                self.vm_db.cpu_pinning = self.vm_db.host.cpu_pinning
+                self.vm_db.save()
+
+        # Create our new VirtualMachineInstance on that host
+        self.instance = VirtualMachineInstance(host=self.vm_db.host)
             
         # Prepare some variables
         private_ip:str  = kwargs["PrivateIp"] if "PrivateIp" in kwargs else None
@@ -143,20 +309,24 @@ class VmManager:
         efi_boot:bool   = True if "EfiBoot" in kwargs and kwargs["EfiBoot"] == "true" else False
 
         # Prepare our boot disk image and save the metadata to the DB
-        self.vm_db.image_metadata = self.prepare_disk(kwargs["ImageId"], kwargs["DiskSize"])
+        with self._stage("prepare_disk"):
+            self.vm_db.image_metadata = self.prepare_disk(kwargs["ImageId"], kwargs["DiskSize"],
+                kwargs.get("DiskProfile"), instance_def)
 
         # initialize our CloudInit object
         self.cloudinit = CloudInit(base_dir=self.vm_dir)
 
         # Networking (May also set a cloudinit network config file)
-        vnet_metadata = self.prepare_network_interface(kwargs["NetworkProfile"], private_ip)
+        with self._stage("prepare_network_interface"):
+            vnet_metadata = self.prepare_network_interface(kwargs["NetworkProfile"], private_ip, instance_def)
         self.vm_db.interfaces = {
             "config_at_launch": vnet_metadata
         }
 
         # SSH keys (If configured)
         if key_name:
-            public_key, key_dict = self.prepare_ssh_keys(key_name)
+            with self._stage("prepare_ssh_keys"):
+                public_key, key_dict = self.prepare_ssh_keys(key_name)
             self.vm_db.key_name = key_name
         else:
             public_key = None
@@ -164,48 +334,141 @@ class VmManager:
 
         # Generate the cloudinit Userdata
         # This includes the public keys and user data scripts if any exist.
-        self.cloudinit.generate_userdata_config(
-            public_keys = [public_key],
-            user_data_script = kwargs["UserDataScript"] if "UserDataScript" in kwargs else None,
-            files = kwargs["Files"] if "Files" in kwargs else None,
-            run_command = kwargs["RunCommands"] if "RunCommands" in kwargs else None
-        )
-        
-        # Provides some generic information about our environment to the VM.
-        self.cloudinit.generate_metadata(self.vm_db.instance_id, ip_addr=private_ip, public_key=key_dict)
-
-        # Validate and create the cloudinit iso
-        try:
-            cloudinit_iso_path = self.cloudinit.create_iso()
-        except CloudInitFailedValidation as e:
-            logger.exception(e)
-            raise VirtualMachineConfigurationError
-        except CloudInitIsoCreationError as e:
-            logger.exception(e)
-            raise VirtualMachineConfigurationError
+        with self._stage("generate_userdata_config"):
+            self.cloudinit.generate_userdata_config(
+                public_keys = [public_key],
+                user_data_script = kwargs["UserDataScript"] if "UserDataScript" in kwargs else None,
+                files = kwargs["Files"] if "Files" in kwargs else None,
+                run_command = kwargs["RunCommands"] if "RunCommands" in kwargs else None
+            )
             
-        if cloudinit_iso_path:
-            self.instance.add_removable_media(cloudinit_iso_path, "hdb")
+            # Provides some generic information about our environment to the VM.
+            self.cloudinit.generate_metadata(self.vm_db.instance_id, ip_addr=private_ip, public_key=key_dict)
+
+        # A static network config has to be read before the network is up, which the metadata
+        # service can't serve, so those virtual machines always get a seed image
+        if CLOUDINIT_DATASOURCE == "nocloud-net" and metadata_service_configured() and not self.cloudinit.network_config:
+            # Served by the metadata service, found through the SMBIOS serial number
+            with self._stage("publish_seed"):
+                seed_url = self.publish_seed()
+            self.instance.configure_smbios(seed_url)
+        else:
+            # Validate and create the cloudinit iso
+            with self._stage("create_iso"):
+                try:
+                    cloudinit_iso_path = self.cloudinit.create_iso()
+                except CloudInitFailedValidation as e:
+                    logger.exception(e)
+                    raise VirtualMachineConfigurationError
+                except CloudInitIsoCreationError as e:
+                    logger.exception(e)
+                    raise VirtualMachineConfigurationError
+                
+            if cloudinit_iso_path:
+                self.instance.add_removable_media(cloudinit_iso_path, "hdb")
     
         # VNC?
         metadata = {}
         if enable_vnc:
-            metadata += self.configure_vnc(vnc_port)
+            metadata.update(self.configure_vnc(vnc_port))
             
         # Generate the virtual machine XML document and (try to) launch our VM!
-        self.instance.configure_core(instance_def, efi_boot)
-        self.instance.define(self.vm_db)
-        self.instance.start()
+        if not instance_def.pinned:
+            # Read when the VM is defined, pinned VMs may have been placed since this one was
+            shared_cpus = capacity_index.shared_cpus(self.vm_db.host_id)
+            self.vm_db.cpu_pinning = {"cpuset": shared_cpus} if shared_cpus else {}
+            self.vm_db.save()
+        self.instance.configure_core(instance_def, efi_boot, self.vm_db.cpu_pinning)
+        with self._stage("define"):
+            self.instance.define(self.vm_db)
+        if instance_def.pinned:
+            self._update_shared_cpus()
+        with self._stage("start"):
+            self.instance.start()
 
         # Add the information for this VM in the db
         self.vm_db.storage = {}
         self.vm_db.metadata = metadata
+        self.vm_db.metadata["timings"] = self._record_timings()
         self.finish_vm_db()
 
         logger.debug(f"Successfully created VM: {self.vm_db.instance_id} : {self.vm_dir}")
         return self.vm_db.instance_id
 
 
+    def _update_shared_cpus(self):
+        """Move the virtual machines that aren't pinned off the host cores this one was pinned to"""
+        shared_cpus = capacity_index.shared_cpus(self.vm_db.host_id)
+        if not shared_cpus:
+            return
+
+        vms = VirtualMachine.objects \
+            .filter(host_id=self.vm_db.host_id, cpu_pinning__has_key="cpuset") \
+            .exclude(state__in=[VirtualMachine.State.TERMINATED, VirtualMachine.State.ERROR])
+        for vm in vms:
+            if set(vm.cpu_pinning["cpuset"]) <= set(shared_cpus):
+                continue
+            try:
+                VirtualMachineInstance(vm.instance_id, self.vm_db.host).set_shared_cpus(shared_cpus)
+            except VirtualMachineDoesNotExist:
+                # Not defined yet, it reads the shared cores when it is
+                continue
+            except Exception as e:
+                # The new VM is fine, the other one keeps sharing the cores until it's moved
+                logger.warning(f"Could not move {vm.instance_id} off the cores of {self.vm_db.instance_id}: {e}")
+                continue
+            vm.cpu_pinning = {"cpuset": shared_cpus}
+            vm.save(update_fields=["cpu_pinning"])
+
+
+    def publish_seed(self) -> str:
+        """Save the cloud-init configs generated for the virtual machine for the metadata service
+        to serve. Returns the seed URL to pass to cloud-init."""
+        seed = InstanceSeed(
+            virtual_machine=self.vm_db,
+            user_data=self.cloudinit.userdata_config,
+            meta_data=self.cloudinit.metadata,
+            network_config=self.cloudinit.network_config if self.cloudinit.network_config else None,
+        )
+        seed.generate_token()
+        seed.save()
+        seed_cache.put(seed)
+        return get_seed_url(seed.token)
+
+
+    @contextmanager
+    def _stage(self, name:str):
+        """Time a stage of the creation process and record it in the job, if there is one."""
+        start = time.monotonic()
+        try:
+            if self.job:
+                with self.job.track_stage(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.timings[name] = time.monotonic() - start
+
+
+    def _record_timings(self) -> dict:
+        """Returns the timing breakdown of the creation of the virtual machine (in seconds)
+        and adds it to the launch metrics."""
+        total = time.monotonic() - self.launch_started
+        labels = {
+            "image_id": self.vm_db.image_metadata["image_id"],
+            "instance_type": f"{self.vm_db.instance_type}.{self.vm_db.instance_size}",
+        }
+        for stage, duration in self.timings.items():
+            metrics.observe("vm_launch_stage_seconds", duration, stage=stage, **labels)
+        metrics.observe("vm_launch_seconds", total, **labels)
+
+        logger.debug(f"Launch timings for {self.vm_db.instance_id}: {total:.2f}s total, {self.timings}")
+        return {
+            "total": total,
+            "stages": self.timings,
+        }
+
+
     def configure_vnc(self, vnc_port:str = None) -> dict:
         """This will provide a VNC configuration if a user requests it"""
         logger.debug("Enabling VNC")
@@ -224,8 +487,9 @@ class VmManager:
         }
 
 
-    def prepare_disk(self, image_id:str, disk_size:str = "10G") -> dict:
-        """Given an image ID and disk size, will prepare a virtual disk for the VM."""
+    def prepare_disk(self, image_id:str, disk_size:str = "10G", disk_profile:str = None, instance_def:InstanceDefinition = None) -> dict:
+        """Given an image ID and disk size, will prepare a virtual disk for the VM. The disk is attached
+        with the disk profile if set, otherwise with the instance type's (see get_disk_profile())."""
         # Get the image from the image id:
         logger.debug("Preparing disk..")
         img_mgr = ImageManager()
@@ -234,31 +498,45 @@ class VmManager:
         except ImageDoesNotExistError:
             raise
         
-        # Copy our image to the destination directory
-        image_iso_path = img_mgr.copy_image(image, Path(self.vm_dir), self.vm_db.instance_id)
-
         new_vol = Volume(
             account=self.user.account,
             host=self.vm_db.host,
             virtual_machine=self.vm_db,
-            path=image_iso_path,
         )
         new_vol.generate_id()
-        new_vol.new_volume_from_image(image)
-        new_vol.save()
 
-        # resize our disk
-        logger.debug(f"Resizing image size to {disk_size}")
-        try:
-            QemuImg().resize(image_iso_path, disk_size)
-        except Exception as e:
-            logger.error(f"Encountered error when running qemu resize. {e}")
-            raise LaunchError("Encountered error when running qemu resize.")
-        
-        new_vol.populate_metadata()
+        # Claim a ready disk from the warm pool if there is one
+        pooled_disk = DiskPoolManager().claim(image, disk_size, Path(self.vm_dir), self.vm_db.instance_id)
+
+        if pooled_disk:
+            logger.debug(f"Using pooled disk: {pooled_disk.path}")
+            new_vol.path = pooled_disk.path
+            new_vol.new_volume_from_image(image, pooled_disk.backing_file is not None)
+            new_vol.format = pooled_disk.format
+            new_vol.size = pooled_disk.size
+        else:
+            # Copy (or clone) our image to the destination directory with the requested size
+            linked = DISK_PROVISIONING == "linked"
+            try:
+                new_vol.path = img_mgr.provision_disk(image, Path(self.vm_dir), self.vm_db.instance_id, disk_size, linked)
+            except ImageCopyError as e:
+                logger.error(f"Encountered error when provisioning disk. {e}")
+                raise LaunchError("Encountered error when provisioning disk.")
+
+            new_vol.new_volume_from_image(image, linked)
+            new_vol.populate_metadata()
+
         logger.debug(f"Created new volume: {new_vol.volume_id}")
 
-        self.instance.add_virtual_disk(new_vol, "vda")
+        try:
+            new_vol.disk_profile = get_disk_profile(
+                disk_profile,
+                instance_def.disk_profile if instance_def else "balanced",
+                new_vol.operating_system,
+            ).name
+        except KeyError:
+            raise InvalidLaunchConfiguration(f"Provided DiskProfile does not exist: {disk_profile}")
+        self.instance.add_virtual_disk(new_vol, "vda", instance_def.get_cpu() if instance_def else None)
         new_vol.state = Volume.State.ATTACHED
         new_vol.save()
 
@@ -270,13 +548,16 @@ class VmManager:
         }
 
 
-    def prepare_network_interface(self, network_name:str, private_ip:str = None) -> dict:
+    def prepare_network_interface(self, network_name:str, private_ip:str = None, instance_def:InstanceDefinition = None) -> dict:
         """Networking
         For VMs launched with BridgeToLan, we'll need to create a cloudinit
         network file as we're unable to set a private IP address at build time.
         It must instead be configured during boot with cloud-init.
         For all other VMs, we can omit the cloudinit ISOs and use the metadata
         API.
+
+        The interface is attached with the virtual network's interface profile if it sets one,
+        otherwise with the instance type's (see get_interface_profile()).
         """
         # Determine what network profile we're using:
         try:
@@ -299,12 +580,22 @@ class VmManager:
             logger.debug("CloudInit: Creating network config")
             self.cloudinit.generate_network_config(vnet, private_ip)
 
-        self.instance.configure_network(vnet)
+        boot_disk = self.instance.virtual_disks.get("vda")
+        try:
+            profile = get_interface_profile(
+                vnet.config.get("interface_profile"),
+                instance_def.interface_profile if instance_def else "balanced",
+                boot_disk.operating_system if boot_disk else None,
+            )
+        except KeyError:
+            raise InvalidLaunchConfiguration(f"Interface profile of the network profile does not exist: {vnet.config['interface_profile']}")
+        self.instance.configure_network(vnet, profile, instance_def.get_cpu() if instance_def else None)
 
         return  {
             "vnet_id": vnet.network_id,
             "type": vnet.type,
             "private_ip": private_ip if private_ip else "",
+            "interface_profile": profile.name,
         }
 
 
@@ -331,8 +622,15 @@ class VmManager:
 
     def create_virtual_machine_image(self, 
             vm_id:str, user:User, name:str = None, description:str = None, 
-            tags:dict = None, prepared_manager:ImageManager = None):
-        """Create a virtual machine image to create new virtual machines from."""
+            tags:dict = None, prepared_manager:ImageManager = None,
+            live:bool = False, quiesce:bool = False):
+        """Create a virtual machine image to create new virtual machines from.
+
+        By default a running VM is stopped while its disk is copied and started again afterwards.
+        With live, a running VM keeps running: its disk is frozen with an external snapshot while
+        it is copied, and the snapshot is merged back afterwards. With quiesce, the guest file
+        systems are frozen while the snapshot is taken (requires the qemu guest agent).
+        """
 
         logger.debug(f"Creating VMI from {vm_id}")
 
@@ -344,42 +642,93 @@ class VmManager:
             image_manager = prepared_manager
             new_vmi_id = image_manager.image.image_id
 
-
-        # Stop the instance (we can't copy a live machine, yet)
         instance = VirtualMachineInstance(vm_id)
-        # But first, get the current state so we can start it back up if it was on before.
+        # The target dev of the boot disk depends on its bus (e.g. sda on scsi), find it by its file
+        vm_db = self.try_get_database_object(vm_id, user)
+        boot_volume = Volume.objects.filter(volume_id=(vm_db.image_metadata or {}).get("volume_id")).first()
+        boot_disk = instance.config.disk_by_source(boot_volume.path) if boot_volume else None
+        if boot_disk is None:
+            raise ImagePrepError(f"Could not find the boot disk of {vm_id}")
+
+        # Get the current state so we can start it back up if it was on before.
         before_state, _, _ = instance.get_vm_state()
         logger.debug(f"Previous VM state: {before_state}")
-        instance.stop()
 
         # Define the path to the account vmi directory & create it if doesn't exist
         user_vmi_dir = self.__return_account_user_images_path(user.account)
         logger.debug(f"User_vmi_dir: {user_vmi_dir}")
 
-        current_image_full_path = self.__return_vm_path(user.account, vm_id) / f"{vm_id}.qcow2"
+        current_image_full_path = Path(boot_disk.source)
         logger.debug(f"Current image full path: {current_image_full_path}")
         new_image_full_path = user_vmi_dir / f"{new_vmi_id}.qcow2"
         logger.debug(f"New image full path: {new_image_full_path}")
 
-        # Copy the image to the new VM directory
-        if not QemuImg().convert(current_image_full_path, new_image_full_path, 'qcow2'):
-            raise ImagePrepError("Failed copying image with QemuImg() convert")
-
-        # Revert the state of the VM (if it was running, turn it back on)
-        if before_state == "running":
-            instance.start()
+        # Only the capture needs the disk to hold still, so it's kept as short as possible:
+        # standalone qcow2 disks are copied as is (cheaply with a reflink where supported), linked
+        # clones are flattened with qemu-img convert. Sysprep and sparsify (and compression) run
+        # on the copy after the VM is back up, sysprep first so sparsify trims what it freed.
+        disk_info = QemuImg().info(str(current_image_full_path))
+        standalone = disk_info and disk_info["format"] == "qcow2" and "backing-filename" not in disk_info
+        # Compressing needs sparsify to write a new file, capture next to it
+        captured_path = user_vmi_dir / f"{new_vmi_id}-capture.qcow2" if COMPRESS_IMAGES else new_image_full_path
+        build = ImageBuild(image_manager.image, ["capture", "sysprep", "sparsify"])
+
+        with build.stage("capture") as stage:
+            if live and before_state == "running":
+                # Writes go to the overlay while we copy, the disk itself doesn't change
+                overlay_path = self.__return_vm_path(user.account, vm_id) / f"{vm_id}-capture-{new_vmi_id}.qcow2"
+                instance.create_disk_snapshot(boot_disk.target_dev, str(overlay_path), quiesce)
+                try:
+                    self.__capture_disk(current_image_full_path, captured_path, disk_info, standalone, stage)
+                finally:
+                    instance.commit_disk_snapshot(boot_disk.target_dev)
+                    os.remove(overlay_path)
+            else:
+                # Stop the instance so the disk doesn't change while we copy it
+                instance.stop()
+                try:
+                    self.__capture_disk(current_image_full_path, captured_path, disk_info, standalone, stage)
+                finally:
+                    # Revert the state of the VM (if it was running, turn it back on)
+                    if before_state == "running":
+                        instance.start()
 
         # Prep the image for use in a new VM
-        if not VirtTools().sysprep(new_image_full_path):
-            raise ImagePrepError("Failed copying image with VirtTools() sysprep")
-
-        # Resize the image
-        if not VirtTools().sparsify(new_image_full_path):
-            raise ImagePrepError("Failed copying image with VirtTools() sparsify")
+        with build.stage("sysprep"):
+            if not VirtTools().sysprep(str(captured_path)):
+                raise ImagePrepError("Failed copying image with VirtTools() sysprep")
+
+        # Trim the blocks that are free (including the ones sysprep freed)
+        with build.stage("sparsify") as stage:
+            if COMPRESS_IMAGES:
+                try:
+                    if not VirtTools().sparsify(str(captured_path), str(new_image_full_path), "qcow2", True, stage.progress):
+                        raise ImagePrepError("Failed copying image with VirtTools() sparsify")
+                finally:
+                    os.remove(captured_path)
+            elif not VirtTools().sparsify(str(new_image_full_path), progress=stage.progress):
+                raise ImagePrepError("Failed copying image with VirtTools() sparsify")
         
         image_manager.finish_user_image(new_image_full_path)
 
         return {"vmi_id": new_vmi_id}
+
+
+    def __capture_disk(self, source:Path, destination:Path, disk_info:dict, standalone:bool, stage:BuildStage):
+        if not standalone:
+            # Flatten linked clones (merges the backing image) into a standalone qcow2
+            size = disk_info["virtual-size"] if disk_info else None
+            def progress(percent:float):
+                stage.progress(percent, int(size * percent / 100) if size else None)
+
+            if not QemuImg().convert(str(source), str(destination), "qcow2", progress):
+                raise ImagePrepError("Failed copying image with QemuImg() convert")
+        else:
+            try:
+                result = copy_file(source, destination)
+            except OSError as e:
+                raise ImagePrepError(f"Failed copying image: {e}")
+            stage.progress(100, result.bytes_copied)
         
 
     def try_get_database_object(self, vm_id:str, user:User):
@@ -400,10 +749,20 @@ class VmManager:
 
         vm_db = self.try_get_database_object(vm_id, user)
 
-        instance = VirtualMachineInstance(vm_id)
-        # Stop the instance and undefine (remove) from Virsh
-        instance.stop()
-        instance.terminate()
+        try:
+            instance = VirtualMachineInstance(vm_id)
+        except VirtualMachineDoesNotExist:
+            # E.g. the VM failed before it was defined, there's nothing to remove from libvirt
+            instance = None
+
+        if instance:
+            # Stop the instance and undefine (remove) from Virsh. The live state is checked
+            # rather than the cached one, which lags behind (e.g. for a VM that was just started).
+            instance.stop()
+            if instance.virsh_domain.isActive():
+                # Started again while it was being stopped
+                instance.virsh_domain.destroy()
+            instance.terminate()
         
         # Delete folder/path
         self.__delete_vm_path(vm_db.instance_id, user)
@@ -418,11 +777,43 @@ class VmManager:
         return True
     
 
-    def prepare_vm_db(self, user:User, instance_def:InstanceDefinition, tags:dict = {}) -> str:
+    def terminate_instances(self, vm_ids:List[str], user:User) -> List[str]:
+        """Terminate many instances. They are shut down at the same time, so this takes about
+        as long as the slowest shutdown instead of the sum of all of them. Returns the IDs of
+        the instances that could not be terminated."""
+        vms = list(VirtualMachine.objects.filter(
+            instance_id__in=vm_ids,
+            account=user.account
+        ).select_related("host"))
+
+        # The coordinator checks the live state, VMs that are already stopped (or were never
+        # defined) are done right away
+        targets = [(vm.instance_id, vm.host.libvirt_uri if vm.host else DEFAULT_LIBVIRT_URI) for vm in vms]
+
+        for vm_id, result in shutdown_coordinator.shutdown_many(targets).items():
+            if isinstance(result, Exception):
+                # terminate_instance() tries again
+                logger.warning(f"Could not shut down {vm_id} before terminating it: {result}")
+
+        failed = [vm_id for vm_id in vm_ids if vm_id not in {vm.instance_id for vm in vms}]
+        for vm in vms:
+            try:
+                self.terminate_instance(vm.instance_id, user)
+            except Exception as e:
+                logger.exception(e)
+                failed.append(vm.instance_id)
+        return failed
+
+
+    def prepare_vm_db(self, user:User, instance_def:InstanceDefinition, tags:dict = {}, host:HostMachine = None,
+            start_order:int = 0, cpu_pinning:dict = None) -> str:
         """Prepare the virtual machine Database object. Use finish_vm_db() to finalize the DB details."""
         vm_db = VirtualMachine(
             account=user.account,
             tags=tags,
+            host=host,
+            start_order=start_order,
+            cpu_pinning=cpu_pinning or {},
         )
         vm_db.set_instance_definition(instance_def)
         vm_db.generate_id()
@@ -489,9 +880,16 @@ class VmManager:
         """Cleans up a virtual machine directory if CLEAN_UP_ON_FAIL is true
         This should only be run when the virtual machine creation process fails!
         """
+        if self.job:
+            # The job still points at the virtual machine, keep it around in the ERROR state
+            # (even when it's not cleaned up, so it doesn't stay in CREATING forever)
+            self.vm_db.state = VirtualMachine.State.ERROR
+            self.vm_db.save()
+
         if CLEAN_UP_ON_FAIL:
             logging.debug("CLEAN_UP_ON_FAIL set to true. Cleaning up..")
-            self.vm_db.delete()
+            if not self.job:
+                self.vm_db.delete()
             self.__delete_vm_path(vm_id, user)
 
         if self.instance:
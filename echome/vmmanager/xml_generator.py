@@ -18,6 +18,17 @@ class KvmXmlCore():
     os_type: str = "hvm"
     bios: str = "bios"
 
+    # Host core each vCPU is pinned to (by vCPU index) and the host cores of the emulator threads
+    vcpu_pins: List[int] = None
+    emulator_pins: List[int] = None
+    # Host cores the vCPUs and emulator threads float on when they're not pinned
+    cpuset: List[int] = None
+    # Host NUMA cell(s) to allocate the memory from, e.g. "0"
+    numa_nodeset: str = None
+    numa_mode: str = "strict"
+    # Back the memory with hugepages of this size (2048 or 1048576)
+    hugepage_kb: int = None
+
     @property
     def machine_type(self) -> str:
         if self.chipset == "modern":
@@ -34,8 +45,17 @@ class KvmXmlDisk():
     driver: str = "qemu"
     type: str = "qcow2"
     target_dev: str = "vda"
+    # 'ide', 'virtio' (virtio-blk) or 'scsi' (on a virtio-scsi controller), see disk_profiles.py
     bus: str = "virtio"
     operating_system:OperatingSystem = OperatingSystem.LINUX
+    cache: str = None
+    io: str = None
+    discard: str = None
+    detect_zeroes: str = None
+    # Number of virtio queues (usually one per vCPU)
+    queues: int = None
+    # Run the I/O of the disk in an iothread of its own
+    iothread: bool = False
 
 
 @dataclass
@@ -47,12 +67,23 @@ class KvmXmlRemovableMedia():
     type: str = "raw"
     target_dev: str = "hdb"
     read_only: bool = True
+    bus: str = "ide"
 
 
 @dataclass
 class KvmXmlNetworkInterface():
     type: str
     source: str
+    # e.g. 'virtio', libvirt's default if not set (see interface_profiles.py)
+    model: str = None
+    # 'vhost' for vhost-net, qemu's userspace backend if not set
+    driver: str = None
+    queues: int = None
+    rx_queue_size: int = None
+    mtu: int = None
+    # Offloads turned off, e.g. {"tso4": "off"}
+    host_offloads: Dict[str, str] = None
+    guest_offloads: Dict[str, str] = None
 
 
 @dataclass
@@ -107,6 +138,24 @@ class KvmXmlObject():
         devices = list(self.hard_disks.values()) + self.removable_media
         obj['disk'] = self._generate_disk_devices(devices, self.core.efi_boot)
 
+        # virtio-scsi controller for the disks on the scsi bus
+        scsi_disks = [disk for disk in self.hard_disks.values() if disk.bus == "scsi"]
+        if scsi_disks:
+            controller = {
+                '@type': 'scsi',
+                '@index': '0',
+                '@model': 'virtio-scsi',
+            }
+            driver = {}
+            queues = max(disk.queues or 0 for disk in scsi_disks)
+            if queues:
+                driver['@queues'] = str(queues)
+            if "scsi" in self._iothreads():
+                driver['@iothread'] = str(self._iothreads()["scsi"])
+            if driver:
+                controller['driver'] = driver
+            obj['controller'] = controller
+
         # Network devices
         for net_dev in self.network_interfaces:
             if net_dev.type == "bridge":
@@ -123,6 +172,7 @@ class KvmXmlObject():
                         '@network': net_dev.source
                     }
                 }
+            n.update(self._render_interface_tuning(net_dev))
             obj['interface'] = n
         
         
@@ -133,6 +183,32 @@ class KvmXmlObject():
         return obj
     
 
+    def _render_interface_tuning(self, net_dev:KvmXmlNetworkInterface):
+        """Model, backend, queues, MTU and offloads of a network interface, if they are set"""
+        obj = {}
+        if net_dev.model:
+            obj['model'] = {'@type': net_dev.model}
+
+        driver = {}
+        if net_dev.driver:
+            driver['@name'] = net_dev.driver
+        # A single queue is the default
+        if net_dev.queues and net_dev.queues > 1:
+            driver['@queues'] = str(net_dev.queues)
+        if net_dev.rx_queue_size:
+            driver['@rx_queue_size'] = str(net_dev.rx_queue_size)
+        if net_dev.host_offloads:
+            driver['host'] = {f'@{name}': value for name, value in net_dev.host_offloads.items()}
+        if net_dev.guest_offloads:
+            driver['guest'] = {f'@{name}': value for name, value in net_dev.guest_offloads.items()}
+        if driver:
+            obj['driver'] = driver
+
+        if net_dev.mtu:
+            obj['mtu'] = {'@size': str(net_dev.mtu)}
+        return obj
+
+
     def _generate_vnc_config(self):
         vnc_obj = {
             '@type': 'vnc',
@@ -152,23 +228,54 @@ class KvmXmlObject():
         return vnc_obj
     
 
+    def _iothreads(self) -> dict:
+        """IOThread IDs (from 1) of the disks that get one, by target dev. The disks on the
+        virtio-scsi controller share the iothread of the controller ('scsi')."""
+        ids = {}
+        for disk in self.hard_disks.values():
+            if not disk.iothread:
+                continue
+            key = "scsi" if disk.bus == "scsi" else disk.target_dev
+            if key not in ids:
+                ids[key] = len(ids) + 1
+        return ids
+
+
     def _generate_disk_devices(self, devices:list, is_efi_boot:bool = False):
         rendered_devices = []
         chars = 'abcdefghijklmnop'
+        iothreads = self._iothreads()
         iter = 0
         for dev in devices:
-            if is_efi_boot:
+            bus = dev.bus
+            if bus == "ide" and is_efi_boot:
+                bus = "sata"
+
+            # Disks and removable media on the sata and scsi buses share the sdX names
+            if bus in ("sata", "scsi"):
                 dev_name = f"sd{chars[iter]}"
+                iter += 1
             else:
                 dev_name = dev.target_dev
 
+            driver = {
+                '@name': dev.driver,
+                '@type': dev.type
+            }
+            if isinstance(dev, KvmXmlDisk):
+                for attr in ['cache', 'io', 'discard', 'detect_zeroes']:
+                    if getattr(dev, attr):
+                        driver[f'@{attr}'] = getattr(dev, attr)
+                if bus == "virtio":
+                    if dev.queues:
+                        driver['@queues'] = str(dev.queues)
+                    if dev.target_dev in iothreads:
+                        driver['@iothread'] = str(iothreads[dev.target_dev])
+
             d = {
                 '@type': 'file',
                 '@device': dev.device,
-                'driver': {
-                    '@name': dev.driver,
-                    '@type': dev.type
-                },
+                'driver': driver,
                 'source': {
                     '@file': dev.file_path
                 },
@@ -177,7 +284,7 @@ class KvmXmlObject():
                 },
                 'target': {
                     '@dev': dev_name,
-                    '@bus': "sata" if is_efi_boot else "ide"
+                    '@bus': bus
                 }
             }
 
@@ -186,7 +293,6 @@ class KvmXmlObject():
                 d['readonly'] = {}
             
             rendered_devices.append(d)
-            iter += 1
         
         return rendered_devices
 
@@ -225,6 +331,67 @@ class KvmXmlObject():
         }
     
 
+    def _render_vcpu(self):
+        if not self.core.cpuset or self.core.vcpu_pins:
+            return self.core.cpu_count
+        return {
+            '@placement': 'static',
+            '@cpuset': ",".join(str(cpu) for cpu in self.core.cpuset),
+            '#text': str(self.core.cpu_count),
+        }
+
+
+    def _render_tuning(self):
+        """IOThreads, CPU pinning, NUMA memory policy and hugepages, if they are requested"""
+        obj = {}
+        iothreads = len(self._iothreads())
+        if iothreads:
+            obj['iothreads'] = str(iothreads)
+
+        if self.core.vcpu_pins:
+            obj['cputune'] = {
+                'vcpupin': [
+                    {
+                        '@vcpu': str(vcpu),
+                        '@cpuset': str(cpu),
+                    }
+                    for vcpu, cpu in enumerate(self.core.vcpu_pins)
+                ]
+            }
+            if self.core.emulator_pins:
+                obj['cputune']['emulatorpin'] = {
+                    '@cpuset': ",".join(str(cpu) for cpu in self.core.emulator_pins)
+                }
+                # The iothreads run with the emulator threads, off the vCPU cores if those are isolated
+                if iothreads:
+                    obj['cputune']['iothreadpin'] = [
+                        {
+                            '@iothread': str(iothread),
+                            '@cpuset': obj['cputune']['emulatorpin']['@cpuset'],
+                        }
+                        for iothread in range(1, iothreads + 1)
+                    ]
+
+        if self.core.numa_nodeset is not None:
+            obj['numatune'] = {
+                'memory': {
+                    '@mode': self.core.numa_mode,
+                    '@nodeset': self.core.numa_nodeset,
+                }
+            }
+
+        if self.core.hugepage_kb:
+            obj['memoryBacking'] = {
+                'hugepages': {
+                    'page': {
+                        '@size': str(self.core.hugepage_kb),
+                        '@unit': 'KiB',
+                    }
+                }
+            }
+        return obj
+
+
     def _render_features(self):
         """Enable features for the virtual machine"""
         default_features = ['acpi', 'apic']
@@ -258,10 +425,12 @@ class KvmXmlObject():
                 '@type': 'kvm',
                 'name': self.name,
                 'memory': {
-                    "@unit": "MB",
+                    # Hugepage backed memory has to be a multiple of the page size (in KiB)
+                    "@unit": "MiB" if self.core.hugepage_kb else "MB",
                     '#text': str(self.core.memory)
                 },
-                'vcpu': self.core.cpu_count,
+                'vcpu': self._render_vcpu(),
+                **self._render_tuning(),
                 'os': {
                     'type': {
                         # https://libvirt.org/formatcaps.html#elementGuest
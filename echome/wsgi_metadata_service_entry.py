@@ -0,0 +1,15 @@
+"""
+WSGI entry point of the metadata service, which serves the cloud-init seeds of
+the virtual machines (see vmmanager/metadata_service.py).
+"""
+
+import os
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'echome.settings')
+django.setup()
+
+from vmmanager.metadata_service import MetadataService, seed_cache
+
+seed_cache.load()
+metadata_app = MetadataService()